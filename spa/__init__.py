@@ -7,16 +7,23 @@ Library of components for the Zinnotech SPA implementation.
 __version__ = '0.1.0'
 __pkgname__ = 'spa'
 
+import atexit
+import copy
 import locale
 import logging
 import os
 import platform
+import queue
 import sys
 from urllib.parse import urlparse
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+from logging.handlers import (QueueHandler, QueueListener, RotatingFileHandler,
+                              TimedRotatingFileHandler)
 
 logger = logging.getLogger(__name__)
 
+# the thread writing the records queued by setup_logging(queued=True)
+_listener = None
+
 
 def add_basic_options(parser):
     parser.add_option("--version", action="store_true",
@@ -27,8 +34,16 @@ def add_basic_options(parser):
                       help="log directory")
     parser.add_option("--debug", action="store_true",
                       help="emit extra diagnostic information")
+    parser.add_option("--log-queue", action="store_true",
+                      help="write the log from a background thread instead of the "
+                           "logging one")
     parser.add_option("--config", dest="config_file", metavar="CONFIG_FILE",
                       help="configuration file")
+    parser.add_option("--metrics", action="store_true",
+                      help="log timings, counters and memory of each stage as JSON")
+    parser.add_option("--metrics-file", metavar="METRICS_FILE",
+                      help="write the totals to this Prometheus textfile at exit "
+                           "(implies --metrics)")
 
 
 def add_db_options(parser, dbadm_opts=False):
@@ -152,7 +167,7 @@ def parse_db_uri(uri):
 
 def setup_logging(appname=None, appvers=None, debug=None, filename=None,
                   dirname=None, max_bytes=None, backup_count=None,
-                  interval=None, log_dict=dict(), emit_platform_info=False):
+                  interval=None, log_dict=dict(), emit_platform_info=False, queued=None):
     """Provide a sane set of defaults for logging.
 
     directory - where to put log files, current dir if nothing specified
@@ -160,6 +175,9 @@ def setup_logging(appname=None, appvers=None, debug=None, filename=None,
     max_bytes - when the log exceeds this size, the log will rotate
     interval - time in minutes
     backup_count - maximum number of files to retain
+    queued - hand the records to a queue and format, write and rotate them
+             in a background thread, so a log call costs the caller little
+             more than merging its message
 
     Configure a rotating log file that rotates when the file size exceeds a
     specified number of bytes or when the time exceeds the specified interval.
@@ -182,6 +200,8 @@ def setup_logging(appname=None, appvers=None, debug=None, filename=None,
         interval = int(log_dict.get('interval', 1440))  # 1 day
     if backup_count is None:
         backup_count = int(log_dict.get('backup_count', 30))
+    if queued is None:
+        queued = to_bool(log_dict.get('queued', False))
 
     # set the log level
     level = logging.DEBUG if debug else logging.INFO
@@ -200,10 +220,15 @@ def setup_logging(appname=None, appvers=None, debug=None, filename=None,
         hand = EnhancedRotatingFileHandler(filename=filename, when='M', interval=interval, maxBytes=max_bytes,
                                            backupCount=backup_count)
 
-    fmt = '%(asctime)s.%(msecs)03d %(processName)s %(threadName)s %(name)s %(funcName)s: %(message)s' \
-        if level == logging.DEBUG else '%(asctime)s.%(msecs)03d %(processName)s %(threadName)s %(message)s'
-    datefmt = '%Y.%m.%d %H:%M:%S'
-    hand.setFormatter(logging.Formatter(fmt, datefmt))
+    hand.setFormatter(log_formatter(debug))
+
+    global _listener
+    stop_logging()
+    if queued:
+        records = queue.SimpleQueue()
+        _listener = QueueListener(records, hand)
+        _listener.start()
+        hand = MessageQueueHandler(records)
 
     root_logger = logging.getLogger()
     root_logger.setLevel(level)
@@ -212,11 +237,45 @@ def setup_logging(appname=None, appvers=None, debug=None, filename=None,
 
     if emit_platform_info:
         if appname and appvers:
-            logger.info('%s: %s' % (appname, appvers))
+            logger.info('%s: %s', appname, appvers)
         for line in platform_info():
             logger.info(line)
 
 
+def log_formatter(debug=False):
+    """the formatter of the records written by setup_logging"""
+    fmt = '%(asctime)s.%(msecs)03d %(processName)s %(threadName)s %(name)s %(funcName)s: %(message)s' \
+        if debug else '%(asctime)s.%(msecs)03d %(processName)s %(threadName)s %(message)s'
+    return logging.Formatter(fmt, '%Y.%m.%d %H:%M:%S')
+
+
+def stop_logging():
+    """write the records still queued by setup_logging(queued=True) and stop its thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+class MessageQueueHandler(QueueHandler):
+    """
+    a QueueHandler that only merges the message and its arguments before
+    queueing a record, and leaves the formatting of the time, the layout
+    and any traceback to the handler behind the QueueListener.  the records
+    stay in this process, so exc_info need not be rendered to be queued.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+
 class EnhancedRotatingFileHandler(TimedRotatingFileHandler, RotatingFileHandler):
 
     def __init__(self, filename, mode='a', maxBytes=0, backupCount=0,
@@ -247,7 +306,7 @@ def read_config_file(filename):
     try:
         cfg = configobj.ConfigObj(filename, file_error=True)
     except IOError as e:
-        logger.error("cannot read configuration: %s" % e)
+        logger.error("cannot read configuration: %s", e)
         raise
     return cfg
 
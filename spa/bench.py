@@ -0,0 +1,683 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Benchmarks for the SPA components.
+
+Each benchmark returns a dict of results that bin/spa-bench prints and can
+save as JSON, so runs can be compared over time.
+"""
+
+import functools
+import http.client
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def latency_summary(latencies, seconds):
+    latencies = np.asarray(latencies) * 1000
+    return {'requests': len(latencies), 'seconds': seconds,
+            'rps': len(latencies) / seconds if seconds > 0 else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+
+def run_load(fn, n_requests, concurrency):
+    """call fn(i) for i in range(n_requests) from concurrency threads"""
+    latencies = [None] * n_requests
+    counter = iter(range(n_requests))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            t = time.perf_counter()
+            fn(i)
+            latencies[i] = time.perf_counter() - t
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latency_summary([x for x in latencies if x is not None], time.perf_counter() - start)
+
+
+def naive_predict(host, port, guide_id, instance):
+    """one report per request on a fresh connection, as in the README"""
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    try:
+        body = json.dumps({'instances': [list(map(float, instance))]})
+        conn.request('POST', '/v1/models/guide_%s:predict' % guide_id, body)
+        return json.loads(conn.getresponse().read())['predictions'][0][0]
+    finally:
+        conn.close()
+
+
+def bench_client(host=None, port=None, grpc_port=None, guide_id=1, n_features=134,
+                 n_requests=2000, concurrency=16, server_delay=0.001,
+                 max_batch=256, max_latency=0.005):
+    """
+    compare the naive README client with the persistent REST client and the
+    micro-batched REST (and optionally gRPC) clients.  without a host a
+    LocalServingServer is started with server_delay seconds per call.
+    """
+    from spa.serving_client import GrpcClient, LocalServingServer, MicroBatcher, RestClient
+
+    server = None
+    if host is None:
+        server = LocalServingServer(delay=server_delay).start()
+        host, port = server.host, server.port
+    instances = (np.random.rand(n_requests, n_features) > 0.5).astype(np.float32)
+    results = dict()
+    try:
+        results['naive'] = run_load(
+            lambda i: naive_predict(host, port, guide_id, instances[i]), n_requests, concurrency)
+
+        client = RestClient(host, port)
+        results['persistent'] = run_load(
+            lambda i: client.predict(guide_id, instances[i:i + 1]), n_requests, concurrency)
+
+        batcher = MicroBatcher(client, max_batch, max_latency)
+        results['micro_batched'] = run_load(
+            lambda i: batcher.predict(guide_id, instances[i]), n_requests, concurrency)
+        results['micro_batched']['batches'] = batcher.batches
+        batcher.close()
+
+        if grpc_port:
+            grpc_client = GrpcClient(host, grpc_port)
+            batcher = MicroBatcher(grpc_client, max_batch, max_latency)
+            results['grpc_micro_batched'] = run_load(
+                lambda i: batcher.predict(guide_id, instances[i]), n_requests, concurrency)
+            results['grpc_micro_batched']['batches'] = batcher.batches
+            batcher.close()
+            grpc_client.close()
+    finally:
+        if server is not None:
+            server.stop()
+    return results
+
+
+STARTUP_COMMANDS = [['--version'], ['db', '--help'], ['model', '--help'],
+                    ['predict', '--help'], ['bench', '--help']]
+
+
+def parse_importtime(stderr):
+    """return [(module, cumulative seconds)] of the top-level imports in -X importtime output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            imports.append((name.strip(), int(cumulative) / 1e6))
+    return imports
+
+
+def bench_startup(commands=None, repeat=5, target_ms=200.0):
+    """
+    time the start of bin/spa subcommands that do not train.  import_ms is
+    the time spent importing modules beyond what a bare interpreter imports,
+    measured with python -X importtime; a command fails when it exceeds
+    target_ms.
+    """
+    spa_cmd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'spa')
+    baseline = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'],
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    builtin = set(name for name, _ in parse_importtime(baseline.stderr))
+
+    results = dict()
+    for args in commands or STARTUP_COMMANDS:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, '-X', 'importtime', spa_cmd] + args,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+            wall = time.perf_counter() - start
+            imports = [i for i in parse_importtime(proc.stderr) if i[0] not in builtin]
+            import_seconds = sum(s for _, s in imports)
+            if best is None or import_seconds < best['import_ms'] / 1000:
+                slowest = sorted(imports, key=lambda i: -i[1])[:3]
+                best = {'wall_ms': wall * 1000, 'import_ms': import_seconds * 1000,
+                        'slowest': ' '.join('%s:%.0f' % (n, s * 1000) for n, s in slowest),
+                        'exit': proc.returncode}
+        best['ok'] = best['import_ms'] <= target_ms
+        results[' '.join(args)] = best
+    return results
+
+
+def bench_pipeline(reports=(1000, 10000), actions=(134,), positive_rate=0.05, epochs=5,
+                   train=True, legacy_max_values=2000000, model_dir=None, keep=False, **dbinfo):
+    """
+    time each stage of the extract, train and score pipeline on synthetic
+    guides of every size in reports x actions.  returns a dict with the
+    configuration and one entry per size with the seconds of each stage:
+    load, fields (get_guide_fields), report_values (get_report_values, only
+    up to legacy_max_values values), matrix, fit and save (when train), score
+    and write.  without train the scores come from random weights.
+    """
+    import shutil
+    import tempfile
+
+    import spa
+    from spa import synthetic
+
+    config = {'reports': list(reports), 'actions': list(actions), 'positive_rate': positive_rate,
+              'epochs': epochs, 'train': train, 'platform': spa.platform_info()}
+    runs = []
+    tmp_dir = model_dir or tempfile.mkdtemp(prefix='spa-bench-')
+    try:
+        for n_actions in actions:
+            for n_reports in reports:
+                stages = dict()
+                run = {'reports': n_reports, 'actions': n_actions, 'stages': stages}
+                runs.append(run)
+
+                start = time.perf_counter()
+                guide_id = synthetic.create_guide(n_actions, **dbinfo)
+                if guide_id is None or synthetic.create_reports(
+                        guide_id, n_reports, positive_rate, **dbinfo) is None:
+                    run['error'] = 'cannot create the synthetic guide'
+                    continue
+                stages['load'] = time.perf_counter() - start
+                run['guide_id'] = guide_id
+                try:
+                    _bench_stages(guide_id, n_reports * n_actions <= legacy_max_values,
+                                  train, epochs, tmp_dir, stages, dbinfo)
+                except Exception as e:
+                    logger.error("benchmark of guide %s failed: %s", guide_id, e)
+                    run['error'] = str(e) or e.__class__.__name__
+                finally:
+                    if not keep:
+                        synthetic.drop_guide(guide_id, **dbinfo)
+                if 'matrix' in stages:
+                    run['reports_per_second'] = n_reports / stages['matrix']
+                logger.info("%d reports x %d actions: %s", n_reports, n_actions, ', '.join(
+                    '%s %.2fs' % (k, v) for k, v in stages.items()))
+    finally:
+        if model_dir is None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'config': config, 'runs': runs}
+
+
+def _bench_stages(guide_id, legacy, train, epochs, model_dir, stages, dbinfo):
+    import spa.dbmanager as dbm
+    from spa.numpy_model import CLIP, NumpyModel
+
+    def timed(name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        stages[name] = time.perf_counter() - start
+        return result
+
+    timed('fields', dbm.get_guide_fields, guide_id, **dbinfo)
+    if legacy:
+        timed('report_values', dbm.get_report_values, guide_id, **dbinfo)
+    layout, report_ids, features, labels = timed('matrix', dbm.get_feature_matrix,
+                                                 guide_id, **dbinfo)
+    mean, scale = features.mean(axis=0), features.std(axis=0)
+    scale[scale == 0] = 1
+    if train:
+        from spa.feature_manifest import FeatureManifest
+        from spa.model_maker import ModelMaker
+        from spa.numpy_model import export_weights
+
+        maker = ModelMaker()
+        scaled = np.clip((features - mean) / scale, -CLIP, CLIP)
+        model = maker.get_tf_model(scaled)
+        timed('fit', model.fit, x=scaled, y=labels, batch_size=maker.BATCH_SIZE,
+              epochs=epochs, verbose=0)
+        path = os.path.join(model_dir, 'guide_%s' % guide_id)
+        start = time.perf_counter()
+        model.save(path)
+        FeatureManifest(guide_id, layout, mean, scale).save(path)
+        export_weights(model, path)
+        stages['save'] = time.perf_counter() - start
+        scorer = NumpyModel.load(path)
+    else:
+        rng = np.random.default_rng(0)
+        scorer = NumpyModel([rng.normal(0, 0.1, (len(layout), 16)).astype(np.float32),
+                             rng.normal(0, 0.1, (16, 1)).astype(np.float32)],
+                            [np.zeros(16, dtype=np.float32), np.zeros(1, dtype=np.float32)],
+                            ['relu', 'sigmoid'], mean, scale)
+    predictions = timed('score', scorer.predict, features)
+    timed('write', dbm.save_predictions, report_ids, predictions, **dbinfo)
+
+
+PIVOT_METHODS = ['report_values', 'matrix', 'pivot']
+
+
+def bench_pivot(guide_id=None, reports=(1000, 10000), actions=(134,), positive_rate=0.05,
+                repeat=3, keep=False, **dbinfo):
+    """
+    compare the ways of reading a guide's reports: report_values (the
+    row-per-value query of get_report_values), matrix (get_feature_matrix,
+    pivoted in numpy), pivot (get_pivoted_feature_matrix, pivoted by the
+    database and sent as binary arrays) and, if the report_feature_vector
+    table exists, vectors (get_vector_matrix of refreshed vectors).  runs on guide_id, or else on
+    synthetic guides of every size in reports x actions.  returns one entry
+    per guide and method with the median seconds of repeat runs, reports
+    per second, and the rows and megabytes the query sends.
+    """
+    from spa import synthetic
+
+    results = dict()
+    if guide_id is not None:
+        _bench_pivot_guide(int(guide_id), 'guide %s' % guide_id, repeat, results, dbinfo)
+        return results
+    for n_actions in actions:
+        for n_reports in reports:
+            guide_id = synthetic.create_guide(n_actions, **dbinfo)
+            if guide_id is None or synthetic.create_reports(guide_id, n_reports, positive_rate,
+                                                            **dbinfo) is None:
+                raise RuntimeError('cannot create the synthetic guide')
+            try:
+                _bench_pivot_guide(guide_id, '%dx%d' % (n_reports, n_actions), repeat,
+                                   results, dbinfo)
+            finally:
+                if not keep:
+                    synthetic.drop_guide(guide_id, **dbinfo)
+    return results
+
+
+def _bench_pivot_guide(guide_id, name, repeat, results, dbinfo):
+    import spa.dbmanager as dbm
+    from spa.pg_binary import HEADER_SIZE, TRAILER, array_row_dtype
+
+    methods = {'report_values': dbm.get_report_values, 'matrix': dbm.get_feature_matrix,
+               'pivot': dbm.get_pivoted_feature_matrix}
+    mgr = dbm.DBManager()
+    try:
+        mgr.connect(**dbinfo)
+        vectors = dbm.has_feature_vectors(mgr)
+    finally:
+        mgr.disconnect()
+    if vectors:
+        start = time.perf_counter()
+        summary = dbm.refresh_feature_vectors(guide_id, **dbinfo)
+        results['%s refresh' % name] = {'seconds': time.perf_counter() - start,
+                                        'vectors': summary['updated'] if summary else None}
+        methods['vectors'] = functools.partial(dbm.get_vector_matrix, refresh=False)
+    for method in PIVOT_METHODS + (['vectors'] if vectors else []):
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = methods[method](guide_id, **dbinfo)
+            seconds.append(time.perf_counter() - start)
+            if result is None:
+                raise RuntimeError('%s of guide %s failed' % (method, guide_id))
+        n_reports = len(result) if method == 'report_values' else len(result[1])
+        seconds = float(np.median(seconds))
+        results['%s %s' % (name, method)] = {
+            'seconds': seconds, 'reports': n_reports,
+            'reports_per_second': n_reports / seconds if seconds > 0 else 0.0}
+
+    # what each query sends: one text row per value, or one binary row per report
+    rows, size = _copy_size(dbm.REPORT_VALUES_SQL.format(guide_id=guide_id), dbinfo)
+    results['%s report_values' % name].update({'rows': rows, 'mb': size / 1048576.0})
+    layout = dbm.get_guide_layout(guide_id, **dbinfo)
+    n_reports = results['%s pivot' % name]['reports']
+    size = HEADER_SIZE + n_reports * array_row_dtype(len(layout)).itemsize + len(TRAILER)
+    results['%s pivot' % name].update({'rows': n_reports, 'mb': size / 1048576.0})
+
+
+def _copy_size(sql, dbinfo):
+    """the rows and bytes of the text COPY output of a query"""
+    import spa.dbmanager as dbm
+
+    class Counter(object):
+        size = 0
+
+        def write(self, data):
+            self.size += len(data)
+
+    counter = Counter()
+    mgr = dbm.DBManager()
+    try:
+        mgr.connect(**dbinfo)
+        with mgr.db_conn.cursor() as cur:
+            cur.copy_expert("COPY (%s) TO STDOUT" % sql.strip().rstrip(';'), counter,
+                            size=1024 * 1024)
+            return cur.rowcount, counter.size
+    finally:
+        mgr.disconnect()
+
+
+def bench_fetch(guide_ids=None, guides=20, reports=1000, actions=134, positive_rate=0.05,
+                workers=(1, 2, 4, 8), methods=('matrix', 'pivot'), repeat=3, keep=False,
+                **dbinfo):
+    """
+    time reading a batch of guides one after another and with
+    dbm.fetch_feature_matrices at each number of workers.  runs on
+    guide_ids, or else on guides synthetic guides of reports x actions.
+    returns one entry per method and number of workers with the median
+    seconds of repeat runs, the guides per second and the speedup over
+    reading the guides one after another.
+    """
+    import spa.dbmanager as dbm
+    from spa import synthetic
+
+    functions = {'matrix': dbm.get_feature_matrix, 'pivot': dbm.get_pivoted_feature_matrix}
+    # the speedups are relative to one worker
+    workers = sorted(set([1] + list(workers)))
+    created = []
+    try:
+        if not guide_ids:
+            for i in range(guides):
+                guide_id = synthetic.create_guide(actions, seed=i, **dbinfo)
+                if guide_id is None:
+                    raise RuntimeError('cannot create the synthetic guide')
+                created.append(guide_id)
+                if synthetic.create_reports(guide_id, reports, positive_rate, seed=i,
+                                            **dbinfo) is None:
+                    raise RuntimeError('cannot create the synthetic reports')
+            guide_ids = created
+        results = dict()
+        for method in methods:
+            fetch = functions[method]
+            serial = None
+            for n in workers:
+                seconds = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    if n == 1:
+                        matrices = [fetch(g, **dbinfo) for g in guide_ids]
+                    else:
+                        matrices = [m for _, m in dbm.fetch_feature_matrices(
+                            guide_ids, fetch=fetch, workers=n, **dbinfo)]
+                    seconds.append(time.perf_counter() - start)
+                    if [m for m in matrices if m is None]:
+                        raise RuntimeError('%s of a guide failed' % method)
+                seconds = float(np.median(seconds))
+                serial = serial or seconds
+                results['%s workers=%d' % (method, n)] = {
+                    'seconds': seconds, 'guides': len(guide_ids),
+                    'reports': sum(len(m[1]) for m in matrices),
+                    'guides_per_second': len(guide_ids) / seconds if seconds > 0 else 0.0,
+                    'speedup': serial / seconds if seconds > 0 else 0.0}
+                logger.info("%s with %d workers: %.2fs", method, n, seconds)
+        return results
+    finally:
+        if not keep:
+            for guide_id in created:
+                synthetic.drop_guide(guide_id, **dbinfo)
+
+
+def bench_packed(guide_id=None, reports=(10000,), actions=(134,), positive_rate=0.05,
+                 batch_size=2048, keep=False, **dbinfo):
+    """
+    compare holding a guide's features dense (get_feature_matrix) and
+    bit-packed (spa.packed_features.get_packed_matrix).  each way runs in a
+    fresh process that reads the guide, makes one pass over it in training
+    batches of batch_size rows (unpacked, scaled and clipped) and scores it
+    with random weights.  returns one entry per guide and way with the
+    megabytes of the features, the peak RSS above the interpreter's, the
+    read seconds and the rows per second of the pass and of scoring.
+    runs on guide_id, or else on synthetic guides of every size in reports
+    x actions.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from spa import synthetic
+
+    def run(guide_id, name, results):
+        for packed in [False, True]:
+            # a fresh process per way, so the peak RSS is its own
+            with ProcessPoolExecutor(max_workers=1,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                r = executor.submit(_bench_packed_guide, guide_id, packed, batch_size,
+                                    dbinfo).result()
+            results['%s %s' % (name, 'packed' if packed else 'dense')] = r
+
+    results = dict()
+    if guide_id is not None:
+        run(int(guide_id), 'guide %s' % guide_id, results)
+        return results
+    for n_actions in actions:
+        for n_reports in reports:
+            guide_id = synthetic.create_guide(n_actions, **dbinfo)
+            if guide_id is None or synthetic.create_reports(guide_id, n_reports, positive_rate,
+                                                            **dbinfo) is None:
+                raise RuntimeError('cannot create the synthetic guide')
+            try:
+                run(guide_id, '%dx%d' % (n_reports, n_actions), results)
+            finally:
+                if not keep:
+                    synthetic.drop_guide(guide_id, **dbinfo)
+    return results
+
+
+def _bench_packed_guide(guide_id, packed, batch_size, dbinfo):
+    import spa.dbmanager as dbm
+    from spa import metrics
+    from spa.numpy_model import CLIP, NumpyModel
+    from spa.packed_features import get_packed_matrix
+
+    base = metrics.rss_bytes()
+    start = time.perf_counter()
+    if packed:
+        matrix = get_packed_matrix(guide_id, **dbinfo)
+    else:
+        matrix = dbm.get_feature_matrix(guide_id, **dbinfo)
+    if matrix is None:
+        raise RuntimeError('cannot read guide %s' % guide_id)
+    read = time.perf_counter() - start
+    layout, report_ids, features, labels = matrix
+    rows = len(report_ids)
+
+    rng = np.random.default_rng(0)
+    mean = rng.random(len(layout)).astype(np.float32)
+    scale = np.ones(len(layout), dtype=np.float32)
+    start = time.perf_counter()
+    for i in range(0, rows, batch_size):
+        x = features[i:i + batch_size]
+        np.clip((x - mean) / scale, -CLIP, CLIP)
+    passed = time.perf_counter() - start
+
+    model = NumpyModel([rng.normal(0, 0.1, (len(layout), 16)).astype(np.float32),
+                        rng.normal(0, 0.1, (16, 1)).astype(np.float32)],
+                       [np.zeros(16, dtype=np.float32), np.zeros(1, dtype=np.float32)],
+                       ['relu', 'sigmoid'], mean, scale)
+    start = time.perf_counter()
+    model.predict(features, batch_size=batch_size)
+    scored = time.perf_counter() - start
+    return {'rows': rows, 'mb': features.nbytes / 1048576.0,
+            'peak_rss_mb': (metrics.peak_rss_bytes() - (base or 0)) / 1048576.0,
+            'read_seconds': read,
+            'pass_rows_per_second': rows / passed if passed > 0 else 0.0,
+            'score_rows_per_second': rows / scored if scored > 0 else 0.0}
+
+
+def bench_live(columns=(134, 500), hidden=16, updates=5000, rest_updates=1000, seed=0):
+    """
+    measure the latency of one changed action of a report being filled in,
+    for random two-layer models of every number of columns:
+
+    incremental - spa.live_scoring.LiveScorer updating the first layer's
+                  pre-activation of an open session
+    full - NumpyModel.predict of the whole vector
+    rest - the whole vector sent to a LocalServingServer over a persistent
+           RestClient connection, like a TF Serving round trip
+
+    returns one entry per model and way with the p50 and p99 milliseconds,
+    and the largest difference between incremental and full predictions.
+    """
+    from spa.live_scoring import LiveScorer
+    from spa.numpy_model import NumpyModel
+    from spa.serving_client import LocalServingServer, RestClient
+
+    def timed(fn, n):
+        latencies = []
+        start = time.perf_counter()
+        for i in range(n):
+            t = time.perf_counter()
+            fn(i)
+            latencies.append(time.perf_counter() - t)
+        return latency_summary(latencies, time.perf_counter() - start)
+
+    rng = np.random.default_rng(seed)
+    results = dict()
+    for n_columns in columns:
+        model = NumpyModel([rng.normal(0, 0.1, (n_columns, hidden)).astype(np.float32),
+                            rng.normal(0, 0.1, (hidden, 1)).astype(np.float32)],
+                           [np.zeros(hidden, dtype=np.float32), np.zeros(1, dtype=np.float32)],
+                           ['relu', 'sigmoid'], rng.random(n_columns).astype(np.float32),
+                           np.ones(n_columns, dtype=np.float32))
+        cols = rng.integers(0, n_columns, updates)
+        values = rng.integers(0, 2, updates).astype(np.float32)
+        name = '%d columns' % n_columns
+
+        scorer = LiveScorer(model)
+        scorer.start(0)
+        incremental = np.empty(updates, dtype=np.float32)
+
+        def update(i):
+            incremental[i] = scorer.set(0, cols[i], values[i])
+        results[name + ' incremental'] = timed(update, updates)
+
+        raw = np.zeros((1, n_columns), dtype=np.float32)
+        full = np.empty(updates, dtype=np.float32)
+
+        def rescore(i):
+            raw[0, cols[i]] = values[i]
+            full[i] = model.predict(raw)[0]
+        results[name + ' full'] = timed(rescore, updates)
+        results[name + ' incremental']['max_difference'] = \
+            float(np.max(np.abs(incremental - full)))
+
+        server = LocalServingServer(scorer=model.predict).start()
+        client = RestClient(server.host, server.port)
+        raw[:] = 0
+        try:
+            def request(i):
+                raw[0, cols[i]] = values[i]
+                client.predict(1, raw)
+            results[name + ' rest'] = timed(request, min(rest_updates, updates))
+        finally:
+            client.close()
+            server.stop()
+    return results
+
+
+def bench_logging(records=20000, threads=1, max_bytes=1024 * 1024):
+    """
+    measure what a log call costs the thread making it.  each way logs
+    records messages with the arguments of a typical SQL debug line, spread
+    over threads threads, to a rotating file of max_bytes (so rotation is
+    part of the cost):
+
+    file, file lazy - the file handler on the calling thread, with the
+                      message formatted by % before the call or by logging
+    queued lazy - spa.setup_logging(queued=True): a MessageQueueHandler in
+                  front of the same file handler
+    debug off, debug off lazy - a debug call while the level is INFO, as
+                                DBManager makes for every query
+
+    returns one entry per way with the microseconds per record on the
+    calling threads and, for queued, until the file is written.
+    """
+    import shutil
+    import tempfile
+    from logging.handlers import QueueListener
+    from queue import SimpleQueue
+
+    import spa
+    import spa.dbmanager as dbm
+
+    sql = dbm.MATRIX_VALUES_SQL
+    guide_id = 28
+
+    def eager(log):
+        log.info("sql: %s" % sql)
+
+    def lazy(log):
+        log.info("sql: %s", sql)
+
+    def debug_eager(log):
+        log.debug("guide %s sql:\n%s" % (guide_id, sql))
+
+    def debug_lazy(log):
+        log.debug("guide %s sql:\n%s", guide_id, sql)
+
+    def run(call, log):
+        per_thread = records // threads
+
+        def work():
+            for _ in range(per_thread):
+                call(log)
+
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        start = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return time.perf_counter() - start, per_thread * threads
+
+    log_dir = tempfile.mkdtemp(prefix='spa-bench-log-')
+    log = logging.getLogger('spa.bench.logging')
+    log.propagate = False
+    results = dict()
+    try:
+        ways = [('file', eager, False), ('file lazy', lazy, False), ('queued lazy', lazy, True),
+                ('debug off', debug_eager, False), ('debug off lazy', debug_lazy, False)]
+        for name, call, queued in ways:
+            hand = spa.EnhancedRotatingFileHandler(
+                os.path.join(log_dir, 'bench.log'), maxBytes=max_bytes, backupCount=2,
+                when='M', interval=1440)
+            hand.setFormatter(spa.log_formatter())
+            listener = None
+            if queued:
+                queue = SimpleQueue()
+                listener = QueueListener(queue, hand)
+                listener.start()
+                log.handlers = [spa.MessageQueueHandler(queue)]
+            else:
+                log.handlers = [hand]
+            log.setLevel(logging.INFO)
+            start = time.perf_counter()
+            seconds, n = run(call, log)
+            r = {'records': n, 'us_per_record': seconds / n * 1e6}
+            if listener is not None:
+                listener.stop()
+                r['us_per_record_written'] = (time.perf_counter() - start) / n * 1e6
+            hand.close()
+            results[name] = r
+    finally:
+        log.handlers = []
+        shutil.rmtree(log_dir, ignore_errors=True)
+    return results
+
+
+PIPELINE_STAGES = ['load', 'fields', 'report_values', 'matrix', 'fit', 'save', 'score', 'write']
+
+
+def format_pipeline(results):
+    lines = ['%9s %8s ' % ('reports', 'actions') + ' '.join('%13s' % s for s in PIPELINE_STAGES)]
+    for run in results['runs']:
+        stages = run['stages']
+        lines.append('%9d %8d ' % (run['reports'], run['actions']) + ' '.join(
+            '%13.3f' % stages[s] if s in stages else '%13s' % '-' for s in PIPELINE_STAGES) +
+            ('  %s' % run['error'] if 'error' in run else ''))
+    return '\n'.join(lines)
+
+
+def format_results(results):
+    lines = []
+    for name, r in results.items():
+        lines.append('%-20s %s' % (name, ', '.join(
+            '%s=%s' % (k, '%.3f' % v if isinstance(v, float) else v) for k, v in r.items())))
+    return '\n'.join(lines)
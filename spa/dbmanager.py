@@ -5,15 +5,28 @@ Database management utilities.
 This file contains generic database interface definitions.
 """
 
+import collections
+import contextlib
+import csv
+import io
+import itertools
 import logging
+import operator
+import threading
+import time
 import psycopg2
 import psycopg2.extras
 import psycopg2.extensions
 
-from spa.schema import schema_def
+from spa import dbpool
+from spa import metrics
+from spa.defaults import Defaults
+from spa.schema import feature_vector_schema_def, history_schema_def, index_def, schema_def
 
 logger = logging.getLogger(__name__)
 
+_local = threading.local()
+
 
 def mkdbstr(dbhost, dbport, dbname, dbuser=None):
     if dbuser is not None:
@@ -24,11 +37,38 @@ def mkdbstr(dbhost, dbport, dbname, dbuser=None):
 def connect(dbhost, dbport, dbname, dbuser, dbpass):
     db_conn_info = "host=%s port=%s database=%s user=%s" % (
         dbhost, dbport, dbname, dbuser)
-    logger.debug("db_conn=%s" % (db_conn_info))
+    logger.debug("db_conn=%s", db_conn_info)
     return psycopg2.connect(host=dbhost, port=dbport, database=dbname,
                             user=dbuser, password=dbpass, connect_timeout=5)
 
 
+def _active_sessions():
+    if not hasattr(_local, 'sessions'):
+        _local.sessions = dict()
+    return _local.sessions
+
+
+@contextlib.contextmanager
+def session(**kwargs):
+    """
+    context manager yielding a connected DBManager.  while a session is open,
+    every DBManager on the same thread that connects to the same database
+    (including the one inside each helper in this module) shares its
+    connection instead of checking out another one from the pool.
+    """
+    mgr = DBManager()
+    mgr.connect(**kwargs)
+    sessions = _active_sessions()
+    if mgr.key not in sessions:
+        sessions[mgr.key] = mgr
+    try:
+        yield mgr
+    finally:
+        if sessions.get(mgr.key) is mgr:
+            del sessions[mgr.key]
+        mgr.disconnect()
+
+
 def clear_table(which_data='all', **kwargs):
     mgr = DBManager()
     try:
@@ -36,9 +76,9 @@ def clear_table(which_data='all', **kwargs):
         if which_data == 'all' or which_data == 'report_prediction':
             mgr.modify('DELETE FROM report_prediction')
         if which_data == 'all' or which_data == 'report_prediction_history':
-            mgr.modify('DELETE FROM report_prediction_history')
+            mgr.modify('TRUNCATE report_prediction_history')
     except psycopg2.Error as err:
-        logger.error('clear failed: %s' % str(err).strip())
+        logger.error('clear failed: %s', str(err).strip())
         if mgr:
             mgr.db_conn.rollback()
     finally:
@@ -51,12 +91,15 @@ def drop_table(**kwargs):
     try:
         mgr.connect(**kwargs)
         mgr.modify('drop trigger if exists prediction_history on report_prediction')
+        mgr.modify('drop trigger if exists prediction_history_insert on report_prediction')
+        mgr.modify('drop trigger if exists prediction_history_update on report_prediction')
         mgr.modify('drop function if exists report_prediction_trigger()')
         mgr.modify('drop table if exists report_prediction')
         mgr.modify('drop table if exists report_prediction_history')
+        mgr.modify('drop function if exists report_prediction_history_partition(date)')
         mgr.modify('drop sequence if exists report_prediction_history_seq')
     except psycopg2.Error as err:
-        logger.error('clear failed: %s' % str(err).strip())
+        logger.error('clear failed: %s', str(err).strip())
         if mgr:
             mgr.db_conn.rollback()
     finally:
@@ -70,11 +113,11 @@ def create_table(**kwargs):
         mgr.connect(**kwargs)
         with mgr.db_conn.cursor() as cur:
             for sql in schema_def:
-                logger.debug("execute sql:\n%s" % sql)
+                logger.debug("execute sql:\n%s", sql)
                 cur.execute(sql)
         mgr.db_conn.commit()
     except psycopg2.Error as err:
-        logger.error('create table failed: %s' % str(err).strip())
+        logger.error('create table failed: %s', str(err).strip())
         if mgr:
             mgr.db_conn.rollback()
     finally:
@@ -82,11 +125,188 @@ def create_table(**kwargs):
             mgr.disconnect()
 
 
+def history_is_partitioned(mgr):
+    """
+    whether report_prediction_history is partitioned, None if there is no
+    such table
+    """
+    rows = mgr.get_all_rows("""
+        SELECT  relkind = 'p'
+        FROM    pg_class
+        WHERE   oid = to_regclass('report_prediction_history')
+        ;
+    """)
+    return bool(rows[0][0]) if rows else None
+
+
+def _check_history_partitioned(mgr):
+    partitioned = history_is_partitioned(mgr)
+    if not partitioned:
+        logger.error("report_prediction_history is %s, run spa-db %s",
+                     "missing" if partitioned is None else "not partitioned",
+                     "create-table" if partitioned is None else "migrate-history")
+    return partitioned
+
+
+def add_history_partitions(months_ahead=3, **kwargs):
+    """
+    create the missing report_prediction_history partitions up to
+    months_ahead from now, returns the names of the ones created
+    """
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        if not _check_history_partitioned(mgr):
+            return None
+        # the partition function is only called, and takes its locks, when a
+        # month is missing
+        sql = """
+            SELECT  report_prediction_history_partition(M.day)
+            FROM    (
+                        SELECT  (now() + make_interval(months => m))::date AS day
+                        FROM    generate_series(0, {months_ahead}) AS m
+                    ) AS M
+            WHERE   to_regclass('report_prediction_history_p' || to_char(M.day, 'YYYYMM'))
+                    IS NULL
+            ;
+        """.format(months_ahead=int(months_ahead))
+        rows = mgr.get_all_rows(sql)
+        created = [r[0] for r in rows] if rows else []
+        for name in created:
+            logger.info("created partition %s", name)
+        return created
+    except psycopg2.Error as err:
+        logger.error('creating history partitions failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def migrate_history(**kwargs):
+    """
+    move a report_prediction_history created before the history was
+    partitioned into the monthly partitioned table, with the statement
+    level triggers, in one transaction.  on a partitioned history only the
+    partition function is brought up to date.  returns the number of rows
+    moved, or None on failure.
+    """
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        partitioned = history_is_partitioned(mgr)
+        if partitioned is None:
+            logger.error("there is no report_prediction_history, run spa-db create-table")
+            return None
+        with mgr.transaction(), mgr.db_conn.cursor() as cur:
+            if partitioned:
+                # create-table defines the function with CREATE OR REPLACE
+                cur.execute([sql for sql in history_schema_def
+                             if 'FUNCTION report_prediction_history_partition' in sql][0])
+                logger.info("report_prediction_history is already partitioned")
+                return 0
+            statements = [
+                'DROP TRIGGER IF EXISTS prediction_history ON report_prediction',
+                'DROP TRIGGER IF EXISTS prediction_history_insert ON report_prediction',
+                'DROP TRIGGER IF EXISTS prediction_history_update ON report_prediction',
+                'DROP FUNCTION IF EXISTS report_prediction_trigger()',
+                'ALTER TABLE report_prediction_history '
+                'RENAME TO report_prediction_history_unpartitioned',
+                'ALTER INDEX IF EXISTS report_prediction_history_pkey '
+                'RENAME TO report_prediction_history_unpartitioned_pkey']
+            for sql in statements + history_schema_def:
+                logger.debug("execute sql:\n%s", sql)
+                cur.execute(sql)
+            # the months of the old rows, so none of them lands in the default partition
+            cur.execute("""
+                SELECT  report_prediction_history_partition(M.day::date)
+                FROM    (
+                            SELECT  generate_series(
+                                        date_trunc('month', min(history_change_time)),
+                                        max(history_change_time), interval '1 month') AS day
+                            FROM    report_prediction_history_unpartitioned
+                        ) AS M
+                ;
+            """)
+            logger.info("created %d partitions for the existing history", cur.rowcount)
+            cur.execute("""
+                INSERT INTO report_prediction_history
+                        (report_id, prediction, history_change_time, history_change_type)
+                SELECT  report_id, prediction, COALESCE(history_change_time, now()),
+                        history_change_type
+                FROM    report_prediction_history_unpartitioned
+                ;
+            """)
+            moved = cur.rowcount
+            cur.execute('DROP TABLE report_prediction_history_unpartitioned')
+            cur.execute('DROP SEQUENCE IF EXISTS report_prediction_history_seq')
+        logger.info("moved %d history rows into the partitioned report_prediction_history", moved)
+        return moved
+    except psycopg2.Error as err:
+        logger.error('migrating prediction history failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def prune_history(retain_months, months_ahead=3, **kwargs):
+    """
+    drop the monthly partitions of report_prediction_history that end more
+    than retain_months before the current month, delete the rows that old
+    from its default partition, and make sure the coming months' partitions
+    exist.  returns the names of the dropped partitions.
+    """
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        if not _check_history_partitioned(mgr):
+            return None
+        sql = """
+            SELECT  C.relname
+            FROM    pg_inherits AS I
+                    JOIN pg_class AS C ON C.oid = I.inhrelid
+            WHERE   I.inhparent = 'report_prediction_history'::regclass
+                    AND C.relname ~ '^report_prediction_history_p[0-9]{{6}}$'
+                    AND right(C.relname, 6) < to_char(
+                        date_trunc('month', now()) - make_interval(months => {retain_months}),
+                        'YYYYMM')
+            ORDER BY C.relname
+            ;
+        """.format(retain_months=int(retain_months))
+        rows = mgr.get_all_rows(sql) or []
+        dropped = []
+        for r in rows:
+            logger.info("drop partition %s", r[0])
+            mgr.modify('DROP TABLE %s' % r[0])
+            dropped.append(r[0])
+        # rows written before their month's partition existed
+        sql = """
+            WITH deleted AS (
+                DELETE FROM report_prediction_history_default
+                WHERE   history_change_time <
+                        date_trunc('month', now()) - make_interval(months => {retain_months})
+                RETURNING 1
+            )
+            SELECT count(*) FROM deleted
+            ;
+        """.format(retain_months=int(retain_months))
+        rows = mgr.get_all_rows(sql)
+        logger.info("deleted %d rows from report_prediction_history_default",
+                    rows[0][0] if rows else 0)
+    except psycopg2.Error as err:
+        logger.error('pruning history failed: %s', str(err).strip())
+        return None
+    finally:
+        if mgr:
+            mgr.disconnect()
+    add_history_partitions(months_ahead, **kwargs)
+    return dropped
+
+
 def create_test_db(dbhost, dbport, dbname,
                         dbuser, dbpass, dbadmuser, dbadmpass):
     mgr = DBManager()
-    logger.info("create database %s as user %s" %
-                (mkdbstr(dbhost, dbport, dbname), dbadmuser))
+    logger.info("create database %s as user %s",
+                mkdbstr(dbhost, dbport, dbname), dbadmuser)
     try:
         mgr.connect(dbhost, dbport, 'postgres', dbadmuser, dbadmpass)
         mgr.db_conn.set_isolation_level(
@@ -95,7 +315,7 @@ def create_test_db(dbhost, dbport, dbname,
             cur.execute('create database %s' % dbname)
         mgr.db_conn.commit()
     except psycopg2.Error as err:
-        logger.error('creating database failed: %s' % str(err).strip())
+        logger.error('creating database failed: %s', str(err).strip())
         if mgr:
             mgr.db_conn.rollback()
     finally:
@@ -111,10 +331,12 @@ def drop_test_db(dbhost, dbport, dbname,
         mgr.db_conn.set_isolation_level(
             psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         with mgr.db_conn.cursor() as cur:
+            # pooled connections would keep the database busy
+            dbpool.close_pools(dbname=dbname)
             cur.execute('drop database %s' % dbname)
         mgr.db_conn.commit()
     except psycopg2.Error as err:
-        logger.error('dropping database failed: %s' % str(err).strip())
+        logger.error('dropping database failed: %s', str(err).strip())
         if mgr:
             mgr.db_conn.rollback()
     finally:
@@ -137,7 +359,7 @@ def create_test_report_result(data, **kwargs):
         ) for row in data)
         mgr.modify_values(sql, data_iter, 1000)
     except psycopg2.Error as err:
-        logger.error('creating test report_result test_data failed: %s' % str(err).strip())
+        logger.error('creating test report_result test_data failed: %s', str(err).strip())
         if mgr:
             mgr.db_conn.rollback()
     finally:
@@ -158,7 +380,7 @@ def create_test_report(data, **kwargs):
         ) for row in data)
         mgr.modify_values(sql, data_iter, 1000)
     except psycopg2.Error as err:
-        logger.error('creating test report test_data failed: %s' % str(err).strip())
+        logger.error('creating test report test_data failed: %s', str(err).strip())
         if mgr:
             mgr.db_conn.rollback()
     finally:
@@ -166,12 +388,430 @@ def create_test_report(data, **kwargs):
             mgr.disconnect()
 
 
+class CsvColumnFilter(object):
+    """
+    read-only file object that streams selected columns of a CSV file, so a
+    file with extra columns can be fed to COPY without loading it in memory.
+    """
+
+    def __init__(self, f, columns, rows_per_read=1000):
+        self.reader = csv.reader(f)
+        self.pick = operator.itemgetter(*columns)
+        self.single = len(columns) == 1
+        self.rows_per_read = rows_per_read
+        self.pending = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            rows = list(itertools.islice(self.reader, self.rows_per_read))
+            if not rows:
+                break
+            buf = io.StringIO()
+            writer = csv.writer(buf, lineterminator='\n')
+            if self.single:
+                writer.writerows([self.pick(r)] for r in rows)
+            else:
+                writer.writerows(self.pick(r) for r in rows)
+            self.pending += buf.getvalue()
+        if size < 0:
+            data, self.pending = self.pending, ''
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def get_secondary_indexes(mgr, table):
+    """return (name, definition) of the indexes of table that back no constraint"""
+    sql = """
+        SELECT  I.indexrelid::regclass::text, pg_get_indexdef(I.indexrelid)
+        FROM    pg_index AS I
+        WHERE   I.indrelid = '{table}'::regclass
+                AND NOT EXISTS ( SELECT 1 FROM pg_constraint AS C WHERE C.conindid = I.indexrelid )
+        ;
+    """.format(table=table)
+    return mgr.get_all_rows(sql) or []
+
+
+def copy_csv(filename, table, columns, csv_columns=None, rebuild_indexes=False, **kwargs):
+    """
+    stream a CSV file into table with COPY FROM STDIN.  csv_columns selects
+    and orders the columns of the file to load (all of them by default).
+    with rebuild_indexes the table's secondary indexes are dropped before
+    the load and created again afterwards, all in one transaction, so a
+    failed load or index build leaves the table and its indexes as they
+    were.  the table is locked meanwhile.  returns the number of rows
+    loaded, or None on failure.
+    """
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        start = time.time()
+        indexes = get_secondary_indexes(mgr, table) if rebuild_indexes else []
+        with open(filename, newline='') as f, mgr.transaction(), mgr.db_conn.cursor() as cur:
+            for name, _ in indexes:
+                logger.info("drop index %s", name)
+                cur.execute('DROP INDEX %s' % name)
+            with metrics.span('db.copy', table=table) as span:
+                src = CsvColumnFilter(f, csv_columns) if csv_columns is not None else f
+                sql = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)".format(
+                    table=table, columns=', '.join(columns))
+                logger.debug("sql: %s", sql)
+                cur.copy_expert(sql, src, size=1024 * 1024)
+                rows = cur.rowcount
+                span.add('rows', rows)
+                span.add('bytes', f.tell())
+            elapsed = time.time() - start
+            for name, indexdef in indexes:
+                logger.info("create index %s", name)
+                cur.execute(indexdef)
+        total = time.time() - start
+        if indexes:
+            restored = set(name for name, _ in get_secondary_indexes(mgr, table))
+            missing = [name for name, _ in indexes if name not in restored]
+            if missing:
+                logger.error("indexes of %s not restored: %s", table, ', '.join(missing))
+        logger.info("loaded %d rows into %s in %.1fs (%.0f rows/s)%s",
+                    rows, table, elapsed, rows / elapsed if elapsed > 0 else 0,
+                    ", indexes rebuilt in %.1fs" % (total - elapsed) if indexes else "")
+        return rows
+    except (psycopg2.Error, OSError) as err:
+        logger.error('loading %s into %s failed: %s', filename, table, str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def copy_csv_files(jobs, rebuild_indexes=False, **kwargs):
+    """
+    run copy_csv for each job concurrently, one connection per job.  a job is
+    a dict of copy_csv arguments (filename, table, columns, csv_columns).
+    returns the rows loaded per job, None for a failed one.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+        futures = [executor.submit(copy_csv, rebuild_indexes=rebuild_indexes,
+                                   **dict(job, **kwargs)) for job in jobs]
+        results = [f.result() for f in futures]
+    elapsed = time.time() - start
+    rows = sum(r for r in results if r)
+    logger.info("loaded %d rows in %.1fs (%.0f rows/s)",
+                rows, elapsed, rows / elapsed if elapsed > 0 else 0)
+    return results
+
+
+def get_invalid_indexes(mgr, names):
+    """return those of the named indexes left invalid by a failed concurrent build"""
+    sql = """
+        SELECT  C.relname
+        FROM    pg_index AS I
+                JOIN pg_class AS C ON C.oid = I.indexrelid
+        WHERE   C.relname = ANY(%s) AND NOT I.indisvalid
+    """
+    with mgr.db_conn.cursor() as cur:
+        cur.execute(sql, (list(names),))
+        return [r[0] for r in cur.fetchall()]
+
+
+def create_indexes(**kwargs):
+    """
+    create the indexes of index_def on the checklist tables with CREATE
+    INDEX CONCURRENTLY, so reports keep being written while they are built.
+    an index left invalid by an earlier, interrupted build is dropped and
+    built again.  returns a list of (name, status, seconds) with status
+    'created', 'exists' or 'failed', or None if the database is unreachable.
+    """
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        invalid = get_invalid_indexes(mgr, [name for name, _ in index_def])
+        results = []
+        for name, sql in index_def:
+            start = time.time()
+            try:
+                # the connection is in autocommit mode, concurrent builds
+                # cannot run inside a transaction
+                with mgr.db_conn.cursor() as cur:
+                    if name in invalid:
+                        logger.warning("index %s is invalid, building it again", name)
+                        cur.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+                    else:
+                        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+                        if cur.fetchone()[0]:
+                            results.append((name, 'exists', 0.0))
+                            continue
+                    logger.info("create index %s", name)
+                    logger.debug("sql: %s", sql)
+                    with metrics.span('db.create_index', index=name):
+                        cur.execute(sql)
+                results.append((name, 'created', time.time() - start))
+            except psycopg2.Error as err:
+                logger.error('creating index %s failed: %s', name, str(err).strip())
+                results.append((name, 'failed', time.time() - start))
+        return results
+    except psycopg2.Error as err:
+        logger.error('creating indexes failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+GUIDE_LAYOUT_SQL = """
+        SELECT	ST.id AS step_id, TK.id AS task_id, AC.id AS action_id, TK.type
+        FROM	(
+                    SELECT  id
+                    FROM    guide
+                    WHERE   id = {guide_id}
+                )	AS GD
+                JOIN step AS ST ON ST.guide_id = GD.id
+                JOIN (
+                    SELECT  id, step_id, type
+                    FROM    task
+                    WHERE   is_analytics = True
+                ) AS TK ON TK.step_id = ST.id
+                JOIN task_action AS AC ON AC.task_id = TK.id
+        ORDER BY TK.step_id, TK.id, AC.id -- This should not be changed for AI model
+"""
+
+
+def get_guide_layout(guide_id, **kwargs):
+    """
+    return the ordered list of (step_id, task_id, action_id, type) rows that
+    make up the feature columns of a guide's model.
+    """
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        rows = mgr.get_all_rows(GUIDE_LAYOUT_SQL.format(guide_id=int(guide_id)))
+        return [tuple(r) for r in rows] if rows else []
+    except psycopg2.Error as err:
+        logger.error('selecting table failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
 def get_guide_fields(guide_id, **kwargs):
+    layout = get_guide_layout(guide_id, **kwargs)
+    if layout is None:
+        return None
+    x = dict()
+    for r in layout:
+        x[str(r[0]) + '_' + str(r[1]) + '_' + str(r[2])] = 0
+    x['result'] = 0
+    return x
+
+
+def _report_filter(guide_id, min_report_id=None, labeled=True, unscored=False, report_ids=None):
+    """the WHERE clause selecting the reports of a guide from report"""
+    report_filter = "guide_id = {guide_id}".format(guide_id=int(guide_id))
+    if labeled:
+        report_filter += " AND result IS NOT NULL"
+    if min_report_id is not None:
+        report_filter += " AND id > %d" % int(min_report_id)
+    if report_ids is not None:
+        report_filter += " AND id = ANY('{%s}'::integer[])" % ','.join(
+            str(int(i)) for i in report_ids)
+    if unscored:
+        report_filter += " AND NOT EXISTS (SELECT 1 FROM report_prediction AS RP" \
+                         " WHERE RP.report_id = report.id)"
+    return report_filter
+
+
+MATRIX_REPORTS_SQL = """
+            SELECT  id, result
+            FROM    report
+            WHERE   {report_filter}
+            ORDER BY id{limit_sql}
+"""
+
+# joined on the action alone: the planner treats step, task and action as
+# independent and would expect almost no rows, picking a nested loop.  the
+# step and task are checked by get_feature_matrix instead
+MATRIX_VALUES_SQL = """
+            SELECT  RR.report_id, RR.step_id, RR.task_id, RR.action_id
+                    , COALESCE(CASE WHEN TP.TYPE = 'RADIO' OR TP.TYPE = 'CHECK'
+                      THEN ( CASE WHEN RR.result = 'true' THEN 1 ELSE 0 END )
+                      ELSE CAST(RR.result AS FLOAT) END, 0) AS action_value
+            FROM    report_result AS RR
+                    JOIN (
+                        SELECT	id
+                        FROM	report
+                        WHERE	{report_filter}
+                    ) AS RE ON RR.report_id = RE.id
+                    JOIN ( {layout_sql} ) AS TP
+                         ON  RR.action_id = TP.action_id
+"""
+
+
+def get_feature_matrix(guide_id, min_report_id=None, labeled=True, unscored=False,
+                       limit=None, report_ids=None, chunksize=10000, **kwargs):
+    """
+    Stream the report values of a guide into a dense float32 matrix.
+
+    Returns a tuple (layout, report_ids, features, labels): the ordered guide
+    layout (see get_guide_layout), the sorted ids of the selected reports, a
+    float32 matrix with one row per report and one column per layout entry,
+    and the float32 vector of report results.  The matrix is allocated once
+    and filled from a server-side cursor chunksize rows at a time, so peak
+    memory is roughly the size of the final matrix.
+
+    If min_report_id is given only reports with a greater id are read.  With
+    labeled=False reports without a result are included and get a NaN label;
+    unscored=True keeps only reports that have no row in report_prediction;
+    limit caps the number of reports read, lowest ids first; report_ids
+    keeps only the reports with these ids.
+    """
+    import numpy as np
+
+    guide_id = int(guide_id)
     mgr = DBManager()
     try:
         mgr.connect(**kwargs)
-        with mgr.db_conn.cursor() as cur:
-            sql = """
+        rows = mgr.get_all_rows(GUIDE_LAYOUT_SQL.format(guide_id=guide_id))
+        layout = [tuple(r) for r in rows] if rows else []
+
+        # task_action ids are unique, so they index the column directly
+        step_ids = np.array([r[0] for r in layout], dtype=np.int64)
+        task_ids = np.array([r[1] for r in layout], dtype=np.int64)
+        action_ids = np.array([r[2] for r in layout], dtype=np.int64)
+        col_index = np.full(action_ids.max() + 1 if len(layout) else 1, -1, dtype=np.int64)
+        col_index[action_ids] = np.arange(len(layout))
+
+        report_filter = _report_filter(guide_id, min_report_id, labeled, unscored, report_ids)
+        limit_sql = " LIMIT %d" % int(limit) if limit is not None else ""
+        rows = mgr.get_all_rows("SELECT count(*) FROM (SELECT id FROM report WHERE %s ORDER BY id%s) AS RE"
+                                % (report_filter, limit_sql))
+        n_reports = rows[0][0] if rows else 0
+
+        report_ids = np.empty(n_reports, dtype=np.int64)
+        labels = np.empty(n_reports, dtype=np.float32)
+        features = np.zeros((n_reports, len(layout)), dtype=np.float32)
+
+        sql = MATRIX_REPORTS_SQL.format(report_filter=report_filter, limit_sql=limit_sql)
+        n = 0
+        for chunk in mgr.iter_chunks(sql, chunksize):
+            # guard against reports inserted after the count was taken.
+            # a missing result becomes NaN
+            chunk = np.array(chunk[:n_reports - n], dtype=np.float64).reshape(-1, 2)
+            report_ids[n:n + len(chunk)] = chunk[:, 0]
+            labels[n:n + len(chunk)] = chunk[:, 1]
+            n += len(chunk)
+        report_ids, labels, features = report_ids[:n], labels[:n], features[:n]
+        if n and (limit is not None or unscored):
+            # only the reports read above
+            report_filter = "guide_id = {guide_id} AND id BETWEEN {lo} AND {hi}".format(
+                guide_id=guide_id, lo=report_ids[0], hi=report_ids[-1])
+
+        sql = MATRIX_VALUES_SQL.format(report_filter=report_filter,
+                                       layout_sql=GUIDE_LAYOUT_SQL.format(guide_id=guide_id))
+        for chunk in mgr.iter_chunks(sql, chunksize):
+            chunk = np.array(chunk, dtype=np.float64).reshape(-1, 5)
+            rids = chunk[:, 0].astype(np.int64)
+            cols = col_index[chunk[:, 3].astype(np.int64)]
+            pos = np.searchsorted(report_ids, rids)
+            pos[pos >= n] = 0
+            found = (report_ids[pos] == rids) & (step_ids[cols] == chunk[:, 1]) \
+                & (task_ids[cols] == chunk[:, 2])
+            features[pos[found], cols[found]] = chunk[found, 4]
+        return layout, report_ids, features, labels
+    except psycopg2.Error as err:
+        logger.error('selecting feature matrix failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+PIVOT_SQL = """
+    WITH TP AS MATERIALIZED (
+        SELECT  row_number() OVER (ORDER BY L.step_id, L.task_id, L.action_id) AS pos, L.*
+        FROM    ( {layout_sql} ) AS L
+    )
+    SELECT  report.id, COALESCE(report.result::float8, 'NaN')
+            , ARRAY(
+                SELECT  COALESCE(CASE
+                        WHEN RR.step_id <> TP.step_id OR RR.task_id <> TP.task_id THEN 0
+                        WHEN TP.TYPE = 'RADIO' OR TP.TYPE = 'CHECK'
+                        THEN ( CASE WHEN RR.result = 'true' THEN 1 ELSE 0 END )
+                        ELSE CAST(RR.result AS FLOAT) END, 0)::float8
+                FROM    TP LEFT JOIN report_result AS RR
+                        ON RR.report_id = report.id AND RR.action_id = TP.action_id
+                ORDER BY TP.pos)
+    FROM    report
+    WHERE   {report_filter}
+    ORDER BY report.id{limit_sql}
+"""
+
+
+def get_pivoted_feature_matrix(guide_id, min_report_id=None, labeled=True, unscored=False,
+                               limit=None, **kwargs):
+    """
+    like get_feature_matrix, but the reports are pivoted by the database:
+    each report comes back as one row holding a float8[] of its values in
+    layout order, sent with binary COPY and decoded straight into the
+    matrix (see spa.pg_binary).  this sends about 12 bytes per value
+    instead of a row per value.  each report's array is built from its
+    results alone through the report_id index, so nothing larger than one
+    report is sorted.  like get_feature_matrix the results are joined on
+    the action, a result recorded under another step or task counts as 0.
+
+    if a report holds more than one result for a field the arrays do not
+    match the layout; the guide is then read with get_feature_matrix.
+    """
+    from spa.pg_binary import FloatArrayRows
+
+    guide_id = int(guide_id)
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        rows = mgr.get_all_rows(GUIDE_LAYOUT_SQL.format(guide_id=guide_id))
+        layout = [tuple(r) for r in rows] if rows else []
+        if not layout:
+            # get_feature_matrix takes its own connection, give this one back first
+            mgr.disconnect()
+            return get_feature_matrix(guide_id, min_report_id=min_report_id, labeled=labeled,
+                                      unscored=unscored, limit=limit, **kwargs)
+
+        sql = PIVOT_SQL.format(
+            layout_sql=GUIDE_LAYOUT_SQL.format(guide_id=guide_id),
+            report_filter=_report_filter(guide_id, min_report_id, labeled, unscored),
+            limit_sql=" LIMIT %d" % int(limit) if limit is not None else "")
+        target = FloatArrayRows(len(layout))
+        with mgr.db_conn.cursor() as cur, \
+                metrics.span('db.copy', query='pivot', guide_id=guide_id) as span:
+            logger.debug("sql: %s", sql)
+            cur.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT binary)" % sql, target,
+                            size=1024 * 1024)
+            span.add('bytes', target.bytes)
+        try:
+            report_ids, labels, features = target.finish()
+        except ValueError as e:
+            logger.warning("cannot pivot the reports of guide %s in the database (%s), "
+                           "reading them row by row", guide_id, e)
+            mgr.disconnect()
+            return get_feature_matrix(guide_id, min_report_id=min_report_id, labeled=labeled,
+                                      unscored=unscored, limit=limit, **kwargs)
+        return layout, report_ids, features, labels
+    except psycopg2.Error as err:
+        logger.error('selecting feature matrix failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+REPORT_VALUES_SQL = """
+        SELECT  RR.report_id, RR.step_id, RR.task_id, RR.action_id
+                , CASE WHEN TP.TYPE = 'RADIO' OR TP.TYPE = 'CHECK' 
+                THEN ( CASE WHEN RR.result = 'true' THEN 1 ELSE 0 END )
+                ELSE CAST(RR.result AS FLOAT) END AS action_value
+        FROM    report_result AS RR 
+                LEFT OUTER JOIN ( 
+                    SELECT	id
+                    FROM	report
+                    WHERE	guide_id = {guide_id}
+                ) AS RE ON RR.report_id = RE.id
+                LEFT OUTER JOIN ( 
                     SELECT	ST.id AS step_id, TK.id AS task_id, AC.id AS action_id, TK.type
                     FROM	(
                                 SELECT  id
@@ -185,59 +825,279 @@ def get_guide_fields(guide_id, **kwargs):
                                 WHERE   is_analytics = True
                             ) AS TK ON TK.step_id = ST.id
                             JOIN task_action AS AC ON AC.task_id = TK.id
-                    ORDER BY TK.step_id, TK.id, AC.id -- This should not be changed for AI model
-                    ;
-            """.format(guide_id=guide_id)
-            rows = mgr.get_all_rows(sql)
-            x = dict()
-            if rows:
-                for r in rows:
-                    x[str(r[0]) + '_' + str(r[1]) + '_' + str(r[2])] = 0
-            x['result'] = 0
-            return x
+                ) AS TP ON  RR.step_id = TP.step_id
+                        AND RR.task_id = TP.task_id
+                        AND RR.action_id = TP.action_id
+        WHERE RE.ID is not NULL
+        ;	
+"""
+
+
+def create_feature_vectors(**kwargs):
+    """create the optional report_feature_vector table and its triggers"""
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        with mgr.transaction(), mgr.db_conn.cursor() as cur:
+            for sql in feature_vector_schema_def:
+                logger.debug("execute sql:\n%s", sql)
+                cur.execute(sql)
+        return True
+    except psycopg2.Error as err:
+        logger.error('creating feature vectors failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def drop_feature_vectors(**kwargs):
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        mgr.modify('drop trigger if exists feature_vector_insert on report_result')
+        mgr.modify('drop trigger if exists feature_vector_update on report_result')
+        mgr.modify('drop trigger if exists feature_vector_delete on report_result')
+        mgr.modify('drop trigger if exists feature_vector_report_update on report')
+        mgr.modify('drop function if exists report_feature_vector_mark()')
+        mgr.modify('drop function if exists report_feature_vector_mark_report()')
+        mgr.modify('drop table if exists report_feature_vector')
+        mgr.modify('drop table if exists report_feature_vector_dirty')
     except psycopg2.Error as err:
-        logger.error('selecting table failed: %s' % str(err).strip())
+        logger.error('dropping feature vectors failed: %s', str(err).strip())
     finally:
         if mgr:
             mgr.disconnect()
 
 
+def has_feature_vectors(mgr):
+    rows = mgr.get_all_rows("SELECT to_regclass('report_feature_vector') IS NOT NULL")
+    return bool(rows and rows[0][0])
+
+
+# the values of a report in layout order, packed as big-endian float4.  of
+# two results for one field the later one counts, like everywhere the
+# results are joined on the action alone
+VECTOR_REFRESH_SQL = """
+    WITH TP AS MATERIALIZED (
+        SELECT  row_number() OVER (ORDER BY L.step_id, L.task_id, L.action_id) AS pos, L.*
+        FROM    ( {layout_sql} ) AS L
+    ), DIRTY AS (
+        DELETE FROM report_feature_vector_dirty AS D
+        USING   report
+        WHERE   D.report_id = report.id AND report.guide_id = {guide_id}
+        RETURNING D.report_id
+    )
+    INSERT INTO report_feature_vector (report_id, guide_id, layout_version, features, result)
+    SELECT  report.id, report.guide_id, '{layout_version}'
+            , COALESCE((
+                SELECT  string_agg(float4send(V.value), ''::bytea ORDER BY V.pos)
+                FROM    (
+                    SELECT  DISTINCT ON (TP.pos) TP.pos, COALESCE(CASE
+                            WHEN RR.step_id <> TP.step_id OR RR.task_id <> TP.task_id THEN 0
+                            WHEN TP.TYPE = 'RADIO' OR TP.TYPE = 'CHECK'
+                            THEN ( CASE WHEN RR.result = 'true' THEN 1 ELSE 0 END )
+                            ELSE CAST(RR.result AS FLOAT) END, 0)::float4 AS value
+                    FROM    TP LEFT JOIN report_result AS RR
+                            ON RR.report_id = report.id AND RR.action_id = TP.action_id
+                    ORDER BY TP.pos, RR.id DESC
+                ) AS V), ''::bytea)
+            , report.result
+    FROM    report
+    WHERE   report.guide_id = {guide_id}
+            AND (report.id IN (SELECT report_id FROM DIRTY)
+                 OR NOT EXISTS (SELECT 1 FROM report_feature_vector AS FV
+                                WHERE FV.report_id = report.id))
+    ON CONFLICT (report_id) DO UPDATE
+    SET     guide_id = EXCLUDED.guide_id, layout_version = EXCLUDED.layout_version,
+            features = EXCLUDED.features, result = EXCLUDED.result, update_time = now()
+"""
+
+
+def refresh_feature_vectors(guide_id, rebuild=False, **kwargs):
+    """
+    bring the report_feature_vector rows of a guide up to date: compute the
+    vectors of its new reports and of the reports marked by the triggers,
+    and remove those of reports that left the guide.  when the guide's
+    analytics fields changed, or with rebuild, all of its vectors are
+    computed again.  returns a summary with the layout_version and the
+    numbers of vectors updated and deleted, or None on failure.
+    """
+    from spa.feature_cache import layout_fingerprint
+
+    guide_id = int(guide_id)
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        layout = [tuple(r) for r in mgr.get_all_rows(
+            GUIDE_LAYOUT_SQL.format(guide_id=guide_id)) or []]
+        version = layout_fingerprint(layout)
+        summary = {'guide_id': guide_id, 'layout_version': version, 'rebuilt': False,
+                   'updated': 0, 'deleted': 0}
+        with mgr.transaction(), mgr.db_conn.cursor() as cur, \
+                metrics.span('db.refresh_vectors', guide_id=guide_id) as span:
+            # one refresh of a guide at a time
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('report_feature_vector'), %s)",
+                        (guide_id,))
+            if not rebuild:
+                cur.execute("SELECT 1 FROM report_feature_vector "
+                            "WHERE guide_id = %s AND layout_version <> %s LIMIT 1",
+                            (guide_id, version))
+                rebuild = cur.fetchone() is not None
+                if rebuild:
+                    logger.info("field layout of guide %s changed, rebuilding its feature "
+                                "vectors", guide_id)
+            if rebuild:
+                cur.execute("DELETE FROM report_feature_vector WHERE guide_id = %s", (guide_id,))
+                summary['rebuilt'] = True
+            else:
+                cur.execute("""
+                    DELETE FROM report_feature_vector AS FV
+                    WHERE   FV.guide_id = %s AND NOT EXISTS (
+                                SELECT 1 FROM report
+                                WHERE report.id = FV.report_id AND report.guide_id = FV.guide_id)
+                """, (guide_id,))
+                summary['deleted'] = cur.rowcount
+            cur.execute("""
+                DELETE FROM report_feature_vector_dirty AS D
+                WHERE   NOT EXISTS (SELECT 1 FROM report WHERE report.id = D.report_id)
+            """)
+            sql = VECTOR_REFRESH_SQL.format(layout_sql=GUIDE_LAYOUT_SQL.format(guide_id=guide_id),
+                                            guide_id=guide_id, layout_version=version)
+            logger.debug("sql: %s", sql)
+            cur.execute(sql)
+            summary['updated'] = cur.rowcount
+            span.add('rows', cur.rowcount)
+        logger.info("guide %s: %d feature vectors updated, %d deleted%s",
+                    guide_id, summary['updated'], summary['deleted'],
+                    ' (rebuilt)' if summary['rebuilt'] else '')
+        return summary
+    except psycopg2.Error as err:
+        logger.error('refreshing feature vectors failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def _vector_filter(guide_id, layout_version, min_report_id=None, labeled=True, unscored=False,
+                   report_ids=None):
+    """the WHERE clause selecting the current vectors of a guide from report_feature_vector"""
+    vector_filter = "FV.guide_id = %d AND FV.layout_version = '%s'" % (
+        int(guide_id), layout_version)
+    if labeled:
+        vector_filter += " AND FV.result IS NOT NULL"
+    if min_report_id is not None:
+        vector_filter += " AND FV.report_id > %d" % int(min_report_id)
+    if report_ids is not None:
+        vector_filter += " AND FV.report_id = ANY('{%s}'::integer[])" % ','.join(
+            str(int(i)) for i in report_ids)
+    if unscored:
+        vector_filter += " AND NOT EXISTS (SELECT 1 FROM report_prediction AS RP" \
+                         " WHERE RP.report_id = FV.report_id)"
+    return vector_filter
+
+
+VECTOR_READ_SQL = """
+            SELECT  FV.report_id, COALESCE(FV.result::float8, 'NaN'), FV.features
+            FROM    report_feature_vector AS FV
+            WHERE   {vector_filter}
+            ORDER BY FV.report_id{limit_sql}
+"""
+
+
+def get_vector_matrix(guide_id, min_report_id=None, labeled=True, unscored=False,
+                      limit=None, report_ids=None, refresh=True, **kwargs):
+    """
+    like get_feature_matrix, but read from the precomputed vectors of
+    report_feature_vector, refreshed first unless refresh is False.  the
+    packed vectors are sent with binary COPY and decoded straight into the
+    matrix.  without the report_feature_vector table this falls back to
+    get_feature_matrix.
+    """
+    from spa.feature_cache import layout_fingerprint
+    from spa.pg_binary import PackedVectorRows
+
+    guide_id = int(guide_id)
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        if not has_feature_vectors(mgr):
+            logger.info("no report_feature_vector table, reading the results of guide %s",
+                        guide_id)
+            # get_feature_matrix takes its own connection, give this one back first
+            mgr.disconnect()
+            return get_feature_matrix(guide_id, min_report_id=min_report_id, labeled=labeled,
+                                      unscored=unscored, limit=limit, report_ids=report_ids,
+                                      **kwargs)
+        if refresh:
+            # likewise for the refresh
+            mgr.disconnect()
+            if refresh_feature_vectors(guide_id, **kwargs) is None:
+                return None
+            mgr.connect(**kwargs)
+        layout = [tuple(r) for r in mgr.get_all_rows(
+            GUIDE_LAYOUT_SQL.format(guide_id=guide_id)) or []]
+
+        sql = VECTOR_READ_SQL.format(
+            vector_filter=_vector_filter(guide_id, layout_fingerprint(layout),
+                                         min_report_id, labeled, unscored, report_ids),
+            limit_sql=" LIMIT %d" % int(limit) if limit is not None else "")
+        target = PackedVectorRows(len(layout))
+        with mgr.db_conn.cursor() as cur, \
+                metrics.span('db.copy', query='vectors', guide_id=guide_id) as span:
+            logger.debug("sql: %s", sql)
+            cur.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT binary)" % sql, target,
+                            size=1024 * 1024)
+            span.add('bytes', target.bytes)
+        try:
+            report_ids, labels, features = target.finish()
+        except ValueError as e:
+            logger.error('reading feature vectors of guide %s failed: %s', guide_id, e)
+            return None
+        return layout, report_ids, features, labels
+    except psycopg2.Error as err:
+        logger.error('selecting feature vectors failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def fetch_feature_matrices(guide_ids, fetch=None, workers=None, **kwargs):
+    """
+    read the feature matrices of many guides, several at a time, and yield
+    (guide_id, matrix) in the order of guide_ids.  fetch is the function
+    reading one guide, get_feature_matrix by default; a guide it cannot
+    read yields None.  each read runs on its own thread and pooled
+    connection.  at most workers guides are read at once and no more than
+    workers matrices wait for the caller, which bounds both the load on the
+    database and the memory held.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    fetch = fetch or get_feature_matrix
+    guide_ids = list(guide_ids)
+    workers = max(1, min(workers or Defaults.DB_FETCH_WORKERS, len(guide_ids) or 1))
+    remaining = iter(guide_ids)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='spa_fetch') as executor:
+        def submit(n):
+            for guide_id in itertools.islice(remaining, n):
+                pending.append((guide_id, executor.submit(fetch, guide_id, **kwargs)))
+
+        submit(workers)
+        while pending:
+            guide_id, future = pending.popleft()
+            matrix = future.result()
+            # the next guide is read while the caller works on this one
+            submit(1)
+            yield guide_id, matrix
+
+
 def get_report_values(guide_id, **kwargs):
     mgr = DBManager()
     try:
         mgr.connect(**kwargs)
         with mgr.db_conn.cursor() as cur:
-            sql = """
-                SELECT  RR.report_id, RR.step_id, RR.task_id, RR.action_id
-                        , CASE WHEN TP.TYPE = 'RADIO' OR TP.TYPE = 'CHECK' 
-                        THEN ( CASE WHEN RR.result = 'true' THEN 1 ELSE 0 END )
-                        ELSE CAST(RR.result AS FLOAT) END AS action_value
-                FROM    report_result AS RR 
-                        LEFT OUTER JOIN ( 
-                            SELECT	id
-                            FROM	report
-                            WHERE	guide_id = {guide_id}
-                        ) AS RE ON RR.report_id = RE.id
-                        LEFT OUTER JOIN ( 
-                            SELECT	ST.id AS step_id, TK.id AS task_id, AC.id AS action_id, TK.type
-                            FROM	(
-                                        SELECT  id
-                                        FROM    guide
-                                        WHERE   id = {guide_id}
-                                    )	AS GD
-                                    JOIN step AS ST ON ST.guide_id = GD.id
-                                    JOIN (
-                                        SELECT  id, step_id, type
-                                        FROM    task
-                                        WHERE   is_analytics = True
-                                    ) AS TK ON TK.step_id = ST.id
-                                    JOIN task_action AS AC ON AC.task_id = TK.id
-                        ) AS TP ON  RR.step_id = TP.step_id
-                                AND RR.task_id = TP.task_id
-                                AND RR.action_id = TP.action_id
-                WHERE RE.ID is not NULL
-                ;	
-            """.format(guide_id=guide_id)
+            sql = REPORT_VALUES_SQL.format(guide_id=guide_id)
             rows = mgr.get_all_rows(sql)
             x = dict()
             if rows:
@@ -250,7 +1110,7 @@ def get_report_values(guide_id, **kwargs):
                     x[r[0]][key] = r[4]
             return x
     except psycopg2.Error as err:
-        logger.error('creating table failed: %s' % str(err).strip())
+        logger.error('creating table failed: %s', str(err).strip())
     finally:
         if mgr:
             mgr.disconnect()
@@ -274,52 +1134,307 @@ def get_report_results(guide_id, **kwargs):
                     x[r[0]] = int(r[1])
             return x
     except psycopg2.Error as err:
-        logger.error('creating table failed: %s' % str(err).strip())
+        logger.error('creating table failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def save_predictions(report_ids, predictions, **kwargs):
+    """
+    upsert predictions into report_prediction: the rows are streamed with
+    COPY into a temporary staging table and merged with one
+    INSERT ... ON CONFLICT statement.
+    """
+    import numpy as np
+
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        buf = io.BytesIO()
+        np.savetxt(buf, np.column_stack([report_ids, predictions]), fmt=['%d', '%.9g'],
+                   delimiter='\t')
+        buf.seek(0)
+        with mgr.transaction(), mgr.db_conn.cursor() as cur, \
+                metrics.span('db.copy', table='report_prediction') as span:
+            span.add('rows', len(report_ids))
+            span.add('bytes', len(buf.getvalue()))
+            cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS report_prediction_stage
+                    (LIKE report_prediction) ON COMMIT DELETE ROWS
+            """)
+            cur.copy_expert("COPY report_prediction_stage (report_id, prediction) FROM STDIN", buf)
+            cur.execute("""
+                INSERT INTO report_prediction (report_id, prediction)
+                SELECT  report_id, prediction
+                FROM    report_prediction_stage
+                ON CONFLICT (report_id) DO UPDATE SET prediction = EXCLUDED.prediction
+            """)
+        return len(report_ids)
+    except psycopg2.Error as err:
+        logger.error('saving predictions failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+REPORT_IDS_SQL = """
+            SELECT  id
+            FROM    report
+            WHERE   guide_id = {guide_id}{labeled}
+            ORDER BY id
+"""
+
+
+def get_report_ids(guide_id, labeled=True, chunksize=10000, **kwargs):
+    """return the sorted ids of a guide's reports, only those with a result if labeled"""
+    import numpy as np
+
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        sql = REPORT_IDS_SQL.format(guide_id=int(guide_id),
+                                    labeled=" AND result IS NOT NULL" if labeled else "")
+        chunks = [np.array(chunk, dtype=np.int64).reshape(-1)
+                  for chunk in mgr.iter_chunks(sql, chunksize)]
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+    except psycopg2.Error as err:
+        logger.error('selecting reports failed: %s', str(err).strip())
     finally:
         if mgr:
             mgr.disconnect()
 
 
+GUIDE_IDS_SQL = """
+            SELECT  DISTINCT ST.guide_id
+            FROM    step AS ST
+                    JOIN task AS TK ON TK.step_id = ST.id
+            WHERE   TK.is_analytics = True
+            ORDER BY ST.guide_id
+            ;
+"""
+
+
+def get_guide_ids(**kwargs):
+    """return the ids of the guides that have at least one analytics task"""
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        rows = mgr.get_all_rows(GUIDE_IDS_SQL)
+        return [r[0] for r in rows] if rows else []
+    except psycopg2.Error as err:
+        logger.error('selecting guides failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def _explain_queries(mgr, guide_id):
+    """the queries run for a guide, as (name, sql) pairs"""
+    from spa.feature_cache import layout_fingerprint
+
+    layout_sql = GUIDE_LAYOUT_SQL.format(guide_id=guide_id)
+    queries = [
+        ('guide_ids', GUIDE_IDS_SQL),
+        ('layout', layout_sql),
+        ('report_ids', REPORT_IDS_SQL.format(guide_id=guide_id,
+                                             labeled=" AND result IS NOT NULL")),
+        ('report_values', REPORT_VALUES_SQL.format(guide_id=guide_id)),
+        ('matrix_reports', MATRIX_REPORTS_SQL.format(
+            report_filter=_report_filter(guide_id), limit_sql="")),
+        ('matrix_values', MATRIX_VALUES_SQL.format(
+            report_filter=_report_filter(guide_id), layout_sql=layout_sql)),
+        ('unscored_reports', MATRIX_REPORTS_SQL.format(
+            report_filter=_report_filter(guide_id, labeled=False, unscored=True),
+            limit_sql="")),
+        ('pivot', PIVOT_SQL.format(layout_sql=layout_sql,
+                                   report_filter=_report_filter(guide_id), limit_sql="")),
+    ]
+    if has_feature_vectors(mgr):
+        version = layout_fingerprint([tuple(r) for r in mgr.get_all_rows(layout_sql) or []])
+        queries += [
+            ('vector_refresh', VECTOR_REFRESH_SQL.format(
+                layout_sql=layout_sql, guide_id=guide_id, layout_version=version)),
+            ('vector_read', VECTOR_READ_SQL.format(
+                vector_filter=_vector_filter(guide_id, version), limit_sql="")),
+        ]
+    return queries
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        for node in _plan_nodes(child):
+            yield node
+
+
+def _explain(mgr, sql, options):
+    """run EXPLAIN of sql in a transaction that is rolled back"""
+    autocommit = mgr.db_conn.autocommit
+    mgr.db_conn.autocommit = False
+    try:
+        with mgr.db_conn.cursor() as cur:
+            logger.debug("sql: %s", sql)
+            cur.execute("EXPLAIN (%s) %s" % (options, sql))
+            return cur.fetchall()
+    finally:
+        mgr.db_conn.rollback()
+        mgr.db_conn.autocommit = autocommit
+
+
+def explain_queries(guide_id, min_rows=10000, plans=False, **kwargs):
+    """
+    run EXPLAIN (ANALYZE, BUFFERS) on each query read or written for a
+    guide and flag the sequential scans of tables holding at least min_rows
+    rows.  the queries really run, each in a transaction that is rolled
+    back, so the vector refresh leaves nothing behind.  returns a list of
+    dicts: name, seconds (execution time), planning_seconds, rows,
+    shared_hit and shared_read (buffers), seq_scans (the flagged tables)
+    and, with plans, plan (the text plan), or None on failure.
+    """
+    guide_id = int(guide_id)
+    mgr = DBManager()
+    try:
+        mgr.connect(**kwargs)
+        results = []
+        for name, sql in _explain_queries(mgr, guide_id):
+            sql = sql.strip().rstrip(';')
+            explain = _explain(mgr, sql, 'ANALYZE, BUFFERS, FORMAT JSON')[0][0][0]
+            top = explain['Plan']
+            scans = sorted(set(node['Relation Name'] for node in _plan_nodes(top)
+                               if node['Node Type'] == 'Seq Scan'))
+            large = []
+            if scans:
+                with mgr.db_conn.cursor() as cur:
+                    cur.execute("SELECT relname FROM pg_class "
+                                "WHERE relname = ANY(%s) AND relkind IN ('r', 'p') "
+                                "AND reltuples >= %s ORDER BY relname", (scans, min_rows))
+                    large = [r[0] for r in cur.fetchall()]
+            if large:
+                logger.warning("%s scans %s sequentially", name, ', '.join(large))
+            result = {'name': name, 'seconds': explain['Execution Time'] / 1000.0,
+                      'planning_seconds': explain['Planning Time'] / 1000.0,
+                      'rows': top.get('Actual Rows', 0),
+                      'shared_hit': top.get('Shared Hit Blocks', 0),
+                      'shared_read': top.get('Shared Read Blocks', 0),
+                      'seq_scans': large}
+            if plans:
+                result['plan'] = '\n'.join(r[0] for r in _explain(mgr, sql, 'ANALYZE, BUFFERS'))
+            results.append(result)
+        return results
+    except psycopg2.Error as err:
+        logger.error('explaining queries failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def format_explain(results, plans=False):
+    lines = ['%-18s %10s %10s %10s %10s  %s' % ('query', 'ms', 'rows', 'hit', 'read',
+                                              'seq scans')]
+    for r in results:
+        lines.append('%-18s %10.1f %10d %10d %10d  %s' % (
+            r['name'], r['seconds'] * 1000, r['rows'], r['shared_hit'], r['shared_read'],
+            ', '.join(r['seq_scans']) or '-'))
+        if plans and 'plan' in r:
+            lines.append(r['plan'])
+            lines.append('')
+    flagged = len([r for r in results if r['seq_scans']])
+    lines.append('%d of %d queries scan large tables sequentially' % (flagged, len(results)))
+    return '\n'.join(lines)
+
+
 class DBManager(object):
 
     def __init__(self):
         self.uri = None
+        self.key = None
+        self.pool = None
         self.db_conn = None
 
     def connect(self, dbhost, dbport, dbname, dbuser, dbpass=None, **kwargs):
-        logger.debug("connect: %s@%s:%s/%s" % (dbuser, dbhost, dbport, dbname))
+        logger.debug("connect: %s@%s:%s/%s", dbuser, dbhost, dbport, dbname)
         self.uri = mkdbstr(dbhost, dbport, dbname, dbuser)
-        self.db_conn = connect(dbhost, dbport, dbname, dbuser, dbpass)
+        self.key = dbpool.pool_key(dbhost, dbport, dbname, dbuser, dbpass)
+        shared = _active_sessions().get(self.key)
+        if shared is not None:
+            self.db_conn = shared.db_conn
+        else:
+            self.pool = dbpool.get_pool(dbhost, dbport, dbname, dbuser, dbpass)
+            self.db_conn = self.pool.getconn()
         self.db_conn.set_isolation_level(
             psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
 
     def disconnect(self):
         if self.db_conn is not None:
-            logger.debug("disconnect from %s" % self.uri)
-            self.db_conn.close()
+            logger.debug("disconnect from %s", self.uri)
+            if self.pool is not None:
+                self.pool.putconn(self.db_conn)
+                self.pool = None
             self.db_conn = None
 
     def modify(self, sql):
         try:
-            with self.db_conn.cursor() as cur:
-                logger.debug("sql: %s" % sql)
+            with self.db_conn.cursor() as cur, metrics.span('db.query', query=sql) as span:
+                logger.debug("sql: %s", sql)
                 cur.execute(sql)
+                span.add('rows', max(cur.rowcount, 0))
         except psycopg2.Error as err:
-            logger.error("query '%s' failed: %s" % (sql, err))
+            logger.error("query '%s' failed: %s", sql, err)
 
     def modify_values(self, sql, iter, chunksize=1000):
         try:
-            with self.db_conn.cursor() as cur:
-                logger.debug("sql: %s" % sql)
+            with self.db_conn.cursor() as cur, metrics.span('db.query', query=sql):
+                logger.debug("sql: %s", sql)
                 psycopg2.extras.execute_values(cur, sql, iter, page_size=chunksize)
         except psycopg2.Error as err:
-            logger.error("query '%s' failed: %s" % ('', err))
+            logger.error("query '%s' failed: %s", '', err)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """run the enclosed statements in one transaction, even in autocommit mode"""
+        autocommit = self.db_conn.autocommit
+        self.db_conn.autocommit = False
+        try:
+            yield self
+            self.db_conn.commit()
+        except BaseException:
+            self.db_conn.rollback()
+            raise
+        finally:
+            self.db_conn.autocommit = autocommit
+
+    def iter_chunks(self, sql, chunksize=10000, name='spa_stream'):
+        """
+        yield the result of a query as lists of at most chunksize rows,
+        using a server-side cursor so the full result never sits in memory.
+        """
+        autocommit = self.db_conn.autocommit
+        # named cursors only live inside a transaction
+        self.db_conn.autocommit = False
+        try:
+            with self.db_conn.cursor(name=name) as cur, \
+                    metrics.span('db.stream', query=sql) as span:
+                cur.itersize = chunksize
+                logger.debug("sql: %s", sql)
+                cur.execute(sql)
+                while True:
+                    rows = cur.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    span.add('rows', len(rows))
+                    yield rows
+        finally:
+            self.db_conn.rollback()
+            self.db_conn.autocommit = autocommit
 
     def get_all_rows(self, sql):
         try:
-            with self.db_conn.cursor() as cur:
-                logger.debug("sql: %s" % sql)
+            with self.db_conn.cursor() as cur, metrics.span('db.query', query=sql) as span:
+                logger.debug("sql: %s", sql)
                 cur.execute(sql)
-                return cur.fetchall()
+                rows = cur.fetchall()
+                span.add('rows', len(rows))
+                return rows
         except psycopg2.Error as err:
-            logger.error("query '%s' failed: %s" % (sql, err))
+            logger.error("query '%s' failed: %s", sql, err)
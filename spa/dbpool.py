@@ -0,0 +1,237 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Database connection pooling.
+
+Every DBManager borrows its connection from a process-wide pool keyed by the
+connection parameters, so repeated helper calls reuse a handful of open
+connections instead of paying a TCP and authentication handshake each time.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from spa import metrics
+from spa.defaults import Defaults
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of connections to a single database.
+
+    maxconn - most connections open at once, idle or in use
+    max_idle - idle connections older than this many seconds are closed
+    check_after - connections idle for longer than this many seconds are
+                  checked with a trivial query before being handed out
+    wait_timeout - seconds to wait for a free connection before giving up
+    """
+
+    def __init__(self, connect_fn, maxconn=None, max_idle=None,
+                 check_after=None, wait_timeout=None, name=None):
+        self.connect_fn = connect_fn
+        self.name = name
+        self.maxconn = maxconn or Defaults.DB_POOL_SIZE
+        self.max_idle = Defaults.DB_POOL_MAX_IDLE if max_idle is None else max_idle
+        self.check_after = Defaults.DB_POOL_CHECK_AFTER if check_after is None else check_after
+        self.wait_timeout = Defaults.DB_POOL_WAIT_TIMEOUT if wait_timeout is None else wait_timeout
+        self.cond = threading.Condition()
+        self.idle = []  # (conn, time returned), most recently used last
+        self.in_use = 0
+        self.pid = os.getpid()
+        self.opened = 0
+        self.connect_seconds = 0.0
+        self.checkouts = 0
+        self.waits = 0
+
+    def getconn(self):
+        with self.cond:
+            self._check_pid()
+            deadline = time.time() + self.wait_timeout
+            while True:
+                self._evict_idle()
+                if self.idle:
+                    conn, returned = self.idle.pop()
+                    self.in_use += 1
+                    break
+                if self.in_use < self.maxconn:
+                    conn, returned = None, None
+                    self.in_use += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise psycopg2.pool.PoolError(
+                        "no connection available in pool %s after %ss" %
+                        (self.name, self.wait_timeout))
+                self.waits += 1
+                metrics.count('db.pool_waits')
+                self.cond.wait(remaining)
+            self.checkouts += 1
+        try:
+            if conn is not None and time.time() - returned > self.check_after \
+                    and not self._is_healthy(conn):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except BaseException:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        with self.cond:
+            if self._check_pid():
+                return
+            self.in_use -= 1
+            if not discard and not conn.closed:
+                try:
+                    status = conn.info.transaction_status
+                    if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                        discard = True
+                    elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            if discard or conn.closed:
+                self._close(conn)
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def closeall(self):
+        with self.cond:
+            if self._check_pid():
+                return
+            for conn, _ in self.idle:
+                self._close(conn)
+            self.idle = []
+
+    def stats(self):
+        with self.cond:
+            return {'name': self.name, 'opened': self.opened,
+                    'connect_seconds': self.connect_seconds,
+                    'checkouts': self.checkouts, 'waits': self.waits,
+                    'idle': len(self.idle), 'in_use': self.in_use}
+
+    def _open(self):
+        start = time.time()
+        conn = self.connect_fn()
+        elapsed = time.time() - start
+        with self.cond:
+            self.opened += 1
+            self.connect_seconds += elapsed
+        metrics.count('db.connections_opened')
+        metrics.count('db.connect_seconds', elapsed)
+        logger.debug("opened connection to %s in %.3fs", self.name, elapsed)
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except psycopg2.Error as err:
+            logger.debug("dropping stale connection to %s: %s", self.name, str(err).strip())
+            return False
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.max_idle
+        keep = []
+        for conn, returned in self.idle:
+            if returned < cutoff or conn.closed:
+                self._close(conn)
+            else:
+                keep.append((conn, returned))
+        self.idle = keep
+
+    def _check_pid(self):
+        """
+        a forked child must not touch the sockets it inherited from its
+        parent, so it starts over with an empty pool.  returns True if the
+        pool was reset.
+        """
+        if self.pid == os.getpid():
+            return False
+        self.pid = os.getpid()
+        self.idle = []
+        self.in_use = 0
+        self.opened = self.checkouts = self.waits = 0
+        self.connect_seconds = 0.0
+        return True
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def pool_key(dbhost, dbport, dbname, dbuser, dbpass=None, **kwargs):
+    return (dbhost, str(dbport), dbname, dbuser, dbpass)
+
+
+def get_pool(dbhost, dbport, dbname, dbuser, dbpass=None, **kwargs):
+    """return the shared pool for the given connection parameters"""
+    from spa.dbmanager import connect, mkdbstr
+
+    key = pool_key(dbhost, dbport, dbname, dbuser, dbpass)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                lambda: connect(dbhost, dbport, dbname, dbuser, dbpass),
+                name=mkdbstr(dbhost, dbport, dbname, dbuser))
+            _pools[key] = pool
+        return pool
+
+
+def close_pools(dbname=None):
+    """close idle pooled connections, optionally only those to dbname"""
+    with _pools_lock:
+        pools = [p for k, p in _pools.items() if dbname is None or k[2] == dbname]
+    for pool in pools:
+        pool.closeall()
+
+
+def pool_stats():
+    """return the combined statistics of every pool in this process"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    totals = {'pools': len(pools), 'opened': 0, 'connect_seconds': 0.0,
+              'checkouts': 0, 'waits': 0}
+    for pool in pools:
+        s = pool.stats()
+        for n in ['opened', 'connect_seconds', 'checkouts', 'waits']:
+            totals[n] += s[n]
+    return totals
+
+
+def log_pool_stats(total_seconds):
+    """log how much of total_seconds went into opening connections"""
+    s = pool_stats()
+    share = 100.0 * s['connect_seconds'] / total_seconds if total_seconds > 0 else 0.0
+    logger.info("db connections: %d opened in %.3fs (%.2f%% of %.3fs), "
+                "%d checkouts, %d waits", s['opened'], s['connect_seconds'], share,
+                total_seconds, s['checkouts'], s['waits'])
+    return s
+
+
+atexit.register(close_pools)
@@ -10,3 +10,26 @@ class Defaults(object):
     DB_NAME = 'ai_test'
     DB_USER = os.getenv('USER', 'zinnotech')
     DB_ADMUSER = 'zinnotech'
+    # database connection pool
+    DB_POOL_SIZE = 8
+    DB_POOL_MAX_IDLE = 300  # seconds
+    DB_POOL_CHECK_AFTER = 30  # seconds
+    DB_POOL_WAIT_TIMEOUT = 30  # seconds
+    # guides read at once, each on its own pooled connection
+    DB_FETCH_WORKERS = 4
+    # feature cache
+    FEATURE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+    # prediction history retention
+    HISTORY_RETAIN_MONTHS = 12
+    # REST port of TF Serving
+    SERVING_REST_PORT = 8501
+    # model versions kept per guide after publishing a new one
+    MODEL_RETAIN_VERSIONS = 3
+    # batch scoring
+    PREDICT_BATCH_SIZE = 50000
+    PREDICT_ENGINES = ['auto', 'numpy', 'tensorflow']
+    # predictions of distinct report vectors kept by predict, about 250 bytes each
+    PREDICTION_CACHE_ENTRIES = 200000
+    # live scoring sessions of reports being filled in
+    LIVE_SESSION_TTL = 1800  # seconds
+    LIVE_MAX_SESSIONS = 10000
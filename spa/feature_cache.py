@@ -0,0 +1,216 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Incremental on-disk cache of guide feature matrices.
+
+Each guide is stored in its own directory as memory-mappable .npy files
+(report_ids, features, labels) plus a JSON manifest recording the layout
+fingerprint, the number of rows and the highest report id read so far:
+
+    <cache_dir>/guide_<id>/manifest.json
+    <cache_dir>/guide_<id>/report_ids.npy
+    <cache_dir>/guide_<id>/features.npy
+    <cache_dir>/guide_<id>/labels.npy
+
+On each run only reports with an id above the high-water mark are fetched
+and appended in place.  A change to the guide's field layout invalidates the
+guide's entry.  Results edited on reports that are already cached, or reports
+labelled after newer reports were cached, are not picked up; use invalidate()
+to force a full reload.
+
+The total size of the cache is bounded, and the least recently used guides
+are evicted first.
+"""
+
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+import spa.dbmanager as dbm
+from spa.defaults import Defaults
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+ARRAYS = ['report_ids', 'features', 'labels']
+
+
+def layout_fingerprint(layout):
+    """a stable hash of an ordered guide layout (see dbm.get_guide_layout)"""
+    h = hashlib.sha1()
+    for r in layout:
+        h.update(('%s_%s_%s_%s;' % tuple(r)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def append_rows(path, rows):
+    """
+    append rows to the .npy file at path, creating it if necessary.  the data
+    is written first and the header rewritten in place afterwards, so an
+    interrupted append leaves the previous contents readable.
+    """
+    rows = np.ascontiguousarray(rows)
+    if not os.path.exists(path):
+        np.save(path, rows)
+        return
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            read_header, write_header = (np.lib.format.read_array_header_1_0,
+                                         np.lib.format.write_array_header_1_0)
+        else:
+            read_header, write_header = (np.lib.format.read_array_header_2_0,
+                                         np.lib.format.write_array_header_2_0)
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        if fortran_order or dtype != rows.dtype or shape[1:] != rows.shape[1:]:
+            raise ValueError("cannot append %s %s to %s %s in %s" %
+                             (rows.dtype, rows.shape, dtype, shape, path))
+        header = io.BytesIO()
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (shape[0] + rows.shape[0],) + shape[1:]})
+        header = header.getvalue()
+        if len(header) != offset:
+            # the header outgrew its padding, rewrite the whole file
+            f.close()
+            merged = np.concatenate([np.load(path, mmap_mode='r'), rows])
+            np.save(path + '.tmp.npy', merged)
+            os.replace(path + '.tmp.npy', path)
+            return
+        f.seek(offset + int(np.prod(shape)) * dtype.itemsize)
+        f.truncate()
+        f.write(rows.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(0)
+        f.write(header)
+
+
+class FeatureCache(object):
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_bytes = Defaults.FEATURE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    def guide_dir(self, guide_id):
+        return os.path.join(self.cache_dir, 'guide_%s' % guide_id)
+
+    def get_feature_matrix(self, guide_id, **dbinfo):
+        """
+        return (layout, report_ids, features, labels) like
+        dbm.get_feature_matrix, bringing the cached copy up to date first.
+        the arrays are read-only memory maps of the cache files.
+        """
+        guide_id = int(guide_id)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, 'guide_%s.lock' % guide_id), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            result = self._update(guide_id, **dbinfo)
+        if result is not None:
+            self.evict(keep=guide_id)
+        return result
+
+    def invalidate(self, guide_id):
+        path = self.guide_dir(guide_id)
+        if os.path.isdir(path):
+            logger.info("invalidating cached features of guide %s", guide_id)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def evict(self, keep=None):
+        """remove the least recently used guides until the cache fits max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            manifest = self._read_manifest_at(os.path.join(self.cache_dir, name))
+            if manifest is not None:
+                entries.append(manifest)
+        total = sum(m['bytes'] for m in entries)
+        for m in sorted(entries, key=lambda m: m['last_access']):
+            if total <= self.max_bytes:
+                break
+            if m['guide_id'] == keep:
+                continue
+            with open(os.path.join(self.cache_dir, 'guide_%s.lock' % m['guide_id']), 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # being updated by another process
+                logger.info("evicting cached features of guide %s (%d bytes)",
+                            m['guide_id'], m['bytes'])
+                shutil.rmtree(self.guide_dir(m['guide_id']), ignore_errors=True)
+                total -= m['bytes']
+        if total > self.max_bytes:
+            logger.warning("feature cache %s holds %d bytes, over its limit of %d",
+                           self.cache_dir, total, self.max_bytes)
+
+    def _update(self, guide_id, **dbinfo):
+        path = self.guide_dir(guide_id)
+        manifest = self._read_manifest_at(path)
+        if manifest is not None and not self._is_consistent(path, manifest):
+            logger.warning("cached features of guide %s are inconsistent", guide_id)
+            self.invalidate(guide_id)
+            manifest = None
+
+        high_water = manifest['high_water'] if manifest else None
+        matrix = dbm.get_feature_matrix(guide_id, min_report_id=high_water, **dbinfo)
+        if matrix is None:
+            return None
+        layout, report_ids, features, labels = matrix
+        fingerprint = layout_fingerprint(layout)
+        if manifest is not None and manifest['fingerprint'] != fingerprint:
+            logger.info("field layout of guide %s changed", guide_id)
+            self.invalidate(guide_id)
+            manifest = None
+            matrix = dbm.get_feature_matrix(guide_id, **dbinfo)
+            if matrix is None:
+                return None
+            layout, report_ids, features, labels = matrix
+            fingerprint = layout_fingerprint(layout)
+
+        if manifest is None:
+            os.makedirs(path, exist_ok=True)
+            manifest = {'guide_id': guide_id, 'fingerprint': fingerprint, 'rows': 0,
+                        'columns': len(layout), 'high_water': None}
+        if len(report_ids):
+            for name, rows in zip(ARRAYS, [report_ids, features, labels]):
+                append_rows(os.path.join(path, name + '.npy'), rows)
+            manifest['rows'] += len(report_ids)
+            manifest['high_water'] = int(report_ids[-1])
+        logger.info("guide %s: %d cached reports, %d new",
+                    guide_id, manifest['rows'] - len(report_ids), len(report_ids))
+        manifest['last_access'] = time.time()
+        manifest['bytes'] = sum(os.path.getsize(os.path.join(path, n + '.npy'))
+                                for n in ARRAYS if os.path.exists(os.path.join(path, n + '.npy')))
+        self._write_manifest(path, manifest)
+
+        if manifest['rows'] == 0:
+            return layout, report_ids, features, labels
+        arrays = [np.load(os.path.join(path, n + '.npy'), mmap_mode='r') for n in ARRAYS]
+        return tuple([layout] + arrays)
+
+    def _is_consistent(self, path, manifest):
+        for name in ARRAYS:
+            fn = os.path.join(path, name + '.npy')
+            if not os.path.exists(fn):
+                return manifest['rows'] == 0
+            if len(np.load(fn, mmap_mode='r')) != manifest['rows']:
+                return False
+        return True
+
+    def _read_manifest_at(self, path):
+        try:
+            with open(os.path.join(path, MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_manifest(self, path, manifest):
+        fn = os.path.join(path, MANIFEST)
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(fn + '.tmp', fn)
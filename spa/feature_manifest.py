@@ -0,0 +1,151 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Feature manifest and vectorizer for serving-time input.
+
+make_model saves a manifest next to each model in assets.extra/features.json
+with everything needed to build the model's input without a database: the
+ordered feature columns (step_id, task_id, action_id and task type) and the
+mean and scale of the StandardScaler fitted in training.
+
+Vectorizer turns report_result rows into model-ready batches.  Task action
+ids are unique, so an integer array indexed by action_id maps each row to its
+column; building a batch is O(rows) with no SQL and no string keys.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from spa.feature_cache import layout_fingerprint
+from spa.model_store import CLIP, FEATURES_FILE
+
+MANIFEST_VERSION = 1
+BOOLEAN_TYPES = ('RADIO', 'CHECK')
+
+
+class FeatureManifest(object):
+
+    def __init__(self, guide_id, layout, mean, scale, clip=CLIP):
+        self.guide_id = int(guide_id)
+        self.layout = [tuple(r) for r in layout]
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.clip = clip
+        if len(self.mean) != len(self.layout) or len(self.scale) != len(self.layout):
+            raise ValueError("scaler of %d columns does not match a layout of %d" %
+                             (len(self.mean), len(self.layout)))
+
+    @property
+    def fingerprint(self):
+        return layout_fingerprint(self.layout)
+
+    def save(self, path):
+        fn = os.path.join(path, FEATURES_FILE)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'w') as f:
+            json.dump({'manifest_version': MANIFEST_VERSION, 'guide_id': self.guide_id,
+                       'fingerprint': self.fingerprint,
+                       'columns': [{'step_id': s, 'task_id': t, 'action_id': a, 'type': tp}
+                                   for s, t, a, tp in self.layout],
+                       'mean': self.mean.tolist(), 'scale': self.scale.tolist(),
+                       'clip': self.clip}, f)
+        return fn
+
+    @classmethod
+    def load(cls, path):
+        """load the manifest saved next to the model at path"""
+        with open(os.path.join(path, FEATURES_FILE)) as f:
+            d = json.load(f)
+        if d.get('manifest_version') != MANIFEST_VERSION:
+            raise ValueError("unsupported feature manifest version %s in %s" %
+                             (d.get('manifest_version'), path))
+        layout = [(c['step_id'], c['task_id'], c['action_id'], c['type']) for c in d['columns']]
+        manifest = cls(d['guide_id'], layout, d['mean'], d['scale'], d['clip'])
+        if manifest.fingerprint != d['fingerprint']:
+            raise ValueError("feature manifest in %s is corrupt" % path)
+        return manifest
+
+
+class Vectorizer(object):
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        layout = manifest.layout
+        self.columns = len(layout)
+        self.step_ids = np.array([r[0] for r in layout], dtype=np.int64)
+        self.task_ids = np.array([r[1] for r in layout], dtype=np.int64)
+        self.is_boolean = np.array([r[3] in BOOLEAN_TYPES for r in layout], dtype=bool)
+        action_ids = np.array([r[2] for r in layout], dtype=np.int64)
+        self.col_index = np.full(action_ids.max() + 1 if len(layout) else 1, -1, dtype=np.int64)
+        self.col_index[action_ids] = np.arange(len(layout))
+
+    @classmethod
+    def load(cls, path):
+        return cls(FeatureManifest.load(path))
+
+    def vectorize(self, rows, scale=True):
+        """
+        build the input of the model from report_result rows of
+        (report_id, step_id, task_id, action_id, result).  rows whose action is
+        not a feature column of the guide are ignored, and missing values are
+        0 like in training.  returns (report_ids, features) with report_ids
+        sorted; the features are scaled and clipped unless scale is False.
+        """
+        if not len(rows):
+            return np.empty(0, dtype=np.int64), np.empty((0, self.columns), dtype=np.float32)
+        rows = list(rows)
+        ids = np.array([r[:4] for r in rows], dtype=np.int64).reshape(-1, 4)
+        results = np.array([r[4] for r in rows], dtype=object)
+
+        actions = ids[:, 3]
+        cols = np.full(len(rows), -1, dtype=np.int64)
+        known = (actions >= 0) & (actions < len(self.col_index))
+        cols[known] = self.col_index[actions[known]]
+        keep = cols >= 0
+        keep[keep] = (self.step_ids[cols[keep]] == ids[keep, 1]) & \
+                     (self.task_ids[cols[keep]] == ids[keep, 2])
+
+        boolean = np.zeros(len(rows), dtype=bool)
+        boolean[keep] = self.is_boolean[cols[keep]]
+        numeric = keep & ~boolean
+        values = np.zeros(len(rows), dtype=np.float32)
+        values[boolean] = results[boolean] == 'true'
+        numbers = results[numeric]
+        numbers[np.equal(numbers, None)] = 0
+        values[numeric] = numbers.astype(np.float64)
+
+        report_ids, rows_report = np.unique(ids[:, 0], return_inverse=True)
+        features = np.zeros((len(report_ids), self.columns), dtype=np.float32)
+        features[rows_report[keep], cols[keep]] = values[keep]
+        if scale:
+            self.transform(features)
+        return report_ids, features
+
+    def vectorize_report(self, results, scale=True):
+        """the input row of a single report from (step_id, task_id, action_id, result) tuples"""
+        features = np.zeros((1, self.columns), dtype=np.float32)
+        if len(results):
+            _, features = self.vectorize([(0,) + tuple(r) for r in results], scale=False)
+        return (self.transform(features) if scale else features)[0]
+
+    def column_value(self, step_id, task_id, action_id, result):
+        """
+        the (column, raw value) of one report_result row, or None if its
+        action is not a feature column of the guide
+        """
+        if not 0 <= action_id < len(self.col_index):
+            return None
+        col = int(self.col_index[action_id])
+        if col < 0 or self.step_ids[col] != step_id or self.task_ids[col] != task_id:
+            return None
+        if self.is_boolean[col]:
+            return col, float(result == 'true')
+        return col, 0.0 if result is None else float(result)
+
+    def transform(self, features):
+        """scale and clip raw features in place, like in training"""
+        features -= self.manifest.mean
+        features /= self.manifest.scale
+        np.clip(features, -self.manifest.clip, self.manifest.clip, out=features)
+        return features
@@ -0,0 +1,191 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+tf.data input pipeline for training on guides too large to hold in memory.
+
+The reports of a guide are read in chunks from a source: ArraySource slices
+arrays that may be memory maps of the feature cache files, DBSource reads
+each chunk of report ids from the database through the connection pool.
+Chunks are loaded by parallel map calls, scaled and clipped in TensorFlow,
+split into rows, shuffled through a bounded buffer, batched and prefetched,
+so reading the next batches overlaps with training on the current one.
+
+Every fifth report (by id) is held out for validation, so the split is
+stable across epochs and runs without materializing an index.
+"""
+
+import logging
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+import spa.dbmanager as dbm
+from spa.feature_cache import layout_fingerprint
+from spa.model_store import CLIP
+
+logger = logging.getLogger(__name__)
+
+VALIDATION_MOD = 5
+
+
+class ArraySource(object):
+    """
+    chunks of in-memory or memory-mapped (report_ids, features, labels)
+    arrays.  features may also be a spa.packed_features.PackedFeatures,
+    unpacked one chunk at a time.
+    """
+
+    def __init__(self, report_ids, features, labels, chunk_rows):
+        self.report_ids = report_ids
+        self.features = features
+        self.labels = labels
+        self.chunk_rows = chunk_rows
+        self.columns = features.shape[1]
+        self.n_chunks = (len(report_ids) + chunk_rows - 1) // chunk_rows
+        self.last_report_id = report_ids[-1] if len(report_ids) else None
+
+    def read(self, i):
+        s = slice(i * self.chunk_rows, (i + 1) * self.chunk_rows)
+        return (np.asarray(self.report_ids[s]), np.asarray(self.features[s], dtype=np.float32),
+                np.asarray(self.labels[s], dtype=np.float32))
+
+
+class DBSource(object):
+    """chunks of a guide's labeled reports read from the database"""
+
+    def __init__(self, guide_id, chunk_rows, **dbinfo):
+        self.guide_id = guide_id
+        self.chunk_rows = chunk_rows
+        self.dbinfo = dbinfo
+        self.layout = dbm.get_guide_layout(guide_id, **dbinfo)
+        report_ids = dbm.get_report_ids(guide_id, **dbinfo)
+        if self.layout is None or report_ids is None:
+            raise ValueError("cannot read the reports of guide %s" % guide_id)
+        self.fingerprint = layout_fingerprint(self.layout)
+        self.columns = len(self.layout)
+        # each chunk starts after the last report id of the previous one
+        self.starts = report_ids[::chunk_rows] - 1
+        self.n_chunks = len(self.starts)
+        self.last_report_id = report_ids[-1] if len(report_ids) else None
+
+    def read(self, i):
+        matrix = dbm.get_feature_matrix(self.guide_id, min_report_id=self.starts[i],
+                                        limit=self.chunk_rows, **self.dbinfo)
+        if matrix is None:
+            raise IOError("cannot read reports of guide %s" % self.guide_id)
+        layout, report_ids, features, labels = matrix
+        if layout_fingerprint(layout) != self.fingerprint:
+            raise ValueError("field layout of guide %s changed while training" % self.guide_id)
+        return report_ids, features, labels
+
+
+def is_validation(report_ids):
+    return report_ids % VALIDATION_MOD == 0
+
+
+def fit_scaler(source):
+    """
+    one pass over the training rows of a source.  returns the mean and scale
+    of a StandardScaler fitted on them and the count of each label.
+    """
+    n, total, squares = 0, 0.0, 0.0
+    counts = np.zeros(2, dtype=np.int64)
+    for i in range(source.n_chunks):
+        report_ids, features, labels = source.read(i)
+        train = ~is_validation(report_ids)
+        x = features[train].astype(np.float64)
+        n += len(x)
+        total = total + x.sum(axis=0)
+        squares = squares + (x * x).sum(axis=0)
+        counts += np.bincount(labels[train].astype(np.int64), minlength=2)[:2]
+    if not n:
+        raise ValueError("no training reports")
+    mean = total / n
+    std = np.sqrt(np.maximum(squares / n - mean * mean, 0))
+    # like StandardScaler, constant columns are left unscaled
+    scale = np.where(std > 0, std, 1.0)
+    return mean.astype(np.float32), scale.astype(np.float32), counts
+
+
+def make_dataset(source, mean, scale, batch_size, training=True, shuffle_buffer=100000,
+                 cache=None):
+    """
+    return a dataset of (features, labels) batches from the training or
+    validation reports of a source.  cache, if not None, caches the scaled
+    chunks in memory ('') or in files with that prefix after the first epoch.
+    """
+    columns = source.columns
+    mean = tf.constant(mean, dtype=tf.float32)
+    scale = tf.constant(scale, dtype=tf.float32)
+
+    def load(i):
+        report_ids, features, labels = source.read(int(i))
+        keep = is_validation(report_ids) != training
+        return features[keep], labels[keep]
+
+    def load_chunk(i):
+        features, labels = tf.numpy_function(load, [i], [tf.float32, tf.float32])
+        features.set_shape([None, columns])
+        labels.set_shape([None])
+        return features, labels
+
+    def transform(features, labels):
+        return tf.clip_by_value((features - mean) / scale, -CLIP, CLIP), labels
+
+    ds = tf.data.Dataset.range(source.n_chunks)
+    if training and cache is None:
+        ds = ds.shuffle(source.n_chunks, reshuffle_each_iteration=True)
+    ds = ds.map(load_chunk, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=not training)
+    ds = ds.map(transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if cache is not None:
+        ds = ds.cache(cache)
+    ds = ds.unbatch()
+    if training:
+        ds = ds.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    return ds.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def initial_bias(counts):
+    """the output bias predicting the base rate of the labels, or None"""
+    zero, one = counts
+    if not zero or not one:
+        return None
+    return np.log([one / zero])
+
+
+def class_weights(counts):
+    """weights that make both labels contribute equally to the loss, or None"""
+    zero, one = counts
+    if not zero or not one:
+        return None
+    total = zero + one
+    return {0: total / (2.0 * zero), 1: total / (2.0 * one)}
+
+
+class StepsPerSecond(keras.callbacks.Callback):
+    """measures the training steps per second of each epoch, without validation"""
+
+    def __init__(self):
+        super(StepsPerSecond, self).__init__()
+        self.rates = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.start = self.last = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self.last = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.last > self.start:
+            self.rates.append(self.steps / (self.last - self.start))
+            logger.debug("epoch %d: %.1f steps/s", epoch + 1, self.rates[-1])
+
+    @property
+    def steps_per_second(self):
+        # the first epoch includes tracing and filling the pipeline
+        rates = self.rates[1:] or self.rates
+        return float(np.median(rates)) if rates else None
@@ -0,0 +1,198 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Incremental scoring of a report while it is being filled in.
+
+The first layer of a guide model is Dense, so before its activation it is
+linear in the scaled input: pre = bias + z @ kernel.  Each feature is
+scaled and clipped on its own, so when one action of the report changes
+from raw value a to b only one term moves:
+
+    pre += (clip((b - mean) / scale) - clip((a - mean) / scale)) * kernel[col]
+
+LiveScorer keeps z and pre for every open session and applies that O(hidden
+units) update per changed action, then runs only the (small) layers after
+the first one.  A full pass recomputes pre every REFRESH_UPDATES updates so
+float rounding cannot pile up.
+
+Sessions idle for more than ttl seconds are evicted, and the least recently
+used ones once there are more than max_sessions.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from spa.defaults import Defaults
+from spa.feature_manifest import Vectorizer
+from spa.numpy_model import ACTIVATIONS, NumpyModel
+
+logger = logging.getLogger(__name__)
+
+REFRESH_UPDATES = 1000
+
+# the same functions, cheaper on the few values of one report: the boolean
+# masks numpy_model's batch sigmoid uses to avoid overflow cost more than
+# the layer itself, and tanh never overflows
+_ACTIVATIONS = dict(ACTIVATIONS, sigmoid=lambda x: 0.5 * (1 + np.tanh(0.5 * x)))
+
+
+class SessionError(KeyError):
+    pass
+
+
+class _Session(object):
+    __slots__ = ['z', 'pre', 'updates', 'used']
+
+    def __init__(self, z, pre, used):
+        self.z = z
+        self.pre = pre
+        self.updates = 0
+        self.used = used
+
+
+class LiveScorer(object):
+    """
+    scores open reports of one guide model.  a session is keyed by any
+    hashable id, e.g. the report being filled in.  safe to share between
+    threads.
+    """
+
+    def __init__(self, model, vectorizer=None, ttl=None, max_sessions=None):
+        self.model = model
+        self.vectorizer = vectorizer
+        self.ttl = Defaults.LIVE_SESSION_TTL if ttl is None else ttl
+        self.max_sessions = Defaults.LIVE_MAX_SESSIONS if max_sessions is None \
+            else max_sessions
+        self.kernel = np.ascontiguousarray(model.kernels[0], dtype=np.float32)
+        self.bias = np.asarray(model.biases[0], dtype=np.float32)
+        self.activation = _ACTIVATIONS[model.activations[0]]
+        # python floats, scaling one value with numpy scalars is slower
+        self.mean = model.mean.tolist()
+        self.scale = model.scale.tolist()
+        self.clip = float(model.clip)
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """a scorer of the model saved at path, from its exported weights and manifest"""
+        if not NumpyModel.exists(path):
+            raise ValueError("%s has no exported weights" % path)
+        return cls(NumpyModel.load(path), Vectorizer.load(path), **kwargs)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def start(self, session_id, features=None):
+        """
+        open a session from the raw feature vector of a report, by default
+        all zeros like an empty report, and return its prediction
+        """
+        columns = len(self.kernel)
+        raw = np.zeros(columns, dtype=np.float32) if features is None \
+            else np.asarray(features, dtype=np.float32).reshape(columns)
+        z = self._scale(raw)
+        session = _Session(z, self.bias + z @ self.kernel, time.monotonic())
+        with self.lock:
+            self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            self._evict(session.used)
+            return self._head(session)
+
+    def start_report(self, session_id, results=()):
+        """open a session from (step_id, task_id, action_id, result) rows"""
+        return self.start(session_id, self.vectorizer.vectorize_report(results, scale=False))
+
+    def update(self, session_id, changes):
+        """
+        apply changes, an iterable of (column, raw value), to a session and
+        return its new prediction
+        """
+        with self.lock:
+            session = self._get(session_id)
+            for col, value in changes:
+                z = self._scale_one(col, value)
+                delta = z - session.z[col]
+                if delta:
+                    session.pre += delta * self.kernel[col]
+                    session.z[col] = z
+                session.updates += 1
+            if session.updates >= REFRESH_UPDATES:
+                session.pre = self.bias + session.z @ self.kernel
+                session.updates = 0
+            return self._head(session)
+
+    def set(self, session_id, column, value):
+        """set one column of a session to a raw value and return its new prediction"""
+        return self.update(session_id, [(column, value)])
+
+    def set_result(self, session_id, step_id, task_id, action_id, result):
+        """
+        apply one report_result row to a session and return its new
+        prediction.  an action that is not a column of the model leaves the
+        prediction unchanged.
+        """
+        change = self.vectorizer.column_value(step_id, task_id, action_id, result)
+        return self.update(session_id, [change] if change is not None else [])
+
+    def score(self, session_id):
+        with self.lock:
+            return self._head(self._get(session_id))
+
+    def end(self, session_id):
+        """close a session, returns False if it was not open"""
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def evict(self):
+        """drop the expired sessions, returns how many were dropped"""
+        with self.lock:
+            return self._evict(time.monotonic())
+
+    def _get(self, session_id):
+        session = self.sessions.get(session_id)
+        now = time.monotonic()
+        if session is None or (self.ttl and now - session.used > self.ttl):
+            self.sessions.pop(session_id, None)
+            raise SessionError(session_id)
+        session.used = now
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def _evict(self, now):
+        evicted = 0
+        # the sessions are kept in the order they were last used
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and \
+                    not (self.ttl and now - session.used > self.ttl):
+                break
+            del self.sessions[session_id]
+            evicted += 1
+        if evicted:
+            self.evictions += evicted
+            logger.debug("evicted %d live scoring sessions", evicted)
+        return evicted
+
+    def _scale(self, raw):
+        model = self.model
+        return np.clip((raw - model.mean) / model.scale, -model.clip, model.clip)
+
+    def _scale_one(self, col, value):
+        z = (float(value) - self.mean[col]) / self.scale[col]
+        return min(max(z, -self.clip), self.clip)
+
+    def _head(self, session):
+        """run the layers after the first one's pre-activation"""
+        x = self.activation(session.pre.copy())
+        model = self.model
+        for kernel, bias, activation in zip(model.kernels[1:], model.biases[1:],
+                                            model.activations[1:]):
+            x = x @ kernel
+            x += bias
+            x = _ACTIVATIONS[activation](x)
+        return float(x[0])
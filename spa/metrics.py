@@ -0,0 +1,211 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Lightweight instrumentation: timing spans, counters and memory.
+
+A span times a named stage and is logged through the spa.metrics logger as
+one JSON object with its seconds, labels, counts, and the current and peak
+resident memory of the process:
+
+    with metrics.span('db.query', query=sql) as s:
+        rows = cur.fetchall()
+        s.add('rows', len(rows))
+
+    stage = metrics.span('model.fit', guide_id=guide_id).start()
+    ...
+    stage.stop()
+
+Counts added to a span are also summed into process-wide counters named
+after the span ('db.query.rows'); count() adds to a counter directly.  The
+totals can be written as a Prometheus textfile, e.g. for the node_exporter
+textfile collector, when the process exits.
+
+Instrumentation is disabled by default.  span() then returns a shared no-op
+object and count() returns at once, so instrumented code pays little more
+than a function call.
+"""
+
+import atexit
+import json
+import logging
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_textfile = None
+_lock = threading.Lock()
+_counters = dict()  # name: total
+_spans = dict()  # name: [calls, seconds, max seconds]
+
+
+def enable(textfile=None):
+    """start recording, and write the totals to textfile at exit if given"""
+    global _enabled, _textfile
+    _enabled = True
+    if textfile and _textfile is None:
+        atexit.register(lambda: write_textfile(_textfile))
+    _textfile = textfile or _textfile
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def configure(options):
+    """enable instrumentation from the --metrics and --metrics-file options"""
+    if getattr(options, 'metrics', False) or getattr(options, 'metrics_file', None):
+        enable(getattr(options, 'metrics_file', None))
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def span(name, **labels):
+    if not _enabled:
+        return NULL_SPAN
+    return Span(name, labels)
+
+
+def rss_bytes():
+    """the current resident memory of the process, or None if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def add(self, name, value=1):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    MAX_LABEL = 120
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counts = dict()
+        self.started = None
+        self.error = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.stop()
+        return False
+
+    def start(self):
+        self.started = time.perf_counter()
+        return self
+
+    def add(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def stop(self):
+        if self.started is None:
+            return
+        seconds = time.perf_counter() - self.started
+        self.started = None
+        with _lock:
+            totals = _spans.setdefault(self.name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            for name, value in self.counts.items():
+                key = '%s.%s' % (self.name, name)
+                _counters[key] = _counters.get(key, 0) + value
+        record = {'span': self.name, 'seconds': round(seconds, 6)}
+        for name, value in self.labels.items():
+            if isinstance(value, str):
+                value = ' '.join(value.split())
+                if len(value) > self.MAX_LABEL:
+                    value = value[:self.MAX_LABEL] + '...'
+            record[name] = value
+        record.update(self.counts)
+        rss = rss_bytes()
+        if rss is not None:
+            record['rss_mb'] = round(rss / 1048576.0, 1)
+        record['peak_rss_mb'] = round(peak_rss_bytes() / 1048576.0, 1)
+        if self.error:
+            record['error'] = self.error
+        logger.info(json.dumps(record, default=str))
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def format_textfile():
+    """the current totals in the Prometheus text exposition format"""
+    with _lock:
+        spans = sorted(_spans.items())
+        counters = sorted(_counters.items())
+    lines = []
+    for metric, kind, i, fmt in [('spa_span_calls_total', 'counter', 0, '%d'),
+                                 ('spa_span_seconds_total', 'counter', 1, '%.6f'),
+                                 ('spa_span_max_seconds', 'gauge', 2, '%.6f')]:
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for name, totals in spans:
+            lines.append(('%s{span="%s"} ' + fmt) % (metric, name, totals[i]))
+    for name, value in counters:
+        metric = 'spa_%s_total' % _metric_name(name)
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %s' % (metric, value))
+    lines.append('# TYPE spa_peak_rss_bytes gauge')
+    lines.append('spa_peak_rss_bytes %d' % peak_rss_bytes())
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    """write the totals to path, replacing it atomically"""
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(format_textfile())
+    os.replace(tmp, path)
@@ -1,48 +1,150 @@
 import tensorflow as tf
 from tensorflow import keras
-from tensorflow.python.keras.layers import Dense, Dropout
+from tensorflow.keras.layers import Dense, Dropout
+
+import os
+import shutil
+import time
 
 import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 
-from copy import deepcopy
-
-import dbm
 import spa.dbmanager as dbm
-
-np.random.seed(3)
-tf.random.set_seed(3)
+from spa import metrics
+from spa import publisher
+from spa.feature_cache import layout_fingerprint
+from spa.feature_manifest import FeatureManifest
+from spa.input_pipeline import (ArraySource, DBSource, StepsPerSecond, class_weights, fit_scaler,
+                                initial_bias, make_dataset)
+from spa.model_store import (CLIP, WEIGHTS_FILE, guide_model_dir, model_versions,
+                             read_preprocess, read_scaler, write_preprocess)
+from spa.numpy_model import check_parity, export_weights
+from spa.packed_features import get_packed_matrix
 
 
 class ModelMaker(object):
-    def __init__(self):
-        pass
+    EPOCHS = 100
+    INCREMENTAL_EPOCHS = 10
+    BATCH_SIZE = 2048
+    CHUNK_ROWS = 50000
+    SHUFFLE_BUFFER = 100000
+
+    def __init__(self, seed=3):
+        if seed is not None:
+            np.random.seed(seed)
+            tf.random.set_seed(seed)
 
-    def make_model(self, guide_id, **dbinfo):
-        field_row = dbm.get_guide_fields(guide_id, **dbinfo)
-        result_dict = dbm.get_report_results(guide_id, **dbinfo)
-        value_dict = dbm.get_report_values(guide_id, **dbinfo)
-        data_array = []
+    def make_model(self, guide_id, model_dir='models', version=None, cache=None,
+                   incremental=False, replay=0.0, streaming=False, dataset_cache=None,
+                   vectors=False, packed=False, retain=None, serving=None, **dbinfo):
+        """
+        build the model of a guide and publish it as
+        <model_dir>/guide_<guide_id>/<version>, by default the version after
+        the latest one saved.  the model is built in a staging directory and
+        only renamed into place once it loads and scores a canary batch (see
+        spa.publisher).  returns the path of the published model, or None if
+        the guide's reports could not be read or the model failed validation.
+
+        cache - an optional spa.feature_cache.FeatureCache to read the
+                guide's features through
+        incremental - fine-tune the latest saved model on the reports that
+                      arrived after it was built instead of training a new
+                      one.  falls back to a full build if there is no
+                      compatible previous model.
+        replay - in incremental mode, also train on a random sample of older
+                 reports, this many times the number of new reports
+        streaming - train from a tf.data pipeline reading the reports in
+                    chunks (see spa.input_pipeline), from the feature cache
+                    if given or else from the database, instead of loading
+                    them all into memory.  ignored in incremental mode.
+        dataset_cache - in streaming mode, cache the scaled chunks after the
+                        first epoch, in memory ('') or in files with this
+                        prefix
+        vectors - read the precomputed vectors of report_feature_vector
+                  (see dbm.get_vector_matrix) instead of the report
+                  results.  ignored with a cache or in streaming mode.
+        packed - hold the features bit-packed (see spa.packed_features) and
+                 train from a tf.data pipeline unpacking them a chunk at a
+                 time.  ignored in incremental mode.
+        retain - versions of the guide kept after publishing [default:
+                 Defaults.MODEL_RETAIN_VERSIONS]
+        serving - an optional spa.serving_client.RestClient, to wait until
+                  TF Serving serves the new version
+        """
+        self.trained = None
+        staged = publisher.stage(model_dir, guide_id)
+        try:
+            built = self._make_model(guide_id, model_dir, staged, cache, incremental, replay,
+                                     streaming, dataset_cache, vectors, packed, **dbinfo)
+        except BaseException:
+            shutil.rmtree(staged, ignore_errors=True)
+            raise
+        if built != staged:
+            # nothing was built, or the latest model has no newer reports
+            shutil.rmtree(staged, ignore_errors=True)
+            return built
+        try:
+            path = publisher.publish(staged, model_dir, guide_id, version=version,
+                                     retain=retain, trained=self.trained)
+        except publisher.PublishError as e:
+            print('not publishing the model of guide {}: {}'.format(guide_id, e))
+            return None
+        if serving is not None:
+            waited = serving.wait_available(guide_id, os.path.basename(path))
+            if waited is None:
+                print('{} is not served yet'.format(path))
+            else:
+                print('{} served {:.1f}s after training ended'.format(
+                    path, time.time() - self.trained))
+        return path
 
-        for r_id in result_dict:
-            result_row = result_dict[r_id]
-            value_row = value_dict[r_id]
+    def _make_model(self, guide_id, model_dir, path, cache, incremental, replay, streaming,
+                    dataset_cache, vectors, packed, **dbinfo):
+        """build the model of a guide into path, see make_model"""
+        start = time.time()
+        guide_dir = guide_model_dir(model_dir, guide_id)
+        versions = model_versions(guide_dir)
+        if (streaming or packed) and not incremental:
+            return self._make_streamed(guide_id, path, cache, dataset_cache, start,
+                                       packed=packed, **dbinfo)
 
-            copy_field_rows = deepcopy(field_row)
-            copy_field_rows['result'] = result_row
-            copy_field_rows.update(value_row)
+        previous = state = None
+        if incremental:
+            previous = os.path.join(guide_dir, str(versions[-1])) if versions else None
+            state = read_preprocess(previous) if previous else None
 
-            data_array.append([i for i in copy_field_rows.values()])
+        stage = metrics.span('model.fetch', guide_id=guide_id).start()
+        # the cache reads only the new reports from the database and maps
+        # the others, the fine tuning reads the rows it trains on only
+        if cache is None and state is not None and state.get('last_report_id') is not None:
+            matrix = self._fetch_new(guide_id, state['last_report_id'], replay, vectors,
+                                     **dbinfo)
+            if matrix is not None and layout_fingerprint(matrix[0]) != state['fingerprint']:
+                matrix = self._fetch(guide_id, cache, vectors, **dbinfo)
+        else:
+            matrix = self._fetch(guide_id, cache, vectors, **dbinfo)
+        if matrix is None:
+            stage.stop()
+            print('cannot read the reports of guide %s' % guide_id)
+            return
+        layout, report_ids, features, labels = matrix
+        stage.add('rows', len(report_ids))
+        stage.stop()
+        fingerprint = layout_fingerprint(layout)
 
-        data_np = np.array(data_array)
+        if incremental:
+            if state is not None and state['fingerprint'] == fingerprint \
+                    and read_scaler(previous) is not None:
+                return self._fine_tune(guide_id, previous, state, path, layout, report_ids,
+                                       features, labels, replay, start)
+            print('no compatible previous model of guide %s, building a new one' % guide_id)
 
-        zero, one = np.bincount(list(map(float, data_np[:,-1])))
+        zero, one = np.bincount(labels.astype(np.int64), minlength=2)
         total = zero + one
         print('Examples:\n    Total: {}\n    one: {} ({:.2f}% of total)\n'
               .format(total, one, 100 * one / total))
 
-        cleaned_data = data_np.copy()
         """
         Split the dataset into train, validation, and test sets. 
         [ Validation set ]  
@@ -55,17 +157,12 @@ class ModelMaker(object):
          where over-fitting is a significant concern from the lack of training test_data.
         """
         # Use a utility from sklearn to split and shuffle our dataset.
-        train_data, test_data = train_test_split(cleaned_data, test_size=0.2)
-        train_df, val_data = train_test_split(train_data, test_size=0.2)
-
-        # Form np arrays of labels and features.
-        train_labels = np.array(train_data[:,1])
-        val_labels = np.array(val_data[:,1])
-        test_labels = np.array(test_data[:,1])
-
-        train_features = np.array(train_data)
-        val_features = np.array(val_data)
-        test_features = np.array(test_data)
+        stage = metrics.span('model.split', guide_id=guide_id).start()
+        train_features, test_features, train_labels, test_labels = \
+            train_test_split(features, labels, test_size=0.2)
+        train_features, val_features, train_labels, val_labels = \
+            train_test_split(train_features, train_labels, test_size=0.2)
+        stage.stop()
 
         """
         Normalize the input features using the sklearn StandardScaler. 
@@ -80,13 +177,15 @@ class ModelMaker(object):
         1.Transform(): Method using these calculated parameters apply the transformation to a particular dataset.
         3.Fit_transform(): joins the fit() and transform() method for transformation of dataset.
         """
+        stage = metrics.span('model.scale', guide_id=guide_id).start()
         scaler = StandardScaler()
         train_features = scaler.fit_transform(train_features)
 
         val_features = scaler.transform(val_features)
 
-        train_features = np.clip(train_features, -5, 5)
-        val_features = np.clip(val_features, -5, 5)
+        train_features = np.clip(train_features, -CLIP, CLIP)
+        val_features = np.clip(val_features, -CLIP, CLIP)
+        stage.stop()
 
         # print('Training labels shape:', train_labels.shape)
         # print('Validation labels shape:', val_labels.shape)
@@ -97,46 +196,242 @@ class ModelMaker(object):
         # print('Test features shape:', test_features.shape)
 
         # build the model
-        EPOCHS = 100
-        BATCH_SIZE = 2048
-
         early_stopping = tf.keras.callbacks.EarlyStopping(
             verbose=1,
             patience=10,
-            mode='max',
+            monitor='val_loss',
+            mode='min',
             restore_best_weights=True)
 
-        model = self.get_tf_model(train_features)
+        # The dataset is imbalanced: start the output layer's bias at the
+        # log-odds of the labels, and weight the classes so that both
+        # contribute equally to the loss.
+        model = self.get_tf_model(train_features, output_bias=initial_bias((zero, one)))
         model.summary()
 
-        # These initial guesses are not great.
-        # You know the dataset is imbalanced.
-        # Set the output layer's bias to reflect that
-        initial_bias = np.log([one / zero])
-        model = self.get_tf_model(train_features, output_bias=initial_bias)
-        #print(model.predict(train_features))
+        """
+        Train the model
+        """
+        steps = StepsPerSecond()
+        with metrics.span('model.fit', guide_id=guide_id, rows=len(train_labels)):
+            model.fit(
+                x=train_features,
+                y=train_labels,
+                batch_size=self.BATCH_SIZE,
+                epochs=self.EPOCHS,
+                callbacks=[early_stopping, steps],
+                class_weight=class_weights((zero, one)),
+                validation_data=(val_features, val_labels))
+        self.trained = time.time()
+        print('training ran at {:.1f} steps/s'.format(steps.steps_per_second or 0))
+
+        with metrics.span('model.save', guide_id=guide_id):
+            model.save(filepath=path, overwrite=True, include_optimizer=True,
+                       save_format=None, signatures=None, options=None)
+            FeatureManifest(guide_id, layout, scaler.mean_, scaler.scale_).save(path)
+            self._export_weights(model, path, val_features)
+        seconds = time.time() - start
+        write_preprocess(path, {
+            'guide_id': int(guide_id), 'fingerprint': fingerprint, 'columns': len(layout),
+            'last_report_id': int(report_ids.max()) if len(report_ids) else None,
+            'mode': 'full', 'seconds': seconds, 'full_seconds': seconds,
+            'steps_per_second': steps.steps_per_second})
+        return path
 
-        results = model.evaluate(train_features, train_labels, batch_size=BATCH_SIZE, verbose=0)
-        print("Loss: {:0.4f}".format(results[0]))
+    def _make_streamed(self, guide_id, path, cache, dataset_cache, start, packed=False,
+                       **dbinfo):
+        """build a new model of a guide from a tf.data pipeline and save it to path"""
+        if packed:
+            matrix = get_packed_matrix(guide_id, **dbinfo)
+            if matrix is None:
+                print('cannot read the reports of guide %s' % guide_id)
+                return
+            layout, report_ids, features, labels = matrix
+            print('packed features of guide {}: {:.1f} MB, {:.1f} MB dense'.format(
+                guide_id, features.nbytes / 1048576.0,
+                4.0 * len(features) * len(layout) / 1048576.0))
+            source = ArraySource(report_ids, features, labels, self.CHUNK_ROWS)
+        elif cache is not None:
+            matrix = cache.get_feature_matrix(guide_id, **dbinfo)
+            if matrix is None:
+                print('cannot read the reports of guide %s' % guide_id)
+                return
+            layout, report_ids, features, labels = matrix
+            source = ArraySource(report_ids, features, labels, self.CHUNK_ROWS)
+        else:
+            try:
+                source = DBSource(guide_id, self.CHUNK_ROWS, **dbinfo)
+            except ValueError as e:
+                print(e)
+                return
+            layout = source.layout
 
+        try:
+            mean, scale, counts = fit_scaler(source)
+        except ValueError as e:
+            print('cannot build a model of guide {}: {}'.format(guide_id, e))
+            return
+        zero, one = counts
+        print('Examples:\n    Total: {}\n    one: {} ({:.2f}% of total)\n'
+              .format(zero + one, one, 100 * one / (zero + one)))
+
+        train = make_dataset(source, mean, scale, self.BATCH_SIZE, training=True,
+                             shuffle_buffer=self.SHUFFLE_BUFFER, cache=dataset_cache)
+        val = make_dataset(source, mean, scale, self.BATCH_SIZE, training=False,
+                           cache=dataset_cache + '_val' if dataset_cache else dataset_cache)
+
+        early_stopping = tf.keras.callbacks.EarlyStopping(
+            verbose=1, patience=10, monitor='val_loss', mode='min', restore_best_weights=True)
+        model = self.get_tf_model(np.empty((0, len(layout))), output_bias=initial_bias(counts))
+        model.summary()
+        steps = StepsPerSecond()
+        with metrics.span('model.fit', guide_id=guide_id, streaming=True):
+            model.fit(
+                train,
+                epochs=self.EPOCHS,
+                callbacks=[early_stopping, steps],
+                class_weight=class_weights(counts),
+                validation_data=val)
+        self.trained = time.time()
+        print('training ran at {:.1f} steps/s'.format(steps.steps_per_second or 0))
+
+        with metrics.span('model.save', guide_id=guide_id):
+            model.save(filepath=path, overwrite=True, include_optimizer=True,
+                       save_format=None, signatures=None, options=None)
+            FeatureManifest(guide_id, layout, mean, scale).save(path)
+            sample = next(iter(val.unbatch().batch(1000)), (np.empty((0, len(layout))), None))[0]
+            self._export_weights(model, path, np.asarray(sample))
+        seconds = time.time() - start
+        write_preprocess(path, {
+            'guide_id': int(guide_id), 'fingerprint': layout_fingerprint(layout),
+            'columns': len(layout),
+            'last_report_id': int(source.last_report_id) if source.last_report_id else None,
+            'mode': 'packed' if packed else 'streamed', 'seconds': seconds,
+            'full_seconds': seconds, 'steps_per_second': steps.steps_per_second})
+        return path
+
+    @staticmethod
+    def _fetch(guide_id, cache, vectors, **dbinfo):
+        """read all the labeled reports of a guide"""
+        if cache is not None:
+            return cache.get_feature_matrix(guide_id, **dbinfo)
+        if vectors:
+            return dbm.get_vector_matrix(guide_id, **dbinfo)
+        return dbm.get_feature_matrix(guide_id, **dbinfo)
+
+    @staticmethod
+    def _fetch_new(guide_id, last_report_id, replay, vectors, **dbinfo):
         """
-        Train the model
+        read the labeled reports of a guide newer than last_report_id and,
+        with replay, a random sample of replay times as many older ones.
+        """
+        fetch = dbm.get_vector_matrix if vectors else dbm.get_feature_matrix
+        matrix = fetch(guide_id, min_report_id=last_report_id, **dbinfo)
+        if matrix is None or replay <= 0 or not len(matrix[1]):
+            return matrix
+        report_ids = dbm.get_report_ids(guide_id, **dbinfo)
+        if report_ids is None:
+            return None
+        old = report_ids[report_ids <= last_report_id]
+        n_replay = min(len(old), int(round(replay * len(matrix[1]))))
+        if not n_replay:
+            return matrix
+        sample = np.sort(np.random.choice(old, n_replay, replace=False))
+        if vectors:
+            dbinfo = dict(dbinfo, refresh=False)
+        replayed = fetch(guide_id, report_ids=sample, **dbinfo)
+        if replayed is None:
+            return None
+        if replayed[0] != matrix[0]:
+            print('field layout of guide %s changed while it was read' % guide_id)
+            return None
+        return (matrix[0],) + tuple(np.concatenate([old_rows, new_rows])
+                                    for old_rows, new_rows in zip(replayed[1:], matrix[1:]))
+
+    def _fine_tune(self, guide_id, previous, state, path, layout, report_ids, features,
+                   labels, replay, start):
+        """
+        continue training the model saved at previous on the reports newer
+        than the ones it was built from, and save the result to path.  the
+        previous model's scaler is reused as-is so its weights stay valid.
         """
-        model = self.get_tf_model(train_features)
+        last_report_id = state['last_report_id']
+        new = report_ids > last_report_id if last_report_id is not None \
+            else np.ones(len(report_ids), dtype=bool)
+        rows = np.flatnonzero(new)
+        if not len(rows):
+            print('no new reports for guide %s since %s' % (guide_id, previous))
+            return previous
+        n_new = len(rows)
+        if replay > 0:
+            old = np.flatnonzero(~new)
+            n_replay = min(len(old), int(round(replay * n_new)))
+            rows = np.concatenate([rows, np.random.choice(old, n_replay, replace=False)])
 
-        model.fit(
-            x=train_features,
-            y=train_labels,
-            batch_size=BATCH_SIZE,
-            epochs=EPOCHS,
-            callbacks=[early_stopping],
-            validation_data=(val_features, val_labels))
+        mean, scale, clip = read_scaler(previous)
+        train_features = np.clip((features[rows] - mean) / scale, -clip, clip)
+        train_labels = np.asarray(labels[rows])
 
-        model.save(filepath='models/guide_{guide_id}/1'.format(guide_id=guide_id), overwrite=True, include_optimizer=True,
-                   save_format=None, signatures=None, options=None)
+        model = keras.models.load_model(previous)
+        callbacks = []
+        validation_data = None
+        if len(rows) >= 10:
+            train_features, val_features, train_labels, val_labels = \
+                train_test_split(train_features, train_labels, test_size=0.2)
+            validation_data = (val_features, val_labels)
+            callbacks.append(tf.keras.callbacks.EarlyStopping(
+                verbose=1, patience=3, monitor='val_loss', mode='min',
+                restore_best_weights=True))
+        fit_start = time.time()
+        with metrics.span('model.fit', guide_id=guide_id, rows=len(train_labels),
+                          incremental=True):
+            model.fit(
+                x=train_features,
+                y=train_labels,
+                batch_size=self.BATCH_SIZE,
+                epochs=self.INCREMENTAL_EPOCHS,
+                callbacks=callbacks,
+                validation_data=validation_data)
+        self.trained = time.time()
+        fit_seconds = self.trained - fit_start
 
+        with metrics.span('model.save', guide_id=guide_id):
+            model.save(filepath=path, overwrite=True, include_optimizer=True,
+                       save_format=None, signatures=None, options=None)
+            FeatureManifest(guide_id, layout, mean, scale, clip).save(path)
+            self._export_weights(model, path, train_features)
+        seconds = time.time() - start
+        full_seconds = state.get('full_seconds')
+        print('incremental retrain of guide {} on {} new and {} replayed reports took {:.1f}s '
+              '(fit {:.1f}s)'.format(guide_id, n_new, len(rows) - n_new, seconds, fit_seconds))
+        if full_seconds:
+            print('last full retrain took {:.1f}s, {:.0f}% saved'
+                  .format(full_seconds, 100 * (full_seconds - seconds) / full_seconds))
+        # models saved before the feature manifest kept the scaler here
+        state = dict((k, v) for k, v in state.items() if k not in ('mean', 'scale'))
+        state.update({'last_report_id': int(report_ids.max()), 'mode': 'incremental',
+                      'seconds': seconds})
+        write_preprocess(path, state)
+        return path
+
+    def _export_weights(self, model, path, scaled_features):
+        """
+        export the weights for spa.numpy_model and check that they score a
+        sample of the scaled features like the model does.  on a failure or a
+        mismatch nothing is exported, so scoring falls back to TensorFlow.
+        """
+        fn = os.path.join(path, WEIGHTS_FILE)
+        try:
+            export_weights(model, path)
+            diff = check_parity(model, path, scaled_features)
+            print('exported weights to {} (max difference {:.2g})'.format(fn, diff))
+        except Exception as e:
+            print('not exporting weights: {}'.format(e))
+            if os.path.exists(fn):
+                os.remove(fn)
 
-    def get_tf_model(self, train_features, output_bias=None):
+    def get_tf_model(self, train_features, output_bias=None, hidden=16, dropout=0.5,
+                     learning_rate=1e-3, layers=1):
         """
         ### Define the model and metrics ###
         Define a function that creates a simple neural network
@@ -148,14 +443,17 @@ class ModelMaker(object):
         if output_bias is not None:
             output_bias = tf.keras.initializers.Constant(output_bias)
         model = keras.Sequential()
-        model.add(Dense(16, activation='relu', input_shape=(train_features.shape[-1],)))
+        model.add(Dense(hidden, activation='relu', input_shape=(train_features.shape[-1],)))
         # The Dropout layer randomly sets input units to 0 with a
         # frequency of rate at each step during training time,
         # which helps prevent overfitting. Inputs not set to 0
         # are scaled up by 1/(1 - rate) such that the sum over all inputs is unchanged.
-        model.add(Dropout(0.5))
+        model.add(Dropout(dropout))
+        for _ in range(layers - 1):
+            model.add(Dense(hidden, activation='relu'))
+            model.add(Dropout(dropout))
         model.add(Dense(1, activation='sigmoid', bias_initializer=output_bias))
-        model.compile(optimizer=keras.optimizers.Adam(lr=1e-3),
+        model.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
                       loss=keras.losses.BinaryCrossentropy(),
                       metrics=['accuracy'])
         return model
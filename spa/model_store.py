@@ -0,0 +1,75 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Layout of the saved models on disk.
+
+Each guide's models live in <model_dir>/guide_<id>/<version>, where version is
+a number as TF Serving requires.  Next to the SavedModel files each version
+keeps its training state (layout fingerprint, last report, timings) in
+assets.extra/preprocess.json, its feature manifest in
+assets.extra/features.json, and its layer weights for TensorFlow-free scoring
+in assets.extra/weights.npz.  The manifest is the only copy of the scaler.
+"""
+
+import json
+import os
+
+import numpy as np
+
+PREPROCESS_FILE = os.path.join('assets.extra', 'preprocess.json')
+FEATURES_FILE = os.path.join('assets.extra', 'features.json')
+WEIGHTS_FILE = os.path.join('assets.extra', 'weights.npz')
+
+# scaled features are clipped to [-CLIP, CLIP] in training and scoring
+CLIP = 5.0
+
+
+def guide_model_dir(model_dir, guide_id):
+    return os.path.join(model_dir, 'guide_{guide_id}'.format(guide_id=guide_id))
+
+
+def model_versions(guide_dir):
+    """return the sorted numeric versions saved in a guide's model directory"""
+    try:
+        return sorted(int(n) for n in os.listdir(guide_dir) if n.isdigit())
+    except OSError:
+        return []
+
+
+def latest_model(model_dir, guide_id):
+    """return the path of the newest saved model of a guide, or None"""
+    guide_dir = guide_model_dir(model_dir, guide_id)
+    versions = model_versions(guide_dir)
+    return os.path.join(guide_dir, str(versions[-1])) if versions else None
+
+
+def read_preprocess(path):
+    try:
+        with open(os.path.join(path, PREPROCESS_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_preprocess(path, state):
+    fn = os.path.join(path, PREPROCESS_FILE)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, 'w') as f:
+        json.dump(state, f)
+
+
+def read_scaler(path):
+    """
+    return the mean, scale and clip bound the model at path was trained with,
+    or None.  models saved before the feature manifest keep them in the
+    preprocessing state.
+    """
+    for fn in (FEATURES_FILE, PREPROCESS_FILE):
+        try:
+            with open(os.path.join(path, fn)) as f:
+                d = json.load(f)
+        except (IOError, ValueError):
+            continue
+        if 'mean' in d and 'scale' in d:
+            return (np.asarray(d['mean'], dtype=np.float32),
+                    np.asarray(d['scale'], dtype=np.float32), float(d.get('clip', CLIP)))
+    return None
@@ -0,0 +1,127 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+TensorFlow-free scoring of the guide models.
+
+make_model exports the weights of each Dense layer to assets.extra/weights.npz
+next to the SavedModel.  NumpyModel loads that file, with the input scaler of
+the feature manifest, and scores whole batches of raw feature vectors with one matrix
+multiply per layer, so scoring needs neither a TensorFlow import nor a model
+server.  Dropout is the identity at inference time and is not exported.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from spa.model_store import CLIP, WEIGHTS_FILE, read_scaler
+
+logger = logging.getLogger(__name__)
+
+PARITY_TOLERANCE = 1e-4
+
+
+def _relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def _sigmoid(x):
+    # split by sign so exp never overflows
+    out = np.empty_like(x)
+    pos = x >= 0
+    out[pos] = 1 / (1 + np.exp(-x[pos]))
+    e = np.exp(x[~pos])
+    out[~pos] = e / (1 + e)
+    return out
+
+
+ACTIVATIONS = {'linear': lambda x: x, 'relu': _relu, 'sigmoid': _sigmoid, 'tanh': np.tanh}
+
+
+def export_weights(model, path):
+    """
+    write the Dense layers of a keras model to <path>/assets.extra/weights.npz.
+    the scaler is read from the feature manifest, save it first.  returns the
+    file name.
+    """
+    arrays = dict()
+    activations = []
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue  # dropout
+        # not every layer implements get_config, the activation names itself
+        activation = getattr(getattr(layer, 'activation', None), '__name__', 'linear')
+        if activation not in ACTIVATIONS:
+            raise ValueError("cannot export layer %s with activation %s" % (layer.name, activation))
+        i = len(activations)
+        arrays['kernel_%d' % i] = weights[0].astype(np.float32)
+        arrays['bias_%d' % i] = weights[1].astype(np.float32)
+        activations.append(activation)
+    arrays['activations'] = np.array(activations)
+    fn = os.path.join(path, WEIGHTS_FILE)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    np.savez(fn, **arrays)
+    return fn
+
+
+class NumpyModel(object):
+
+    def __init__(self, kernels, biases, activations, mean, scale, clip=CLIP):
+        self.kernels = kernels
+        self.biases = biases
+        self.activations = activations
+        self.mean = mean
+        self.scale = scale
+        self.clip = clip
+
+    @classmethod
+    def load(cls, path):
+        """load the weights exported next to the model saved at path"""
+        scaler = read_scaler(path)
+        if scaler is None:
+            raise ValueError("%s has no scaler" % path)
+        with np.load(os.path.join(path, WEIGHTS_FILE)) as f:
+            activations = [str(a) for a in f['activations']]
+            return cls([f['kernel_%d' % i] for i in range(len(activations))],
+                       [f['bias_%d' % i] for i in range(len(activations))],
+                       activations, *scaler)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, WEIGHTS_FILE))
+
+    def predict(self, features, scaled=False, batch_size=8192):
+        """
+        return one prediction per row of features.  unless scaled is set the
+        raw features are standardized and clipped first, like in training.
+        features may be a spa.packed_features.PackedFeatures, unpacked and
+        scored batch_size rows at a time.
+        """
+        if hasattr(features, 'batches'):
+            predictions = [self.predict(x, scaled) for x in features.batches(batch_size)]
+            return np.concatenate(predictions) if predictions else np.empty(0, dtype=np.float32)
+        x = np.asarray(features, dtype=np.float32)
+        if not scaled:
+            x = np.clip((x - self.mean) / self.scale, -self.clip, self.clip)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            x = x @ kernel
+            x += bias
+            x = ACTIVATIONS[activation](x)
+        return x.reshape(-1)
+
+
+def check_parity(model, path, features, tolerance=PARITY_TOLERANCE):
+    """
+    compare the predictions of a keras model with those of its exported
+    weights on a sample of scaled features.  returns the largest absolute
+    difference, or raises ValueError if it is above tolerance.
+    """
+    features = np.asarray(features[:1000], dtype=np.float32)
+    expected = np.asarray(model.predict(features, verbose=0)).reshape(-1)
+    actual = NumpyModel.load(path).predict(features, scaled=True)
+    diff = float(np.max(np.abs(expected - actual))) if len(features) else 0.0
+    if diff > tolerance:
+        raise ValueError("exported weights of %s differ from the model by %g" % (path, diff))
+    logger.debug("exported weights of %s match the model within %g", path, diff)
+    return diff
@@ -0,0 +1,178 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Compact storage of guide feature matrices.
+
+Almost every column of a checklist guide is a RADIO or CHECK action, which
+the feature queries map to 0 or 1.  PackedFeatures keeps those columns as
+bit planes (np.packbits, eight columns of a report per byte) and the
+remaining numeric columns as a float32 block, or as a CSR matrix when most
+of their values are zero.  A 134 column guide of checkboxes takes 17 bytes
+per report instead of 536.
+
+The matrix is unpacked a slice at a time, so training (through
+spa.input_pipeline.ArraySource) and scoring (NumpyModel.predict) only ever
+hold one dense batch.
+"""
+
+import logging
+
+import numpy as np
+
+import spa.dbmanager as dbm
+
+logger = logging.getLogger(__name__)
+
+BOOLEAN_TYPES = ('RADIO', 'CHECK')
+# a numeric block with fewer nonzero values than this is kept as CSR, which
+# costs 8 bytes per value against 4 per cell when dense
+SPARSE_DENSITY = 0.25
+CHUNK_ROWS = 10000
+
+
+def boolean_columns(layout):
+    """the positions of the layout entries whose values are always 0 or 1"""
+    return np.array([i for i, r in enumerate(layout) if str(r[3]).upper() in BOOLEAN_TYPES],
+                    dtype=np.int64)
+
+
+class PackedFeatures(object):
+    """
+    a float32 feature matrix of shape (rows, columns) whose boolean columns
+    are packed into bits.  bits holds one row of packed bits per report,
+    numeric the other columns, dense or as a scipy.sparse CSR matrix.
+    """
+
+    def __init__(self, columns, bool_cols, bits, numeric_cols, numeric):
+        self.columns = columns
+        self.bool_cols = bool_cols
+        self.bits = bits
+        self.numeric_cols = numeric_cols
+        self.numeric = numeric
+        self.sparse = not isinstance(numeric, np.ndarray)
+
+    @classmethod
+    def pack(cls, features, bool_cols=None, sparse=None):
+        """
+        pack a dense matrix.  bool_cols are the columns to store as bits, by
+        default every column holding only 0 and 1; a listed column holding
+        other values is kept numeric.  sparse forces the CSR block on or
+        off, by default it is used below SPARSE_DENSITY.
+        """
+        features = np.asarray(features, dtype=np.float32)
+        columns = features.shape[1]
+        binary = ((features == 0) | (features == 1)).all(axis=0)
+        if bool_cols is None:
+            bool_cols = np.flatnonzero(binary)
+        else:
+            bool_cols = np.asarray(bool_cols, dtype=np.int64)
+            if not binary[bool_cols].all():
+                logger.debug("columns %s are not 0/1, keeping them numeric",
+                             bool_cols[~binary[bool_cols]].tolist())
+                bool_cols = bool_cols[binary[bool_cols]]
+        numeric_cols = np.setdiff1d(np.arange(columns), bool_cols)
+        bits = np.packbits(features[:, bool_cols].astype(np.bool_), axis=1)
+        numeric = features[:, numeric_cols]
+        if sparse is None:
+            sparse = numeric.size > 0 and np.count_nonzero(numeric) < SPARSE_DENSITY * numeric.size
+        if sparse:
+            from scipy import sparse as sp
+            numeric = sp.csr_matrix(numeric)
+        return cls(columns, bool_cols, bits, numeric_cols, numeric)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """join the rows of packed matrices with the same columns"""
+        first = parts[0]
+        if first.sparse:
+            from scipy import sparse as sp
+            numeric = sp.vstack([p.numeric for p in parts], format='csr')
+        else:
+            numeric = np.concatenate([p.numeric for p in parts])
+        return cls(first.columns, first.bool_cols, np.concatenate([p.bits for p in parts]),
+                   first.numeric_cols, numeric)
+
+    def __len__(self):
+        return len(self.bits)
+
+    @property
+    def shape(self):
+        return len(self), self.columns
+
+    @property
+    def nbytes(self):
+        if self.sparse:
+            numeric = self.numeric.data.nbytes + self.numeric.indices.nbytes + \
+                self.numeric.indptr.nbytes
+        else:
+            numeric = self.numeric.nbytes
+        return self.bits.nbytes + numeric
+
+    def __getitem__(self, rows):
+        """the dense float32 rows selected by a slice or an index array"""
+        return self.unpack(rows)
+
+    def unpack(self, rows=slice(None)):
+        bits = self.bits[rows]
+        out = np.zeros((len(bits), self.columns), dtype=np.float32)
+        if len(self.bool_cols):
+            out[:, self.bool_cols] = np.unpackbits(bits, axis=1, count=len(self.bool_cols))
+        if len(self.numeric_cols):
+            numeric = self.numeric[rows]
+            out[:, self.numeric_cols] = numeric.toarray() if self.sparse else numeric
+        return out
+
+    def take(self, rows):
+        """a PackedFeatures holding only the given rows"""
+        return PackedFeatures(self.columns, self.bool_cols, self.bits[rows],
+                              self.numeric_cols, self.numeric[rows])
+
+    def batches(self, batch_size):
+        """yield the matrix as dense batches of batch_size rows"""
+        for start in range(0, len(self), batch_size):
+            yield self.unpack(slice(start, start + batch_size))
+
+
+def get_packed_matrix(guide_id, chunk_rows=CHUNK_ROWS, sparse=None, labeled=True,
+                      unscored=False, **kwargs):
+    """
+    like dbm.get_feature_matrix, but the features come back as a
+    PackedFeatures.  the reports are read and packed chunk_rows at a time,
+    so the dense matrix is never held whole.  labeled and unscored select
+    the reports like in dbm.get_feature_matrix.  returns None on failure.
+    """
+    layout = dbm.get_guide_layout(guide_id, **kwargs)
+    if layout is None:
+        return None
+    bool_cols = boolean_columns(layout)
+    ids, labels, parts = [], [], []
+    last_report_id = None
+    while True:
+        matrix = dbm.get_feature_matrix(guide_id, min_report_id=last_report_id,
+                                        labeled=labeled, unscored=unscored, limit=chunk_rows,
+                                        **kwargs)
+        if matrix is None:
+            return None
+        if matrix[0] != layout:
+            logger.error("field layout of guide %s changed while it was read", guide_id)
+            return None
+        if not len(matrix[1]):
+            break
+        ids.append(matrix[1])
+        labels.append(matrix[3])
+        parts.append(PackedFeatures.pack(matrix[2], bool_cols, sparse))
+        # the first chunk decides for the others
+        sparse = parts[0].sparse
+        if len(matrix[1]) < chunk_rows:
+            break
+        last_report_id = matrix[1][-1]
+    if not parts:
+        parts = [PackedFeatures.pack(np.empty((0, len(layout)), dtype=np.float32), bool_cols,
+                                     sparse)]
+        ids, labels = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+    # every chunk must agree on the columns kept as bits
+    if len(set(tuple(p.bool_cols) for p in parts)) > 1:
+        common = np.array(sorted(set.intersection(*[set(p.bool_cols) for p in parts])),
+                          dtype=np.int64)
+        parts = [PackedFeatures.pack(p.unpack(), common, sparse) for p in parts]
+    return layout, np.concatenate(ids), PackedFeatures.concatenate(parts), \
+        np.concatenate(labels)
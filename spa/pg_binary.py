@@ -0,0 +1,124 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Decoding of PostgreSQL binary COPY output into NumPy arrays.
+
+FloatArrayRows is the target of a COPY (...) TO STDOUT WITH (FORMAT binary)
+of rows (id integer, label float8, values float8[]), PackedVectorRows of
+rows (id integer, label float8, values bytea) whose bytea packs the values
+as big-endian float4.  When every row holds the same number of values and
+no NULLs, all rows have the same size, so whole rows are decoded at once
+with a structured big-endian dtype instead of one Python object per value.
+"""
+
+import numpy as np
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+HEADER_SIZE = len(SIGNATURE) + 8  # flags and header extension length
+TRAILER = b'\xff\xff'
+
+
+def packed_row_dtype(columns):
+    """the layout of one binary COPY row (integer, float8, bytea of columns float4)"""
+    return np.dtype([
+        ('fields', '>i2'),
+        ('id_size', '>i4'), ('id', '>i4'),
+        ('label_size', '>i4'), ('label', '>f8'),
+        ('values_size', '>i4'), ('values', '>f4', (columns,)),
+    ])
+
+
+def array_row_dtype(columns):
+    """the layout of one binary COPY row (integer, float8, float8[columns])"""
+    return np.dtype([
+        ('fields', '>i2'),
+        ('id_size', '>i4'), ('id', '>i4'),
+        ('label_size', '>i4'), ('label', '>f8'),
+        ('array_size', '>i4'), ('ndim', '>i4'), ('has_null', '>i4'), ('element_type', '>u4'),
+        ('length', '>i4'), ('lower_bound', '>i4'),
+        ('values', [('size', '>i4'), ('value', '>f8')], (columns,)),
+    ])
+
+
+class BinaryRows(object):
+    """
+    a file-like object for cursor.copy_expert that decodes the rows as they
+    arrive.  a row that does not have the expected layout, e.g. one with
+    another number of values, stops the decoding and is reported by finish().
+    """
+
+    def __init__(self, columns, dtype):
+        self.columns = columns
+        self.dtype = dtype
+        self.buffer = bytearray()
+        self.header = False
+        self.error = None
+        self.bytes = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.bytes += len(data)
+        if self.error is not None:
+            return
+        self.buffer += data
+        offset = 0
+        if not self.header:
+            if len(self.buffer) < HEADER_SIZE:
+                return
+            if bytes(self.buffer[:len(SIGNATURE)]) != SIGNATURE:
+                self.error = 'not a binary COPY stream'
+                return
+            extension = int.from_bytes(self.buffer[HEADER_SIZE - 4:HEADER_SIZE], 'big')
+            if len(self.buffer) < HEADER_SIZE + extension:
+                return
+            offset = HEADER_SIZE + extension
+            self.header = True
+        n = (len(self.buffer) - offset) // self.dtype.itemsize
+        if n:
+            self._decode(np.frombuffer(self.buffer, self.dtype, n, offset))
+            offset += n * self.dtype.itemsize
+        del self.buffer[:offset]
+
+    def _decode(self, rows):
+        if (rows['fields'] != 3).any() or (rows['id_size'] != 4).any() \
+                or (rows['label_size'] != 8).any() or not self._check(rows):
+            self.error = 'rows do not hold %d values' % self.columns
+            return
+        self.chunks.append((rows['id'].astype(np.int64), rows['label'].astype(np.float32),
+                            self._values(rows).astype(np.float32)))
+
+    def finish(self):
+        """return (ids, labels, values) of the decoded rows, or raise ValueError"""
+        if self.error is None and bytes(self.buffer) != TRAILER:
+            self.error = 'incomplete binary COPY stream'
+        if self.error is not None:
+            raise ValueError(self.error)
+        if not self.chunks:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32),
+                    np.empty((0, self.columns), dtype=np.float32))
+        return tuple(np.concatenate(arrays) for arrays in zip(*self.chunks))
+
+
+class FloatArrayRows(BinaryRows):
+
+    def __init__(self, columns):
+        super(FloatArrayRows, self).__init__(columns, array_row_dtype(columns))
+
+    def _check(self, rows):
+        return (rows['array_size'] == 4 * 5 + 12 * self.columns).all() \
+            and (rows['ndim'] == 1).all() and (rows['length'] == self.columns).all() \
+            and (rows['values']['size'] == 8).all()
+
+    def _values(self, rows):
+        return rows['values']['value']
+
+
+class PackedVectorRows(BinaryRows):
+
+    def __init__(self, columns):
+        super(PackedVectorRows, self).__init__(columns, packed_row_dtype(columns))
+
+    def _check(self, rows):
+        return (rows['values_size'] == 4 * self.columns).all()
+
+    def _values(self, rows):
+        return rows['values']
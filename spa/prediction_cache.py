@@ -0,0 +1,195 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Cache of the predictions of identical checklist vectors.
+
+Many reports of a guide answer its RADIO and CHECK actions the same way.
+PredictionCache scores each distinct raw feature vector of a batch once,
+and remembers the prediction under (guide_id, model version, digest of the
+packed vector) so later batches reuse it.  The vector is packed like
+spa.packed_features does (boolean columns as bits, the others as float32)
+before it is hashed, which makes both the in-batch deduplication and the
+hashing work on a fraction of the bytes; a vector whose boolean column
+holds another value is hashed raw.  Keying a row costs about a
+microsecond, so the cache pays off when inference costs more than that:
+with the keras engine, larger models or many repeated vectors.
+
+The cache is a bounded LRU shared by every guide.  When a guide is scored
+with another model version than the one its entries were made with, they
+are dropped.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from spa import metrics
+from spa.defaults import Defaults
+
+logger = logging.getLogger(__name__)
+
+
+def _distinct(packed, tag):
+    """the distinct rows of a uint8 matrix, like np.unique, and their digests"""
+    packed = np.ascontiguousarray(packed)
+    rows = packed.view(np.dtype((np.void, packed.shape[1]))).reshape(-1)
+    rows, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    digests = [hashlib.blake2b(tag + r.tobytes(), digest_size=16).digest() for r in rows]
+    return first, inverse.reshape(-1), digests
+
+
+def vector_keys(features, bool_cols):
+    """
+    return (first, inverse, digests) for the distinct rows of features:
+    the index of the first occurrence of each, the index of the distinct
+    row of every row of features, and a digest of each.  the digest of a
+    vector does not depend on the other rows of the batch.
+    """
+    # -0.0 becomes 0.0 and every NaN the same NaN, so equal vectors hash alike
+    features = np.asarray(features, dtype=np.float32) + np.float32(0.0)
+    nan = np.isnan(features)
+    if nan.any():
+        features[nan] = np.nan
+    whole = len(bool_cols) == features.shape[1]
+    bools = features if whole else np.take(features, bool_cols, axis=1)
+    binary = bools.astype(np.bool_)
+    packable = (binary == bools).all(axis=1)
+    groups = []
+    rows = np.flatnonzero(packable)
+    if len(rows):
+        # the usual batch, every row packs and needs no copy
+        every = len(rows) == len(features)
+        packed = np.packbits(binary if every else binary[rows], axis=1)
+        if not whole:
+            numeric = np.ascontiguousarray(
+                np.delete(features if every else features[rows], bool_cols, axis=1))
+            packed = np.concatenate([packed, numeric.view(np.uint8)], axis=1)
+        groups.append((rows, packed, b'p'))
+    # a boolean column holds another value, such rows are hashed raw
+    rows = np.flatnonzero(~packable)
+    if len(rows):
+        groups.append((rows, np.ascontiguousarray(features[rows]).view(np.uint8), b'r'))
+    first, digests = [], []
+    inverse = np.empty(len(features), dtype=np.int64)
+    for rows, packed, tag in groups:
+        group_first, group_inverse, group_digests = _distinct(packed, tag)
+        inverse[rows] = group_inverse + len(digests)
+        first.append(rows[group_first])
+        digests.extend(group_digests)
+    first = np.concatenate(first) if first else np.empty(0, dtype=np.int64)
+    return first, inverse, digests
+
+
+class PredictionCache(object):
+    """
+    an LRU of at most max_entries predictions.  safe to share between the
+    threads of Predictor.predict_guides.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = Defaults.PREDICTION_CACHE_ENTRIES if max_entries is None \
+            else max_entries
+        self.entries = OrderedDict()
+        # the model version the entries of each guide were made with
+        self.versions = dict()
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.unique = 0
+        self.hits = 0
+        self.scored = 0
+        self.score_seconds = 0.0
+        self.key_seconds = 0.0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def use_version(self, guide_id, version):
+        """drop the entries of a guide made with another model version"""
+        with self.lock:
+            if self.versions.get(guide_id, version) != version:
+                stale = [k for k in self.entries if k[0] == guide_id]
+                for k in stale:
+                    del self.entries[k]
+                self.invalidations += 1
+                logger.info("guide %s is now scored with version %s, dropped %d cached "
+                            "predictions", guide_id, version, len(stale))
+            self.versions[guide_id] = version
+
+    def predict(self, guide_id, version, features, score, bool_cols):
+        """
+        return (predictions, scored): score(features) for a batch of raw
+        feature vectors, and the number of vectors actually scored, only the
+        distinct ones not cached for this guide and model version.
+        bool_cols are the columns whose values are 0 or 1 (see
+        spa.packed_features.boolean_columns).
+        """
+        self.use_version(guide_id, version)
+        if not len(features):
+            return np.empty(0, dtype=np.float32), 0
+        start = time.perf_counter()
+        first, inverse, digests = vector_keys(features, bool_cols)
+        keys = [(guide_id, version, d) for d in digests]
+        predictions = np.empty(len(keys), dtype=np.float32)
+        missing = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                p = self.entries.get(key)
+                if p is None:
+                    missing.append(i)
+                else:
+                    self.entries.move_to_end(key)
+                    predictions[i] = p
+        key_seconds = time.perf_counter() - start
+        seconds = 0.0
+        if missing:
+            start = time.perf_counter()
+            predictions[missing] = np.asarray(score(features[first[missing]])).reshape(-1)
+            seconds = time.perf_counter() - start
+        evicted = 0
+        with self.lock:
+            if self.max_entries:
+                for i in missing:
+                    self.entries[keys[i]] = float(predictions[i])
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    evicted += 1
+            self.rows += len(features)
+            self.unique += len(keys)
+            self.hits += len(keys) - len(missing)
+            self.scored += len(missing)
+            self.score_seconds += seconds
+            self.key_seconds += key_seconds
+            self.evictions += evicted
+        metrics.count('prediction_cache.rows', len(features))
+        metrics.count('prediction_cache.scored', len(missing))
+        return predictions[inverse], len(missing)
+
+    def stats(self):
+        """
+        return the counters of the cache.  hit_rate is the share of rows that
+        were not scored, whether their vector was cached or repeated in the
+        batch; saved_seconds estimates the inference time that spared, at
+        the average cost of a scored row, and key_seconds is the time spent
+        packing, deduplicating and looking up the vectors.
+        """
+        with self.lock:
+            per_row = self.score_seconds / self.scored if self.scored else 0.0
+            return {'entries': len(self.entries), 'rows': self.rows, 'unique': self.unique,
+                    'hits': self.hits, 'scored': self.scored,
+                    'hit_rate': 1 - self.scored / self.rows if self.rows else 0.0,
+                    'score_seconds': self.score_seconds, 'key_seconds': self.key_seconds,
+                    'saved_seconds': per_row * (self.rows - self.scored),
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def log_stats(self):
+        s = self.stats()
+        logger.info("prediction cache: %d rows, %d scored (hit rate %.1f%%), %d cache hits, "
+                    "%.3fs of inference saved for %.3fs of keying, %d entries, %d evicted",
+                    s['rows'], s['scored'], 100 * s['hit_rate'], s['hits'],
+                    s['saved_seconds'], s['key_seconds'], s['entries'], s['evictions'])
+        return s
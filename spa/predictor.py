@@ -0,0 +1,191 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Batch scoring of reports.
+
+Reads the reports of a guide that have no prediction yet, vectorizes them
+with the column order and scaler of the guide's latest model, runs the
+model in-process on large batches and upserts the results into
+report_prediction.  Memory is bounded by the batch size.
+
+Models with exported weights are scored with spa.numpy_model, without
+importing TensorFlow; older models are loaded with keras.  With a
+spa.prediction_cache.PredictionCache, each distinct report vector is
+scored once.  With packed, the unscored reports of a guide are read
+bit-packed (spa.packed_features) and unpacked one batch at a time.
+"""
+
+import logging
+import os
+import time
+
+import numpy as np
+
+import spa.dbmanager as dbm
+from spa.defaults import Defaults
+from spa.feature_cache import layout_fingerprint
+from spa.model_store import latest_model, read_preprocess, read_scaler
+from spa.numpy_model import NumpyModel
+from spa.packed_features import boolean_columns, get_packed_matrix
+
+logger = logging.getLogger(__name__)
+
+
+class Predictor(object):
+    BATCH_SIZE = Defaults.PREDICT_BATCH_SIZE
+    INFERENCE_BATCH_SIZE = 8192
+    ENGINES = Defaults.PREDICT_ENGINES
+
+    def __init__(self, model_dir='models', batch_size=None, engine='auto', vectors=False,
+                 cache=None, packed=False):
+        if engine not in self.ENGINES:
+            raise ValueError("unknown engine %s" % engine)
+        self.model_dir = model_dir
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.engine = engine
+        # read the precomputed vectors of report_feature_vector
+        self.vectors = vectors
+        # an optional spa.prediction_cache.PredictionCache
+        self.cache = cache
+        # read the reports bit-packed, see spa.packed_features
+        self.packed = packed
+
+    def load_model(self, path):
+        """return a function scoring a batch of scaled features with the model at path"""
+        if self.engine != 'tensorflow' and NumpyModel.exists(path):
+            model = NumpyModel.load(path)
+            return lambda x: model.predict(x, scaled=True)
+        if self.engine == 'numpy':
+            raise ValueError("%s has no exported weights" % path)
+        from tensorflow import keras
+        model = keras.models.load_model(path, compile=False)
+        return lambda x: model.predict(x, batch_size=self.INFERENCE_BATCH_SIZE, verbose=0)
+
+    def predict_guide(self, guide_id, **dbinfo):
+        """
+        score every unscored report of a guide and return a summary with the
+        number of reports scored, the number of them run through the model
+        (fewer with a cache), the model used and the elapsed seconds.
+        """
+        start = time.time()
+        summary = {'guide_id': guide_id, 'status': 'ok', 'path': None, 'reports': 0,
+                   'inferred': 0, 'error': None}
+        path = latest_model(self.model_dir, guide_id)
+        state = read_preprocess(path) if path else None
+        scaler = read_scaler(path) if path else None
+        if state is None or scaler is None:
+            summary.update({'status': 'failed', 'error': 'no model with preprocessing state'})
+            return self._finish(summary, start)
+        summary['path'] = path
+        mean, scale, clip = scaler
+        try:
+            predict = self.load_model(path)
+        except ValueError as e:
+            summary.update({'status': 'failed', 'error': str(e)})
+            return self._finish(summary, start)
+
+        version = int(os.path.basename(path))
+        bool_cols = None
+        for matrix in self._read_batches(guide_id, **dbinfo):
+            if matrix is None:
+                summary.update({'status': 'failed', 'error': 'cannot read reports'})
+                break
+            layout, report_ids, features, _ = matrix
+            if layout_fingerprint(layout) != state['fingerprint']:
+                summary.update({'status': 'failed',
+                                'error': 'field layout changed since %s was built' % path})
+                break
+            if not len(report_ids):
+                break
+            if self.cache is not None:
+                if bool_cols is None:
+                    bool_cols = boolean_columns(layout)
+                predictions, inferred = self.cache.predict(
+                    guide_id, version, features,
+                    lambda x: predict(self._scale(x, mean, scale, clip)), bool_cols)
+                summary['inferred'] += inferred
+            else:
+                predictions = np.asarray(predict(self._scale(features, mean, scale, clip))).reshape(-1)
+                summary['inferred'] += len(report_ids)
+            if dbm.save_predictions(report_ids, predictions, **dbinfo) is None:
+                summary.update({'status': 'failed', 'error': 'cannot save predictions'})
+                break
+            summary['reports'] += len(report_ids)
+            logger.debug("guide %s: scored %d reports up to id %d",
+                         guide_id, summary['reports'], report_ids[-1])
+        return self._finish(summary, start)
+
+    def _read_batches(self, guide_id, **dbinfo):
+        """
+        yield (layout, report_ids, features, labels) of the unscored reports
+        of a guide, batch_size reports at a time and lowest ids first.  the
+        last batch may hold no reports.  yields None when the reports cannot
+        be read.
+        """
+        if self.packed:
+            matrix = get_packed_matrix(guide_id, labeled=False, unscored=True, **dbinfo)
+            if matrix is None:
+                yield None
+                return
+            layout, report_ids, features, labels = matrix
+            logger.debug("guide %s: %d unscored reports packed into %.1f MB",
+                         guide_id, len(report_ids), features.nbytes / 1048576.0)
+            for start in range(0, len(report_ids) + 1, self.batch_size):
+                rows = slice(start, start + self.batch_size)
+                yield layout, report_ids[rows], features.unpack(rows), labels[rows]
+            return
+        last_report_id = None
+        while True:
+            if self.vectors:
+                # the vectors are brought up to date once, before the first batch
+                matrix = dbm.get_vector_matrix(guide_id, min_report_id=last_report_id,
+                                               labeled=False, unscored=True,
+                                               limit=self.batch_size,
+                                               refresh=last_report_id is None, **dbinfo)
+            else:
+                matrix = dbm.get_feature_matrix(guide_id, min_report_id=last_report_id,
+                                                labeled=False, unscored=True,
+                                                limit=self.batch_size, **dbinfo)
+            yield matrix
+            if matrix is None or not len(matrix[1]):
+                return
+            last_report_id = matrix[1][-1]
+
+    def predict_guides(self, guide_ids, workers=1, **dbinfo):
+        """
+        score the guides in guide_ids, workers of them at a time so one
+        guide's reports are read while another's are scored
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        # history rows must not pile up in the default partition
+        dbm.add_history_partitions(**dbinfo)
+        workers = max(1, min(workers or 1, len(guide_ids)))
+        if workers == 1:
+            return [self.predict_guide(g, **dbinfo) for g in guide_ids]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='spa_predict') as executor:
+            return list(executor.map(lambda g: self.predict_guide(g, **dbinfo), guide_ids))
+
+    @staticmethod
+    def _scale(features, mean, scale, clip):
+        """standardize and clip a batch of raw features in place"""
+        features -= mean
+        features /= scale
+        np.clip(features, -clip, clip, out=features)
+        return features
+
+    def _finish(self, summary, start):
+        summary['seconds'] = time.time() - start
+        rate = 3600 * summary['reports'] / summary['seconds'] if summary['seconds'] > 0 else 0
+        logger.info("guide %s: %s, %d reports scored in %.1fs (%.0f reports/hour)",
+                    summary['guide_id'], summary['status'], summary['reports'],
+                    summary['seconds'], rate)
+        return summary
+
+
+def format_summary(summaries):
+    lines = ['%-10s %-8s %10s %9s  %s' % ('guide', 'status', 'reports', 'seconds', 'model / error')]
+    for s in summaries:
+        detail = s['path'] if s['status'] == 'ok' else s['error']
+        lines.append('%-10s %-8s %10d %9.1f  %s' % (s['guide_id'], s['status'], s['reports'],
+                                                    s['seconds'], detail))
+    return '\n'.join(lines)
@@ -0,0 +1,214 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Atomic publishing of guide models to the directory TF Serving watches.
+
+A build is written to a staging directory inside the guide's model
+directory (.staging-*, which TF Serving ignores because its name is not a
+number), validated by loading it and scoring a canary batch, and only then
+renamed to the next numeric version.  A rename within one filesystem is
+atomic, so TF Serving either sees a complete version or none at all, and
+picks it up at its next file system poll without a restart.
+
+After publishing, models.config is regenerated so a new guide is served
+too, and old versions beyond the retention count are removed.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from spa import metrics
+from spa.defaults import Defaults
+from spa.model_store import guide_model_dir, model_versions, read_preprocess, read_scaler
+
+logger = logging.getLogger(__name__)
+
+STAGING_PREFIX = '.staging-'
+CONFIG_FILE = 'models.config'
+SERVING_BASE_PATH = '/models'
+CANARY_ROWS = 16
+
+
+class PublishError(Exception):
+    pass
+
+
+def stage(model_dir, guide_id):
+    """return a new, empty staging directory for a build of a guide"""
+    guide_dir = guide_model_dir(model_dir, guide_id)
+    os.makedirs(guide_dir, exist_ok=True)
+    return tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=guide_dir)
+
+
+def validate(path, canary=None):
+    """
+    load the SavedModel staged at path, as TF Serving will, and score a
+    canary batch of raw feature vectors, by default CANARY_ROWS rows of the
+    scaler's means plus a row of zeros and one of ones.  if the model has
+    exported weights, they must score the canary like the SavedModel.
+    raises PublishError if the model cannot be loaded, its predictions are
+    not probabilities or the exported weights disagree.  returns the
+    predictions.
+    """
+    from spa.numpy_model import PARITY_TOLERANCE, NumpyModel
+
+    state = read_preprocess(path)
+    if state is None:
+        raise PublishError("%s has no preprocessing state" % path)
+    scaler = read_scaler(path)
+    if scaler is None:
+        raise PublishError("%s has no feature manifest" % path)
+    mean, scale, clip = scaler
+    if not os.path.exists(os.path.join(path, 'saved_model.pb')):
+        raise PublishError("%s has no saved_model.pb" % path)
+    if canary is None:
+        # the average report and the extremes of the checklist values
+        columns = state['columns']
+        canary = np.concatenate([np.tile(mean, (CANARY_ROWS - 2, 1)),
+                                 np.zeros((1, columns)), np.ones((1, columns))])
+    canary = np.asarray(canary, dtype=np.float32)
+    if canary.ndim != 2 or canary.shape[1] != state['columns']:
+        raise PublishError("canary batch of shape %s does not fit %d columns" %
+                           (canary.shape, state['columns']))
+    try:
+        from tensorflow import keras
+
+        model = keras.models.load_model(path, compile=False)
+        predictions = np.asarray(model.predict(
+            np.clip((canary - mean) / scale, -clip, clip), verbose=0)).reshape(-1)
+    except Exception as e:
+        raise PublishError("cannot load %s: %s" % (path, e))
+    if len(predictions) != len(canary) or not np.isfinite(predictions).all() \
+            or (predictions < 0).any() or (predictions > 1).any():
+        raise PublishError("%s scores the canary batch out of [0, 1]" % path)
+    if NumpyModel.exists(path):
+        try:
+            exported = NumpyModel.load(path).predict(canary)
+        except Exception as e:
+            raise PublishError("cannot load the exported weights of %s: %s" % (path, e))
+        diff = float(np.max(np.abs(exported - predictions)))
+        if diff > PARITY_TOLERANCE:
+            raise PublishError("exported weights of %s differ from the model by %g" %
+                               (path, diff))
+    return predictions
+
+
+def publish(staged, model_dir, guide_id, version=None, canary=None, retain=None,
+            trained=None):
+    """
+    validate the model staged at staged and rename it to version, by
+    default the guide's next version.  models.config of model_dir is
+    regenerated and versions beyond the newest retain ones are removed.
+    trained is the time training ended, to log how long the model took to
+    become servable.  returns the path of the published version; on failure
+    the staging directory is removed and PublishError raised.
+    """
+    retain = Defaults.MODEL_RETAIN_VERSIONS if retain is None else retain
+    guide_dir = guide_model_dir(model_dir, guide_id)
+    with metrics.span('model.publish', guide_id=guide_id):
+        try:
+            validate(staged, canary)
+        except PublishError:
+            shutil.rmtree(staged, ignore_errors=True)
+            raise
+        _sync(staged)
+        while True:
+            versions = model_versions(guide_dir)
+            if version is not None:
+                path = os.path.join(guide_dir, str(int(version)))
+            else:
+                path = os.path.join(guide_dir, str(versions[-1] + 1 if versions else 1))
+            if version is not None and os.path.exists(path):
+                shutil.rmtree(staged, ignore_errors=True)
+                raise PublishError("%s already exists" % path)
+            try:
+                # fails if another build took the version first
+                os.rename(staged, path)
+                break
+            except OSError as e:
+                if version is not None or not os.path.exists(path):
+                    shutil.rmtree(staged, ignore_errors=True)
+                    raise PublishError("cannot publish %s: %s" % (path, e))
+        _sync(guide_dir)
+        write_model_config(model_dir)
+        prune_versions(guide_dir, retain)
+    if trained is not None:
+        seconds = time.time() - trained
+        metrics.count('model.publish_seconds', seconds)
+        logger.info("published %s %.2fs after training ended", path, seconds)
+    else:
+        logger.info("published %s", path)
+    return path
+
+
+def prune_versions(guide_dir, retain, stale_after=24 * 3600):
+    """
+    remove the versions of a guide older than the newest retain ones, and
+    staging directories left behind by builds that died more than
+    stale_after seconds ago.  returns the removed versions.
+    """
+    versions = model_versions(guide_dir)
+    removed = versions[:-retain] if retain and len(versions) > retain else []
+    for version in removed:
+        logger.info("removing version %s of %s", version, guide_dir)
+        shutil.rmtree(os.path.join(guide_dir, str(version)), ignore_errors=True)
+    for name in os.listdir(guide_dir):
+        path = os.path.join(guide_dir, name)
+        if name.startswith(STAGING_PREFIX) and time.time() - os.path.getmtime(path) > stale_after:
+            logger.info("removing stale staging directory %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+def write_model_config(model_dir, base_path=SERVING_BASE_PATH):
+    """
+    write models.config listing every guide of model_dir with at least one
+    version, as TF Serving sees them under base_path.  the file is replaced
+    atomically and left alone if nothing changed.  returns its path.
+    """
+    guides = sorted((int(name[len('guide_'):]), name) for name in os.listdir(model_dir)
+                    if name.startswith('guide_') and name[len('guide_'):].isdigit()
+                    and model_versions(os.path.join(model_dir, name)))
+    lines = ['model_config_list {']
+    for _, name in guides:
+        lines += ['  config {',
+                  "    name: '%s'" % name,
+                  "    base_path: '%s/%s/'" % (base_path.rstrip('/'), name),
+                  "    model_platform: 'tensorflow'",
+                  '  }']
+    lines.append('}')
+    config = '\n'.join(lines) + '\n'
+    fn = os.path.join(model_dir, CONFIG_FILE)
+    try:
+        with open(fn) as f:
+            if f.read() == config:
+                return fn
+    except IOError:
+        pass
+    fd, tmp = tempfile.mkstemp(prefix='.' + CONFIG_FILE, dir=model_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(config)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, fn)
+    logger.info("wrote %s with %d guides", fn, len(guides))
+    return fn
+
+
+def _sync(path):
+    """flush the files of a directory tree and the directory itself to disk"""
+    for root, _, files in os.walk(path):
+        for name in files + ['.']:
+            try:
+                fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
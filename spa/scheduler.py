@@ -0,0 +1,122 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Parallel model building.
+
+Builds the models of many guides from a pool of worker processes.  Each
+worker gets an equal share of the cores for TensorFlow's thread pools so the
+machine is not oversubscribed, and a failing guide is recorded in the
+summary instead of aborting the batch.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from spa import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def parse_guide_ids(value, **dbinfo):
+    """
+    turn a --guide-id value into a list of guide ids.  'all' selects every
+    guide that has analytics tasks, otherwise a comma separated list.
+    """
+    if value.strip().lower() == 'all':
+        import spa.dbmanager as dbm
+        return dbm.get_guide_ids(**dbinfo) or []
+    return [int(g) for g in value.split(',') if g.strip()]
+
+
+def plan_workers(n_guides, workers=None, threads=None):
+    """
+    return (workers, threads): the number of worker processes and the
+    TensorFlow intra-op threads each of them may use.
+    """
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(workers or cpus, n_guides, cpus))
+    threads = threads or max(1, cpus // workers)
+    return workers, threads
+
+
+def _init_worker(threads, debug, instrument):
+    # must be set before tensorflow is imported by the worker
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import spa
+    spa.setup_logging(debug=debug)
+    if instrument:
+        # spans are logged by the worker, only the parent writes a textfile
+        from spa import metrics
+        metrics.enable()
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _build_guide(guide_id, model_args, dbinfo):
+    from spa.model_maker import ModelMaker
+
+    start = time.time()
+    summary = {'guide_id': guide_id, 'status': 'ok', 'path': None, 'error': None}
+    try:
+        summary['path'] = ModelMaker().make_model(guide_id, **dict(model_args, **dbinfo))
+        if summary['path'] is None:
+            summary['status'] = 'failed'
+            summary['error'] = 'no model was built'
+    except Exception as e:
+        logger.error("guide %s failed: %s", guide_id, traceback.format_exc())
+        summary['status'] = 'failed'
+        summary['error'] = str(e) or e.__class__.__name__
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def make_models(guide_ids, workers=None, threads=None, debug=False,
+                model_args=None, **dbinfo):
+    """
+    build the model of every guide in guide_ids in parallel and return a
+    list of per-guide summaries: guide_id, status ('ok' or 'failed'), path,
+    error and seconds.  model_args are passed on to ModelMaker.make_model.
+    """
+    model_args = model_args or dict()
+    if not guide_ids:
+        return []
+    workers, threads = plan_workers(len(guide_ids), workers, threads)
+    logger.info("building %d guides with %d workers, %d threads each",
+                len(guide_ids), workers, threads)
+
+    summaries = dict()
+    # tensorflow does not survive a fork, so always start fresh interpreters
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_worker,
+                             initargs=(threads, debug, metrics.enabled())) as executor:
+        futures = dict((executor.submit(_build_guide, g, model_args, dbinfo), g)
+                       for g in guide_ids)
+        for future in as_completed(futures):
+            guide_id = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                # the worker itself died, e.g. killed for running out of memory
+                summary = {'guide_id': guide_id, 'status': 'failed', 'path': None,
+                           'error': str(e) or e.__class__.__name__, 'seconds': None}
+            logger.info("guide %s: %s", guide_id, summary['status'])
+            summaries[guide_id] = summary
+    return [summaries[g] for g in guide_ids]
+
+
+def format_summary(summaries):
+    lines = ['%-10s %-8s %9s  %s' % ('guide', 'status', 'seconds', 'path / error')]
+    for s in summaries:
+        seconds = '%9.1f' % s['seconds'] if s['seconds'] is not None else '%9s' % '-'
+        detail = s['path'] if s['status'] == 'ok' else s['error']
+        lines.append('%-10s %-8s %s  %s' % (s['guide_id'], s['status'], seconds, detail))
+    n_ok = len([s for s in summaries if s['status'] == 'ok'])
+    lines.append('%d of %d guides built' % (n_ok, len(summaries)))
+    return '\n'.join(lines)
@@ -7,33 +7,175 @@ CREATE TABLE report_prediction(
     CONSTRAINT report_prediction_pkey PRIMARY KEY (report_id)
 );
     """,
-# table: report_prediction_history
+]
+
+# the prediction history, also run by spa-db migrate-history on a database
+# created before the history was partitioned
+history_schema_def = [
+# table: report_prediction_history, partitioned by month
+    """
+CREATE TABLE report_prediction_history (
+    report_id integer NOT NULL,
+    prediction double precision NOT NULL,
+    history_change_time timestamptz NOT NULL DEFAULT now(),
+    history_change_type character varying(16) NULL
+) PARTITION BY RANGE (history_change_time);
+CREATE TABLE report_prediction_history_default
+    PARTITION OF report_prediction_history DEFAULT;
+    """,
+# function: report_prediction_history_partition
+# creates the partition holding the month of the given day, if missing.
+# rows of that month already in the default partition are moved into it,
+# the default partition is detached meanwhile since it may not hold them
+    """
+CREATE OR REPLACE FUNCTION report_prediction_history_partition(day date) RETURNS text AS $$
+DECLARE
+  month_start date := date_trunc('month', day)::date;
+  month_end date := (date_trunc('month', day) + interval '1 month')::date;
+  partition_name text := 'report_prediction_history_p' || to_char(month_start, 'YYYYMM');
+  in_default boolean;
+BEGIN
+  IF to_regclass(partition_name) IS NOT NULL THEN
+    RETURN partition_name;
+  END IF;
+  in_default := EXISTS (SELECT 1 FROM report_prediction_history_default
+                        WHERE history_change_time >= month_start
+                              AND history_change_time < month_end);
+  IF in_default THEN
+    ALTER TABLE report_prediction_history
+      DETACH PARTITION report_prediction_history_default;
+  END IF;
+  EXECUTE format('CREATE TABLE %I PARTITION OF report_prediction_history '
+                 'FOR VALUES FROM (%L) TO (%L)',
+                 partition_name, month_start, month_end);
+  IF in_default THEN
+    EXECUTE format('WITH moved AS (DELETE FROM report_prediction_history_default '
+                   'WHERE history_change_time >= %L AND history_change_time < %L '
+                   'RETURNING report_id, prediction, history_change_time, history_change_type) '
+                   'INSERT INTO %I SELECT * FROM moved',
+                   month_start, month_end, partition_name);
+    ALTER TABLE report_prediction_history
+      ATTACH PARTITION report_prediction_history_default DEFAULT;
+  END IF;
+  RETURN partition_name;
+END;
+$$ LANGUAGE 'plpgsql';
+    """,
+# partitions: this month and the next three
     """
-CREATE SEQUENCE report_prediction_history_seq;
-CREATE TABLE report_prediction_history AS TABLE report_prediction WITH NO DATA;
-ALTER TABLE report_prediction_history
-    ADD COLUMN id integer default nextval('report_prediction_history_seq'),
-    ADD COLUMN history_change_time timestamptz DEFAULT now(),
-    ADD COLUMN history_change_type character varying(16) NULL,
-    ADD PRIMARY KEY (id);
+SELECT report_prediction_history_partition((now() + make_interval(months => m))::date)
+FROM generate_series(0, 3) AS m;
     """,
 # function: report_prediction_trigger
     """
 CREATE FUNCTION report_prediction_trigger() RETURNS trigger AS $$
 BEGIN
-  IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE'
-  THEN
-    INSERT INTO report_prediction_history (report_id, prediction, history_change_type)
-      VALUES (NEW.report_id, NEW.prediction, TG_OP);
-    RETURN NEW;
+  INSERT INTO report_prediction_history (report_id, prediction, history_change_type)
+    SELECT report_id, prediction, TG_OP FROM new_rows;
+  RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql' SECURITY DEFINER;
+    """,
+# triggers: prediction_history_insert, prediction_history_update
+# statement level, a trigger with a transition table handles a single event
+    """
+CREATE TRIGGER prediction_history_insert AFTER INSERT ON report_prediction
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE report_prediction_trigger();
+CREATE TRIGGER prediction_history_update AFTER UPDATE ON report_prediction
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE report_prediction_trigger();
+    """,
+]
+
+schema_def += history_schema_def
+
+# optional precomputed feature vectors, created by spa-db create-feature-vectors
+feature_vector_schema_def = [
+# table: report_feature_vector
+# features holds the report's values in the order of the guide's layout as
+# big-endian float4, layout_version the fingerprint of that layout
+    """
+CREATE TABLE report_feature_vector(
+    report_id integer NOT NULL,
+    guide_id integer NOT NULL,
+    layout_version character varying(40) NOT NULL,
+    features bytea NOT NULL,
+    result integer NULL,
+    update_time timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT report_feature_vector_pkey PRIMARY KEY (report_id)
+);
+CREATE INDEX report_feature_vector_guide_idx ON report_feature_vector (guide_id, report_id);
+    """,
+# table: report_feature_vector_dirty
+# reports whose vector must be recomputed by the next refresh
+    """
+CREATE TABLE report_feature_vector_dirty(
+    report_id integer NOT NULL
+);
+    """,
+# function: report_feature_vector_mark
+    """
+CREATE FUNCTION report_feature_vector_mark() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    INSERT INTO report_feature_vector_dirty (report_id)
+      SELECT DISTINCT report_id FROM old_rows;
+  ELSE
+    INSERT INTO report_feature_vector_dirty (report_id)
+      SELECT DISTINCT report_id FROM new_rows;
   END IF;
+  RETURN NULL;
 END;
 $$ LANGUAGE 'plpgsql' SECURITY DEFINER;
     """,
-# trigger: prediction_history
+# function: report_feature_vector_mark_report
     """
-CREATE TRIGGER prediction_history AFTER INSERT OR UPDATE ON report_prediction
-FOR EACH ROW EXECUTE PROCEDURE report_prediction_trigger();
+CREATE FUNCTION report_feature_vector_mark_report() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO report_feature_vector_dirty (report_id)
+    SELECT N.id FROM new_rows AS N JOIN old_rows AS O ON O.id = N.id
+    WHERE N.result IS DISTINCT FROM O.result OR N.guide_id IS DISTINCT FROM O.guide_id;
+  RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql' SECURITY DEFINER;
+    """,
+# triggers: feature_vector_insert, feature_vector_update, feature_vector_delete,
+#           feature_vector_report_update
+# statement level, they only record which reports changed
+    """
+CREATE TRIGGER feature_vector_insert AFTER INSERT ON report_result
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE report_feature_vector_mark();
+CREATE TRIGGER feature_vector_update AFTER UPDATE ON report_result
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE report_feature_vector_mark();
+CREATE TRIGGER feature_vector_delete AFTER DELETE ON report_result
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE report_feature_vector_mark();
+CREATE TRIGGER feature_vector_report_update AFTER UPDATE ON report
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE report_feature_vector_mark_report();
     """,
 ]
 
+# indexes on the checklist tables read by the AI, created by spa-db create-indexes
+# each is built with CREATE INDEX CONCURRENTLY so the application keeps
+# writing while it is built, which cannot run inside a transaction
+index_def = [
+# the reports of a guide, with the result for the labeled filter
+    ('report_guide_idx',
+     "CREATE INDEX CONCURRENTLY report_guide_idx ON report (guide_id, id) INCLUDE (result)"),
+# the results of a report per field, looked up by the pivot and the vectors
+    ('report_result_report_action_idx',
+     "CREATE INDEX CONCURRENTLY report_result_report_action_idx "
+     "ON report_result (report_id, action_id)"),
+# the guide layout
+    ('step_guide_idx',
+     "CREATE INDEX CONCURRENTLY step_guide_idx ON step (guide_id)"),
+    ('task_analytics_step_idx',
+     "CREATE INDEX CONCURRENTLY task_analytics_step_idx ON task (step_id, id) "
+     "WHERE is_analytics = true"),
+    ('task_action_task_idx',
+     "CREATE INDEX CONCURRENTLY task_action_task_idx ON task_action (task_id)"),
+]
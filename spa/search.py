@@ -0,0 +1,310 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Parallel hyperparameter search.
+
+The guide's feature matrix is read once and written as .npy files to shared
+memory (/dev/shm when available).  Trials run in a pool of worker processes
+that memory-map those files and stream them through the tf.data pipeline of
+spa.input_pipeline, so the matrix is held once in the page cache however
+many workers there are, and each worker only holds a chunk and a shuffle
+buffer.
+
+Each trial trains a model with a sampled width, depth, dropout, learning
+rate, batch size and early stopping patience.  Trials report their best
+validation loss after every epoch; a trial that is worse than the median of
+the other trials at the same epoch is pruned.  The best finished trial is
+published as the guide's next model version.
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import spa.dbmanager as dbm
+from spa import metrics, publisher
+from spa.feature_cache import layout_fingerprint
+from spa.model_store import guide_model_dir, write_preprocess
+from spa.scheduler import _init_worker, plan_workers
+
+logger = logging.getLogger(__name__)
+
+ARRAYS = ['report_ids', 'features', 'labels']
+SHARED_DIR = '/dev/shm'
+CHUNK_ROWS = 20000
+SHUFFLE_BUFFER = 20000
+
+# the configuration make_model uses, always tried first
+DEFAULT_PARAMS = {'hidden': 16, 'layers': 1, 'dropout': 0.5, 'learning_rate': 1e-3,
+                  'batch_size': 2048, 'patience': 10}
+SEARCH_SPACE = {
+    'hidden': [8, 16, 32, 64, 128],
+    'layers': [1, 2],
+    'dropout': [0.0, 0.1, 0.3, 0.5],
+    'learning_rate': (1e-4, 1e-2),  # sampled log-uniformly
+    'batch_size': [512, 1024, 2048, 4096],
+    'patience': [5, 10, 15],
+}
+
+
+def sample_params(n_trials, seed=0):
+    """return n_trials parameter sets, the first one being DEFAULT_PARAMS"""
+    rng = np.random.RandomState(seed)
+    trials = [dict(DEFAULT_PARAMS)]
+    while len(trials) < n_trials:
+        params = dict()
+        for name in sorted(SEARCH_SPACE):
+            space = SEARCH_SPACE[name]
+            if isinstance(space, tuple):
+                low, high = np.log(space[0]), np.log(space[1])
+                params[name] = float(np.exp(rng.uniform(low, high)))
+            else:
+                params[name] = space[rng.randint(len(space))]
+                if isinstance(params[name], np.generic):
+                    params[name] = params[name].item()
+        trials.append(params)
+    return trials[:n_trials]
+
+
+def _median_pruner(trial, history, lock, warmup, min_trials):
+    from tensorflow import keras
+
+    class MedianPruner(keras.callbacks.Callback):
+        """
+        stops a trial whose best validation loss so far is above the median
+        of the best losses other trials had reached at the same epoch.
+        history is a dict shared by all workers: epoch -> list of losses.
+        """
+
+        def __init__(self):
+            super(MedianPruner, self).__init__()
+            self.best = np.inf
+            self.pruned = False
+
+        def on_epoch_end(self, epoch, logs=None):
+            loss = (logs or {}).get('val_loss')
+            if loss is None:
+                return
+            self.best = min(self.best, loss)
+            with lock:
+                others = list(history.get(epoch, []))
+                history[epoch] = others + [self.best]
+            if epoch + 1 >= warmup and len(others) >= min_trials and \
+                    self.best > np.median(others):
+                logger.info("pruning trial %s at epoch %d, loss %.4f > median %.4f",
+                            trial, epoch + 1, self.best, np.median(others))
+                self.pruned = True
+                self.model.stop_training = True
+
+    return MedianPruner()
+
+
+def _run_trial(trial, params, data_dir, state, trial_dir, epochs, history, lock,
+               warmup, min_trials, seed):
+    import tensorflow as tf
+    from spa.feature_manifest import FeatureManifest
+    from spa.input_pipeline import ArraySource, class_weights, initial_bias, make_dataset
+    from spa.model_maker import ModelMaker
+
+    start = time.time()
+    summary = {'trial': trial, 'params': params, 'status': 'ok', 'val_loss': None,
+               'epochs': 0, 'path': None, 'error': None}
+    try:
+        arrays = [np.load(os.path.join(data_dir, n + '.npy'), mmap_mode='r') for n in ARRAYS]
+        source = ArraySource(*arrays, chunk_rows=CHUNK_ROWS)
+        mean = np.array(state['mean'], dtype=np.float32)
+        scale = np.array(state['scale'], dtype=np.float32)
+        counts = state['counts']
+        train = make_dataset(source, mean, scale, params['batch_size'], training=True,
+                             shuffle_buffer=SHUFFLE_BUFFER)
+        val = make_dataset(source, mean, scale, params['batch_size'], training=False)
+
+        maker = ModelMaker(seed=seed + trial)
+        model = maker.get_tf_model(np.empty((0, source.columns)),
+                                   output_bias=initial_bias(counts),
+                                   hidden=params['hidden'], dropout=params['dropout'],
+                                   learning_rate=params['learning_rate'],
+                                   layers=params['layers'])
+        early_stopping = tf.keras.callbacks.EarlyStopping(
+            patience=params['patience'], monitor='val_loss', mode='min',
+            restore_best_weights=True)
+        pruner = _median_pruner(trial, history, lock, warmup, min_trials)
+        with metrics.span('search.trial', guide_id=state['guide_id'], trial=trial):
+            fit = model.fit(train, epochs=epochs, callbacks=[early_stopping, pruner],
+                            class_weight=class_weights(counts), validation_data=val,
+                            verbose=0)
+        losses = fit.history.get('val_loss', [])
+        summary['epochs'] = len(losses)
+        summary['val_loss'] = float(min(losses)) if losses else None
+        if pruner.pruned:
+            summary['status'] = 'pruned'
+        else:
+            model.save(filepath=trial_dir, overwrite=True, include_optimizer=True)
+            FeatureManifest(state['guide_id'], state['layout'], mean, scale).save(trial_dir)
+            sample = next(iter(val.unbatch().batch(1000)),
+                          (np.empty((0, source.columns)), None))[0]
+            maker._export_weights(model, trial_dir, np.asarray(sample))
+            summary['path'] = trial_dir
+    except Exception as e:
+        logger.error("trial %s failed: %s", trial, traceback.format_exc())
+        summary['status'] = 'failed'
+        summary['error'] = str(e) or e.__class__.__name__
+    summary['seconds'] = time.time() - start
+    summary['peak_rss_mb'] = round(metrics.peak_rss_bytes() / 1048576.0, 1)
+    return summary
+
+
+def share_matrix(report_ids, features, labels, shared_dir=None):
+    """
+    write a feature matrix to a new temporary directory, in shared memory if
+    possible, and return the directory.  the caller removes it.
+    """
+    if shared_dir is None and os.path.isdir(SHARED_DIR) and os.access(SHARED_DIR, os.W_OK):
+        shared_dir = SHARED_DIR
+    data_dir = tempfile.mkdtemp(prefix='spa-search-', dir=shared_dir)
+    for name, rows in zip(ARRAYS, [report_ids, features, labels]):
+        np.save(os.path.join(data_dir, name + '.npy'), np.ascontiguousarray(rows))
+    return data_dir
+
+
+def search(guide_id, n_trials=16, workers=None, threads=None, model_dir='models',
+           cache=None, epochs=100, warmup=5, min_trials=3, seed=0, debug=False,
+           retain=None, **dbinfo):
+    """
+    run n_trials training trials for a guide in parallel, and save the best
+    one as the guide's next model version.  returns (path, summaries): the
+    path of the published model (None if no trial finished or the best one
+    failed validation, see spa.publisher) and one summary
+    per trial with its params, status ('ok', 'pruned' or 'failed'),
+    val_loss, epochs, seconds and the peak memory of its worker.
+
+    warmup - epochs a trial runs before it can be pruned
+    min_trials - trials that must have reached an epoch before the median
+                 of their losses is used to prune
+    """
+    from spa.input_pipeline import ArraySource, fit_scaler
+
+    start = time.time()
+    with metrics.span('search.fetch', guide_id=guide_id):
+        if cache is not None:
+            matrix = cache.get_feature_matrix(guide_id, **dbinfo)
+        else:
+            matrix = dbm.get_feature_matrix(guide_id, **dbinfo)
+    if matrix is None:
+        print('cannot read the reports of guide %s' % guide_id)
+        return None, []
+    layout, report_ids, features, labels = matrix
+    data_dir = share_matrix(report_ids, features, labels)
+    last_report_id = int(report_ids.max()) if len(report_ids) else None
+    del matrix, report_ids, features, labels
+    logger.info("shared the features of guide %s in %s (%.1f MB)",
+                guide_id, data_dir, sum(os.path.getsize(os.path.join(data_dir, n + '.npy'))
+                                        for n in ARRAYS) / 1048576.0)
+
+    guide_dir = guide_model_dir(model_dir, guide_id)
+    trials_dir = os.path.join(guide_dir, '.search-%d' % os.getpid())
+    try:
+        arrays = [np.load(os.path.join(data_dir, n + '.npy'), mmap_mode='r') for n in ARRAYS]
+        try:
+            mean, scale, counts = fit_scaler(ArraySource(*arrays, chunk_rows=CHUNK_ROWS))
+        except ValueError as e:
+            print('cannot search models of guide {}: {}'.format(guide_id, e))
+            return None, []
+        del arrays
+        state = {'guide_id': int(guide_id), 'layout': [tuple(r) for r in layout],
+                 'mean': mean.tolist(), 'scale': scale.tolist(),
+                 'counts': [int(c) for c in counts]}
+
+        trials = sample_params(n_trials, seed)
+        workers, threads = plan_workers(len(trials), workers, threads)
+        logger.info("searching %d trials for guide %s with %d workers, %d threads each",
+                    len(trials), guide_id, workers, threads)
+        os.makedirs(trials_dir, exist_ok=True)
+        summaries = dict()
+        # tensorflow does not survive a fork, so always start fresh interpreters
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Manager() as manager:
+            history, lock = manager.dict(), manager.Lock()
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                     initializer=_init_worker,
+                                     initargs=(threads, debug, metrics.enabled())) as executor:
+                futures = dict()
+                for trial, params in enumerate(trials):
+                    trial_dir = os.path.join(trials_dir, 'trial_%d' % trial)
+                    future = executor.submit(_run_trial, trial, params, data_dir, state,
+                                             trial_dir, epochs, history, lock, warmup,
+                                             min_trials, seed)
+                    futures[future] = trial
+                for future in as_completed(futures):
+                    trial = futures[future]
+                    try:
+                        summary = future.result()
+                    except Exception as e:
+                        # the worker itself died, e.g. killed for running out of memory
+                        summary = {'trial': trial, 'params': trials[trial], 'status': 'failed',
+                                   'val_loss': None, 'epochs': 0, 'path': None,
+                                   'error': str(e) or e.__class__.__name__, 'seconds': None,
+                                   'peak_rss_mb': None}
+                    logger.info("trial %s: %s, val_loss %s",
+                                trial, summary['status'], summary['val_loss'])
+                    summaries[trial] = summary
+        summaries = [summaries[t] for t in range(len(trials))]
+        metrics.count('search.trials', len(summaries))
+        metrics.count('search.pruned', len([s for s in summaries if s['status'] == 'pruned']))
+
+        finished = [s for s in summaries if s['status'] == 'ok' and s['val_loss'] is not None]
+        if not finished:
+            print('no trial of guide %s finished' % guide_id)
+            return None, summaries
+        best = min(finished, key=lambda s: s['val_loss'])
+        path = publish(best, model_dir, state, last_report_id, summaries, start, retain)
+        for s in summaries:
+            s['path'] = path if s is best else None
+        return path, summaries
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        shutil.rmtree(trials_dir, ignore_errors=True)
+
+
+def publish(best, model_dir, state, last_report_id, summaries, start, retain=None):
+    """publish the best trial's model as the guide's next version"""
+    seconds = time.time() - start
+    write_preprocess(best['path'], {
+        'guide_id': state['guide_id'], 'fingerprint': layout_fingerprint(state['layout']),
+        'columns': len(state['layout']), 'last_report_id': last_report_id, 'mode': 'search',
+        'seconds': seconds, 'full_seconds': seconds, 'params': best['params'], 'val_loss': best['val_loss'],
+        'trials': len(summaries),
+        'pruned': len([s for s in summaries if s['status'] == 'pruned'])})
+    try:
+        path = publisher.publish(best['path'], model_dir, state['guide_id'], retain=retain)
+    except publisher.PublishError as e:
+        print('not publishing trial {} of guide {}: {}'.format(best['trial'],
+                                                               state['guide_id'], e))
+        return None
+    logger.info("published trial %s as %s", best['trial'], path)
+    return path
+
+
+def format_search(summaries):
+    lines = ['%-6s %-7s %6s %6s %7s %9s %6s %8s %6s %8s %7s' % (
+        'trial', 'status', 'hidden', 'layers', 'dropout', 'lr', 'batch', 'patience',
+        'epochs', 'val_loss', 'rss_mb')]
+    for s in summaries:
+        p = s['params']
+        loss = '%8.4f' % s['val_loss'] if s['val_loss'] is not None else '%8s' % '-'
+        rss = '%7.0f' % s['peak_rss_mb'] if s.get('peak_rss_mb') else '%7s' % '-'
+        lines.append('%-6s %-7s %6d %6d %7.2f %9.2e %6d %8d %6d %s %s%s' % (
+            s['trial'], s['status'], p['hidden'], p['layers'], p['dropout'],
+            p['learning_rate'], p['batch_size'], p['patience'], s['epochs'], loss, rss,
+            '  <- %s' % s['path'] if s['path'] else ''))
+    counts = dict()
+    for s in summaries:
+        counts[s['status']] = counts.get(s['status'], 0) + 1
+    lines.append(', '.join('%d %s' % (counts[k], k) for k in sorted(counts)))
+    return '\n'.join(lines)
@@ -0,0 +1,335 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Client for the guide_<id> models served by TF Serving.
+
+RestClient talks to the REST port (8501) over persistent HTTP/1.1
+connections, one per thread.  GrpcClient talks to the gRPC port (8500) and
+sends the inputs as binary float32 tensors; it needs the optional grpcio and
+tensorflow-serving-api packages.  MicroBatcher sits in front of either one
+and coalesces concurrent single-report requests into one call per guide,
+waiting at most max_latency seconds for a batch to fill.
+
+LocalServingServer is a stand-in for the REST API of TF Serving, used to
+exercise the clients and benchmark them without a model server.
+"""
+
+import http.client
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+
+import numpy as np
+
+from spa.defaults import Defaults
+
+logger = logging.getLogger(__name__)
+
+REST_PORT = Defaults.SERVING_REST_PORT
+GRPC_PORT = 8500
+
+
+def model_name(guide_id):
+    return 'guide_{guide_id}'.format(guide_id=guide_id)
+
+
+class ServingError(Exception):
+    pass
+
+
+class RestClient(object):
+
+    def __init__(self, host='localhost', port=REST_PORT, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __getstate__(self):
+        # connections stay with the process that opened them
+        return dict(self.__dict__, local=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, local=threading.local())
+
+    def predict(self, guide_id, instances, version=None):
+        """return the predictions of a guide's model for a batch of instances"""
+        path = '/v1/models/%s%s:predict' % (
+            model_name(guide_id), '/versions/%s' % version if version else '')
+        body = json.dumps({'instances': np.asarray(instances, dtype=np.float32).tolist()})
+        status, data = self._request('POST', path, body.encode('utf-8'))
+        if status != 200:
+            raise ServingError("%s returned %s: %s" % (path, status, data[:200]))
+        return np.array(json.loads(data)['predictions'], dtype=np.float32).reshape(-1)
+
+    def model_status(self, guide_id, version=None):
+        """
+        return the state of a guide's model version ('AVAILABLE', 'LOADING',
+        ...) as TF Serving reports it, or None if it does not know it
+        """
+        path = '/v1/models/%s%s' % (model_name(guide_id),
+                                    '/versions/%s' % version if version else '')
+        status, data = self._request('GET', path)
+        if status == 404:
+            return None
+        if status != 200:
+            raise ServingError("%s returned %s: %s" % (path, status, data[:200]))
+        states = json.loads(data).get('model_version_status', [])
+        return states[0]['state'] if states else None
+
+    def wait_available(self, guide_id, version, timeout=600, interval=0.5):
+        """
+        wait until TF Serving serves a version of a guide's model.  returns
+        the seconds waited, or None on timeout.
+        """
+        start = time.time()
+        while time.time() - start < timeout:
+            try:
+                if self.model_status(guide_id, version) == 'AVAILABLE':
+                    return time.time() - start
+            except (ServingError, OSError, http.client.HTTPException):
+                pass
+            time.sleep(interval)
+        return None
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            conn.connect()
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.local.conn = conn
+        return conn
+
+    def _request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                # the server may have closed an idle connection, retry once
+                self.close()
+                if attempt:
+                    raise
+
+
+class GrpcClient(object):
+
+    def __init__(self, host='localhost', port=GRPC_PORT, timeout=10,
+                 signature_name='serving_default'):
+        import grpc
+        from tensorflow_serving.apis import prediction_service_pb2_grpc
+
+        self.timeout = timeout
+        self.signature_name = signature_name
+        self.channel = grpc.insecure_channel('%s:%s' % (host, port))
+        self.stub = prediction_service_pb2_grpc.PredictionServiceStub(self.channel)
+        self.signatures = dict()
+        self.lock = threading.Lock()
+
+    def predict(self, guide_id, instances, version=None):
+        from tensorflow.core.framework import tensor_pb2, types_pb2
+        from tensorflow_serving.apis import predict_pb2
+
+        x = np.ascontiguousarray(instances, dtype='<f4')
+        input_name, output_name = self._signature(guide_id)
+        request = predict_pb2.PredictRequest()
+        request.model_spec.name = model_name(guide_id)
+        request.model_spec.signature_name = self.signature_name
+        if version:
+            request.model_spec.version.value = int(version)
+        tensor = tensor_pb2.TensorProto(dtype=types_pb2.DT_FLOAT, tensor_content=x.tobytes())
+        for n in x.shape:
+            tensor.tensor_shape.dim.add(size=n)
+        request.inputs[input_name].CopyFrom(tensor)
+        output = self.stub.Predict(request, self.timeout).outputs[output_name]
+        if output.tensor_content:
+            return np.frombuffer(output.tensor_content, dtype='<f4').copy()
+        return np.array(output.float_val, dtype=np.float32)
+
+    def close(self):
+        self.channel.close()
+
+    def _signature(self, guide_id):
+        """the input and output tensor names of a model, looked up once"""
+        from tensorflow_serving.apis import get_model_metadata_pb2
+
+        name = model_name(guide_id)
+        with self.lock:
+            if name not in self.signatures:
+                request = get_model_metadata_pb2.GetModelMetadataRequest()
+                request.model_spec.name = name
+                request.metadata_field.append('signature_def')
+                response = self.stub.GetModelMetadata(request, self.timeout)
+                signatures = get_model_metadata_pb2.SignatureDefMap()
+                response.metadata['signature_def'].Unpack(signatures)
+                signature = signatures.signature_def[self.signature_name]
+                self.signatures[name] = (list(signature.inputs)[0], list(signature.outputs)[0])
+            return self.signatures[name]
+
+
+class MicroBatcher(object):
+    """
+    coalesces single-report predictions into batches.  a batch is sent when
+    it holds max_batch requests or max_latency seconds after its first
+    request arrived, whichever comes first.
+    """
+
+    def __init__(self, client, max_batch=256, max_latency=0.005):
+        self.client = client
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = Queue()
+        self.batches = 0
+        self.requests = 0
+        self.thread = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, guide_id, instance):
+        """queue one report's feature vector, returns a Future of its prediction"""
+        future = Future()
+        self.queue.put((guide_id, instance, future))
+        return future
+
+    def predict(self, guide_id, instance, timeout=None):
+        return self.submit(guide_id, instance).result(timeout)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 \
+                        else self.queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        by_guide = dict()
+        for guide_id, instance, future in batch:
+            by_guide.setdefault(guide_id, []).append((instance, future))
+        for guide_id, items in by_guide.items():
+            try:
+                predictions = self.client.predict(guide_id, [i for i, _ in items])
+                predictions = [float(p) for p in predictions]
+                if len(predictions) != len(items):
+                    raise ServingError("guide %s returned %d predictions for %d instances"
+                                       % (guide_id, len(predictions), len(items)))
+                for (_, future), p in zip(items, predictions):
+                    future.set_result(p)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+            self.batches += 1
+            self.requests += len(items)
+
+
+class LocalServingServer(object):
+    """
+    in-process stand-in for the TF Serving REST API.  scorer maps a float32
+    batch to one prediction per row; delay adds a fixed cost per call to
+    mimic inference.  like a single model session, calls are scored one at
+    a time.  the model status requests report the versions found in
+    model_dir as available.
+    """
+
+    def __init__(self, scorer=None, host='127.0.0.1', port=0, delay=0.0, model_dir=None):
+        self.scorer = scorer or (lambda x: 1 / (1 + np.exp(-x.mean(axis=1))))
+        self.delay = delay
+        self.model_dir = model_dir
+        self.calls = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            wbufsize = 64 * 1024
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    x = np.array(json.loads(body)['instances'], dtype=np.float32)
+                    with server.lock:
+                        if server.delay:
+                            time.sleep(server.delay)
+                        server.calls += 1
+                        predictions = np.asarray(server.scorer(x)).reshape(-1, 1)
+                    status, data = 200, {'predictions': predictions.tolist()}
+                except (ValueError, KeyError) as e:
+                    status, data = 400, {'error': str(e)}
+                data = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                from spa.model_store import model_versions
+
+                parts = self.path.strip('/').split('/')
+                versions = model_versions(os.path.join(server.model_dir, parts[2])) \
+                    if server.model_dir and len(parts) >= 3 else []
+                if len(parts) == 5:
+                    versions = [v for v in versions if str(v) == parts[4]]
+                if versions:
+                    status, data = 200, {'model_version_status': [
+                        {'version': str(v), 'state': 'AVAILABLE'} for v in reversed(versions)]}
+                else:
+                    status, data = 404, {'error': 'Could not find any versions of model'}
+                data = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self.httpd = Server((host, port), Handler)
+        self.host, self.port = self.httpd.server_address[:2]
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='LocalServingServer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,221 @@
+# Copyright 2020 Zinnotech, all rights reserved
+"""
+Synthetic guides and reports for benchmarking at scale.
+
+create_guide adds a guide with the given number of analytics actions,
+grouped into steps and tasks shaped like the real checklists: mostly RADIO
+tasks with one of two or three actions checked, some CHECK tasks whose
+actions are checked independently, and some numeric TEXT tasks.
+create_reports adds reports of a guide with one report_result per action.
+Their results follow a hidden linear model of the features, thresholded so
+that positive_rate of the reports get result 1.
+
+Everything is streamed into the database with COPY, with ids reserved from
+the tables' sequences, so it can be loaded next to real data.
+drop_guide removes a synthetic guide with its reports and predictions.
+"""
+
+import io
+import logging
+
+import numpy as np
+import psycopg2
+
+import spa.dbmanager as dbm
+
+logger = logging.getLogger(__name__)
+
+TITLE = 'synthetic benchmark guide'
+# tables holding rows of the reports that not every database has, the last
+# one is filled by the triggers of report_result
+OPTIONAL_TABLES = ['report_prediction', 'report_prediction_history', 'report_feature_vector',
+                   'report_feature_vector_dirty']
+# task type, share of the tasks, actions per task
+TASK_SHAPES = [('RADIO', 0.8, (2, 3)), ('CHECK', 0.1, (1, 4)), ('TEXT', 0.1, (1, 1))]
+CHECK_RATE = 0.3
+
+
+def reserve_ids(mgr, table, n):
+    """
+    reserve n consecutive ids of table from its id sequence and return the
+    first.  the sequence is moved past ids that were loaded explicitly.
+    """
+    rows = mgr.get_all_rows(
+        "SELECT setval('{table}_id_seq', GREATEST(nextval('{table}_id_seq'),"
+        " (SELECT COALESCE(max(id), 0) + 1 FROM {table})) + {n} - 1)".format(table=table, n=int(n)))
+    return rows[0][0] - n + 1
+
+
+def copy_frame(mgr, table, frame):
+    """COPY a pandas DataFrame into the columns of table named like its columns"""
+    buf = io.StringIO()
+    frame.to_csv(buf, header=False, index=False)
+    buf.seek(0)
+    with mgr.db_conn.cursor() as cur:
+        cur.copy_expert("COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)".format(
+            table=table, columns=', '.join(frame.columns)), buf, size=1024 * 1024)
+
+
+def plan_tasks(n_actions, rng):
+    """return (type, number of actions) of tasks adding up to n_actions actions"""
+    tasks = []
+    types = [t for t, _, _ in TASK_SHAPES]
+    shares = [s for _, s, _ in TASK_SHAPES]
+    sizes = dict((t, r) for t, _, r in TASK_SHAPES)
+    while n_actions > 0:
+        task_type = types[rng.choice(len(types), p=shares)]
+        lo, hi = sizes[task_type]
+        n = min(n_actions, int(rng.integers(lo, hi + 1)))
+        if task_type == 'RADIO' and n < 2:
+            task_type = 'CHECK'
+        tasks.append((task_type, n))
+        n_actions -= n
+    return tasks
+
+
+def create_guide(n_actions, tasks_per_step=10, seed=0, **kwargs):
+    """add a synthetic guide with n_actions analytics actions and return its id"""
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    tasks = plan_tasks(n_actions, rng)
+    n_steps = (len(tasks) + tasks_per_step - 1) // tasks_per_step
+    mgr = dbm.DBManager()
+    try:
+        mgr.connect(**kwargs)
+        with mgr.transaction():
+            guide_id = reserve_ids(mgr, 'guide', 1)
+            with mgr.db_conn.cursor() as cur:
+                cur.execute("INSERT INTO guide (id, type, title) VALUES (%s, 'PROCEDURE', %s)",
+                            (guide_id, TITLE))
+            step_id = reserve_ids(mgr, 'step', n_steps)
+            task_id = reserve_ids(mgr, 'task', len(tasks))
+            action_id = reserve_ids(mgr, 'task_action', n_actions)
+            steps = np.arange(step_id, step_id + n_steps)
+            copy_frame(mgr, 'step', pd.DataFrame({
+                'id': steps, 'guide_id': guide_id,
+                'title': ['step %d' % (i + 1) for i in range(n_steps)],
+                'sequence': np.arange(1, n_steps + 1)}))
+            task_ids = np.arange(task_id, task_id + len(tasks))
+            copy_frame(mgr, 'task', pd.DataFrame({
+                'id': task_ids,
+                'step_id': steps[np.arange(len(tasks)) // tasks_per_step],
+                'type': [t for t, _ in tasks],
+                'title': ['task %d' % (i + 1) for i in range(len(tasks))],
+                'sequence': np.arange(len(tasks)) % tasks_per_step + 1,
+                'is_mandatory': True, 'is_analytics': True}))
+            counts = [n for _, n in tasks]
+            copy_frame(mgr, 'task_action', pd.DataFrame({
+                'id': np.arange(action_id, action_id + n_actions),
+                'task_id': np.repeat(task_ids, counts),
+                'title': ['action %d' % (i + 1) for i in range(n_actions)],
+                'sequence': np.concatenate([np.arange(1, n + 1) for n in counts])}))
+        logger.info("created synthetic guide %d with %d steps, %d tasks and %d actions",
+                    guide_id, n_steps, len(tasks), n_actions)
+        return guide_id
+    except psycopg2.Error as err:
+        logger.error('creating synthetic guide failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def sample_reports(layout, n_reports, rng):
+    """return a float32 feature matrix of n_reports random reports of a layout"""
+    task_ids = np.array([r[1] for r in layout])
+    types = np.array([r[3] for r in layout])
+    features = np.zeros((n_reports, len(layout)), dtype=np.float32)
+    check = types == 'CHECK'
+    features[:, check] = rng.random((n_reports, check.sum())) < CHECK_RATE
+    text = types == 'TEXT'
+    features[:, text] = np.round(rng.normal(20, 5, (n_reports, text.sum())), 1)
+    # one action of every RADIO task is checked
+    radio = np.flatnonzero(types == 'RADIO')
+    _, starts, sizes = np.unique(task_ids[radio], return_index=True, return_counts=True)
+    for start, size in zip(radio[starts], sizes):
+        features[np.arange(n_reports), start + rng.integers(0, size, n_reports)] = 1
+    return features
+
+
+def create_reports(guide_id, n_reports, positive_rate=0.05, chunk_reports=5000, seed=0,
+                   **kwargs):
+    """
+    add n_reports synthetic reports of a guide with their report_results.
+    returns the (first, last) report id added, or None on failure.
+    """
+    import pandas as pd
+
+    layout = dbm.get_guide_layout(guide_id, **kwargs)
+    if not layout:
+        logger.error("guide %s has no analytics actions", guide_id)
+        return None
+    rng = np.random.default_rng(seed)
+    weights = rng.normal(0, 1, len(layout)).astype(np.float32)
+    steps, tasks, actions = [np.array([r[i] for r in layout]) for i in range(3)]
+    is_text = np.array([r[3] == 'TEXT' for r in layout])
+
+    mgr = dbm.DBManager()
+    try:
+        mgr.connect(**kwargs)
+        first = reserve_ids(mgr, 'report', n_reports)
+        threshold = None
+        for lo in range(0, n_reports, chunk_reports):
+            n = min(chunk_reports, n_reports - lo)
+            features = sample_reports(layout, n, rng)
+            centered = np.where(is_text, (features - 20) / 5, features - 0.5)
+            scores = centered @ weights + rng.normal(0, 1, n)
+            if threshold is None:
+                threshold = np.quantile(scores, 1 - positive_rate)
+            report_ids = np.arange(first + lo, first + lo + n)
+            results = np.where(features > 0.5, 'true', 'false').astype(object)
+            results[:, is_text] = np.char.mod('%.1f', features[:, is_text])
+            with mgr.transaction():
+                copy_frame(mgr, 'report', pd.DataFrame({
+                    'id': report_ids, 'guide_id': guide_id,
+                    'result': (scores > threshold).astype(np.int64)}))
+                copy_frame(mgr, 'report_result', pd.DataFrame({
+                    'report_id': np.repeat(report_ids, len(layout)),
+                    'step_id': np.tile(steps, n), 'task_id': np.tile(tasks, n),
+                    'action_id': np.tile(actions, n), 'result': results.reshape(-1)}))
+            logger.debug("guide %s: added reports %d to %d",
+                         guide_id, report_ids[0], report_ids[-1])
+        # without fresh statistics the planner picks plans for empty tables
+        mgr.modify("ANALYZE step, task, task_action, report, report_result")
+        logger.info("added %d synthetic reports of guide %s", n_reports, guide_id)
+        return first, first + n_reports - 1
+    except psycopg2.Error as err:
+        logger.error('creating synthetic reports failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
+
+
+def drop_guide(guide_id, **kwargs):
+    """
+    remove a synthetic guide with its reports, report_results, predictions
+    and feature vectors
+    """
+    mgr = dbm.DBManager()
+    try:
+        mgr.connect(**kwargs)
+        rows = mgr.get_all_rows("SELECT title FROM guide WHERE id = %d" % int(guide_id))
+        if not rows or rows[0][0] != TITLE:
+            logger.error("guide %s is not a synthetic guide", guide_id)
+            return False
+        report_filter = "SELECT id FROM report WHERE guide_id = %d" % int(guide_id)
+        # the tables of spa-db create-table and create-feature-vectors may be missing
+        rows = mgr.get_all_rows("SELECT t FROM unnest(ARRAY['%s']) AS t "
+                                "WHERE to_regclass(t) IS NOT NULL" % "', '".join(OPTIONAL_TABLES))
+        existing = set(r[0] for r in rows or [])
+        tables = ['report_result'] + [t for t in OPTIONAL_TABLES if t in existing]
+        with mgr.transaction(), mgr.db_conn.cursor() as cur:
+            for table in tables:
+                cur.execute("DELETE FROM %s WHERE report_id IN (%s)" % (table, report_filter))
+            cur.execute("DELETE FROM guide WHERE id = %d" % int(guide_id))
+        logger.info("dropped synthetic guide %s", guide_id)
+        return True
+    except psycopg2.Error as err:
+        logger.error('dropping synthetic guide failed: %s', str(err).strip())
+    finally:
+        if mgr:
+            mgr.disconnect()
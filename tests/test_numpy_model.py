@@ -0,0 +1,46 @@
+# Copyright 2020 Zinnotech, all rights reserved
+import numpy as np
+import pytest
+
+from spa.numpy_model import CLIP, PARITY_TOLERANCE, NumpyModel, check_parity, export_weights
+
+tf = pytest.importorskip('tensorflow')
+
+
+def _train(tmp_path, layers):
+    from spa.feature_manifest import FeatureManifest
+    from spa.model_maker import ModelMaker
+    rng = np.random.RandomState(7)
+    raw = rng.randint(0, 2, size=(512, 40)).astype(np.float32)
+    raw[:, :5] = rng.normal(3, 2, size=(512, 5))
+    labels = (raw[:, 0] + raw[:, 7] > 3).astype(np.float32)
+    mean, scale = raw.mean(axis=0), raw.std(axis=0) + 1e-3
+    scaled = np.clip((raw - mean) / scale, -CLIP, CLIP)
+    model = ModelMaker(seed=3).get_tf_model(scaled, hidden=16, layers=layers)
+    model.fit(scaled, labels, epochs=3, batch_size=64, verbose=0)
+    path = str(tmp_path / 'guide_1' / '1')
+    model.save(path)
+    layout = [(1, i, i + 1, 'TEXT' if i < 5 else 'RADIO') for i in range(40)]
+    FeatureManifest(1, layout, mean, scale).save(path)
+    export_weights(model, path)
+    return model, path, raw, scaled
+
+
+@pytest.mark.parametrize('layers', [1, 2])
+def test_predict_matches_keras(tmp_path, layers):
+    model, path, raw, scaled = _train(tmp_path, layers)
+    expected = np.asarray(model.predict(scaled, verbose=0)).reshape(-1)
+    numpy_model = NumpyModel.load(path)
+    np.testing.assert_allclose(numpy_model.predict(raw), expected, rtol=0, atol=PARITY_TOLERANCE)
+    np.testing.assert_allclose(numpy_model.predict(scaled, scaled=True), expected,
+                               rtol=0, atol=PARITY_TOLERANCE)
+    assert check_parity(model, path, scaled) <= PARITY_TOLERANCE
+
+
+def test_check_parity_rejects_other_weights(tmp_path):
+    model, path, raw, scaled = _train(tmp_path, 1)
+    weights = model.get_weights()
+    weights[-1] = weights[-1] + 1
+    model.set_weights(weights)
+    with pytest.raises(ValueError):
+        check_parity(model, path, scaled)
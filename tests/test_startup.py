@@ -0,0 +1,9 @@
+# Copyright 2020 Zinnotech, all rights reserved
+from spa.bench import STARTUP_COMMANDS, bench_startup
+
+
+def test_commands_without_training_start_fast():
+    results = bench_startup(repeat=3, target_ms=200)
+    assert sorted(results) == sorted(' '.join(args) for args in STARTUP_COMMANDS)
+    failed = dict((cmd, r) for cmd, r in results.items() if r['exit'] or not r['ok'])
+    assert not failed, "over 200ms or failed: %s" % failed
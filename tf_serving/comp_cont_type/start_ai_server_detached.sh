@@ -3,7 +3,8 @@ sudo docker run -t --rm \
     -p 8501:8501 \
     -v "$(pwd)/models:/models/" tensorflow/serving \
     --model_config_file=/models/models.config \
-    --model_config_file_poll_wait_seconds=600
+    --model_config_file_poll_wait_seconds=60 \
+    --file_system_poll_wait_seconds=1
 
 
 #docker run -t --rm \
@@ -11,4 +12,5 @@ sudo docker run -t --rm \
 #    -p 8501:8501 \
 #    -v "$(pwd):/models/" tensorflow/serving \
 #    --model_config_file=/models/models.config \
-#    --model_config_file_poll_wait_seconds=600
+#    --model_config_file_poll_wait_seconds=60 \
+#    --file_system_poll_wait_seconds=1